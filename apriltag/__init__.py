@@ -1,3 +1,7 @@
-from apriltag import AprilTagDetector, AprilTagDetection
+from apriltag import AprilTagDetector, AprilTagDetection, DETECTION_DTYPE, aligned_ndarray
+from apriltag import throughput_decimation, image_pyramid, roi_rectangles
+from apriltag import get_detector, get_family, clear_detectors
 
-__all__ = [ AprilTagDetector, AprilTagDetection ]
\ No newline at end of file
+__all__ = [ AprilTagDetector, AprilTagDetection, DETECTION_DTYPE, aligned_ndarray,
+            throughput_decimation, image_pyramid, roi_rectangles,
+            get_detector, get_family, clear_detectors ]
\ No newline at end of file
@@ -875,6 +875,28 @@ static void refine_edges(apriltag_detector_t *td, image_u8_t *im_orig, struct qu
     }
 }
 
+// Returns `pref` if it already expresses a preference, otherwise -1 if
+// q0 is smaller, 1 if q1 is smaller and 0 on a tie.
+static inline int prefer_smaller(int pref, double q0, double q1)
+{
+    if (pref)
+        return pref;
+
+    if (q0 < q1)
+        return -1;
+    if (q1 < q0)
+        return 1;
+    return 0;
+}
+
+static inline int apriltag_id_allowed(apriltag_detector_t *td, int id)
+{
+    if (td->allowed_ids == NULL)
+        return 1;
+
+    return id < td->nallowed_ids && td->allowed_ids[id];
+}
+
 static void quad_decode_task(void *_u)
 {
     struct quad_decode_task *task = (struct quad_decode_task*) _u;
@@ -933,7 +955,7 @@ static void quad_decode_task(void *_u)
             struct quick_decode_entry entry;
 
             float decision_margin = quad_decode(family, im, quad, &entry);
-            if (entry.hamming < 255) {
+            if (entry.hamming < 255 && apriltag_id_allowed(td, entry.id)) {
                 apriltag_detection_t *det = calloc(1, sizeof(apriltag_detection_t));
 
                 det->family = family;
@@ -1213,9 +1235,20 @@ zarray_t *apriltag_detector_detect(apriltag_detector_t *td, image_u8_t *im_orig)
 
                 if (g2d_polygon_overlaps_polygon(poly0, poly1)) {
                     // the tags overlap. Delete one, keep the other.
+                    // The choice must not depend on the order of the
+                    // detections, which removals shuffle and which
+                    // depends on which ids are allowed: after the
+                    // decoding scores, break ties on the corners.
+                    int pref = 0;
+                    pref = prefer_smaller(pref, det0->hamming, det1->hamming);
+                    pref = prefer_smaller(pref, -det0->goodness, -det1->goodness);
+                    pref = prefer_smaller(pref, -det0->decision_margin, -det1->decision_margin);
+                    for (int k = 0; k < 4; k++) {
+                        pref = prefer_smaller(pref, det0->p[k][0], det1->p[k][0]);
+                        pref = prefer_smaller(pref, det0->p[k][1], det1->p[k][1]);
+                    }
 
-                    if (det0->hamming < det1->hamming ||
-                        (det0->hamming == det1->hamming && det0->goodness > det1->goodness)) {
+                    if (pref <= 0) {
                         // keep det0, destroy det1
                         apriltag_detection_destroy(det1);
                         zarray_remove_index(detections, i1, 1);
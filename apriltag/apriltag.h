@@ -175,6 +175,13 @@ struct apriltag_detector
 
     struct apriltag_quad_thresh_params qtp;
 
+    // When non-NULL, only tags whose id i satisfies i < nallowed_ids
+    // and allowed_ids[i] != 0 are reported. Quads that decode to any
+    // other id are dropped before a detection is created. Not owned
+    // by the detector.
+    const uint8_t *allowed_ids;
+    int nallowed_ids;
+
     ///////////////////////////////////////////////////////////////
     // Statistics relating to last processed frame
     timeprofile_t *tp;
@@ -1,9 +1,15 @@
 import cython
+import atexit
+import threading
 import numpy as np
+from Queue import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from refine import refine_detections
 
 cimport cpython
 cimport numpy as np
-from cpython.cobject cimport PyCObject_FromVoidPtr, PyCObject_AsVoidPtr
+from libc.string cimport memcpy
 
 
 #
@@ -18,6 +24,7 @@ cdef extern from "zarray.h":
 
     inline int zarray_size(const zarray_t *za)
     inline void zarray_get(const zarray_t *za, int idx, void *p)
+    inline void zarray_clear(zarray_t *za)
 
 
 #--------------------------------------
@@ -29,8 +36,23 @@ cdef extern from "image_u8.h":
         int stride
         np.uint8_t *buf
 
-    image_u8_t *image_u8_create(unsigned int width, unsigned int height)
-    void image_u8_destroy(image_u8_t *im)
+    image_u8_t *image_u8_create(unsigned int width, unsigned int height) nogil
+    void image_u8_destroy(image_u8_t *im) nogil
+
+
+# Must match DEFAULT_ALIGNMENT in common/image_u8.c. The quad thresholding
+# step asserts that its input has the same stride as a freshly created
+# image_u8_t, so only buffers with this row alignment can be wrapped
+# without copying when quads are detected at full resolution.
+DEF IMAGE_U8_ALIGNMENT = 96
+
+# Mirror of image_u8_t without the const qualifiers, so that a view onto
+# a numpy buffer can be filled in on the stack.
+cdef struct image_u8_view_t:
+    int width
+    int height
+    int stride
+    np.uint8_t *buf
 
 
 #--------------------------------------
@@ -48,6 +70,7 @@ cdef extern from "apriltag.h":
 #--------------------------------------
     ctypedef struct apriltag_family_t:
         np.uint32_t black_border
+        np.uint32_t d
 
     ctypedef struct apriltag_detector_t:
         int nthreads;
@@ -57,6 +80,9 @@ cdef extern from "apriltag.h":
         int refine_decode;
         int refine_pose;
         int debug;
+        const np.uint8_t *allowed_ids;
+        int nallowed_ids;
+        zarray_t *tag_families;
 
     ctypedef struct apriltag_detection_t:
         apriltag_family_t *family;
@@ -71,10 +97,15 @@ cdef extern from "apriltag.h":
     apriltag_detector_t *apriltag_detector_create()
     void apriltag_detector_add_family(apriltag_detector_t *td, apriltag_family_t *fam)
     void apriltag_detector_destroy(apriltag_detector_t *td)
-    zarray_t *apriltag_detector_detect(apriltag_detector_t *td, image_u8_t *im_orig)
+    zarray_t *apriltag_detector_detect(apriltag_detector_t *td, image_u8_t *im_orig) nogil
     void apriltag_detections_destroy(zarray_t *detections)
 
 
+# Frees the quick-decode table that apriltag_detector_add_family builds
+# for a family. Not in apriltag.h, but exported by apriltag.c.
+cdef extern void quick_decode_uninit(apriltag_family_t *fam)
+
+
 #--------------------------------------
 cdef extern from "tag36h11.h":
 #--------------------------------------
@@ -138,86 +169,535 @@ cdef create_AprilTagDetection_from_struct(apriltag_detection_t *det):
     return AprilTagDetection(id_, hamming, goodness, decision_margin, H, c, p)
 
 
+# One record per detection, for `detect(im, as_array=True)`. Fields have
+# the same names as those of AprilTagDetection, so `dets['c']` is the
+# (N, 2) array of centers, `dets['p']` the (N, 4, 2) array of corners
+# and `dets['H']` the (N, 3, 3) array of homographies.
+DETECTION_DTYPE = np.dtype([ ('id', np.int32), ('hamming', np.int32),
+                             ('goodness', np.float32), ('decision_margin', np.float32),
+                             ('H', np.float64, (3, 3)), ('c', np.float64, (2,)),
+                             ('p', np.float64, (4, 2)) ])
+
+# C layout of a DETECTION_DTYPE record
+cdef struct detection_record_t:
+    np.int32_t id
+    np.int32_t hamming
+    np.float32_t goodness
+    np.float32_t decision_margin
+    double H[3][3]
+    double c[2]
+    double p[4][2]
+
+
+cdef np.ndarray create_detection_array(zarray_t *c_detections):
+    """
+    Copy all of `c_detections` into a new DETECTION_DTYPE array
+    """
+    cdef int n = zarray_size(c_detections)
+    cdef np.ndarray out = np.empty(n, dtype=DETECTION_DTYPE)
+    cdef detection_record_t *rec = <detection_record_t*>out.data
+    cdef apriltag_detection_t *det
+    cdef int i, j, k
+
+    for i in range(n):
+        zarray_get(c_detections, i, &det)
+        rec[i].id = det.id
+        rec[i].hamming = det.hamming
+        rec[i].goodness = det.goodness
+        rec[i].decision_margin = det.decision_margin
+        for j in range(3):
+            for k in range(3):
+                rec[i].H[j][k] = matd_get(det.H, j, k)
+        rec[i].c[0] = det.c[0]
+        rec[i].c[1] = det.c[1]
+        for j in range(4):
+            rec[i].p[j][0] = det.p[j][0]
+            rec[i].p[j][1] = det.p[j][1]
+
+    return out
+
+
+cdef inline int image_u8_aligned_stride(int width):
+    return ((width + IMAGE_U8_ALIGNMENT - 1) // IMAGE_U8_ALIGNMENT) * IMAGE_U8_ALIGNMENT
+
+
+cdef bint image_u8_can_wrap(apriltag_detector_t *td, const np.uint8_t[:, :] arr):
+    """
+    Can `arr` be handed to the detector as is? The detector blurs the
+    quad image in place, and thresholds it assuming default alignment.
+    Neither matters when quads are detected on a decimated copy, and
+    the detector does not write to `arr` otherwise, so read-only
+    buffers can be wrapped as well.
+    """
+    if td.quad_decimate > 1:
+        return True
+
+    if td.quad_sigma != 0:
+        return False
+
+    return arr.strides[0] == image_u8_aligned_stride(arr.shape[1])
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef image_u8_t *image_u8_create_from_ndarray(np.ndarray[np.uint8_t, ndim=2, mode='c'] arr):
+cdef image_u8_t *image_u8_create_from_ndarray(const np.uint8_t[:, :] arr) nogil:
     cdef image_u8_t* im
     im = image_u8_create(arr.shape[1], arr.shape[0])
 
-    cdef int y, x
-    for y in xrange(im.height):
-        for x in xrange(im.width):
-            im.buf[im.stride*y+x] = arr[y,x]
+    cdef int y
+    for y in range(im.height):
+        memcpy(&im.buf[im.stride*y], &arr[y,0], im.width)
 
     return im
 
 
+# Decimation factors handled by image_u8_decimate, and the size of
+# the quad image the throughput profile aims for.
+THROUGHPUT_DECIMATIONS = [ 1., 1.5, 2., 3., 4. ]
+THROUGHPUT_QUAD_PIXELS = 2e6
+
+
+def throughput_decimation(height, width):
+    """
+    The smallest supported decimation that brings a (`height`, `width`)
+    image down to about `THROUGHPUT_QUAD_PIXELS` for quad detection
+    """
+    for decimate in THROUGHPUT_DECIMATIONS:
+        if height*width / (decimate*decimate) <= THROUGHPUT_QUAD_PIXELS:
+            return decimate
+
+    return THROUGHPUT_DECIMATIONS[-1]
+
+
+def image_pyramid(im, factors):
+    """
+    Downsample `im` by each of the power-of-two `factors` (e.g. [2, 4])
+    by averaging blocks of pixels. Each level is computed from the
+    previous one, so the full resolution image is only read once.
+    Pixel (i, j) of a level covers pixels [i*f, (i+1)*f) x [j*f, (j+1)*f)
+    of `im`.
+    """
+    levels = { 1: np.asarray(im) }
+    level, f = np.asarray(im, dtype=np.uint16), 1
+    while f < max(factors):
+        h, w = level.shape[0] // 2 * 2, level.shape[1] // 2 * 2
+        level = (level[0:h:2,0:w:2] + level[1:h:2,0:w:2] +
+                 level[0:h:2,1:w:2] + level[1:h:2,1:w:2] + 2) // 4
+        f *= 2
+        if f in factors:
+            levels[f] = level.astype(np.uint8)
+
+    assert all(f in levels for f in factors), 'pyramid factors must be powers of two'
+    return [ levels[f] for f in factors ]
+
+
+def aligned_ndarray(height, width):
+    """
+    Allocate a (`height`, `width`) uint8 array whose rows are padded
+    the same way as the detector's own images. Frames written into such
+    an array are detected without an intermediate copy.
+    """
+    buf = np.empty((height, image_u8_aligned_stride(width)), dtype=np.uint8)
+    return buf[:,:width]
+
+
+# Predicted quads are grown by this fraction of their size on each side,
+# to include the white margin and allow for prediction error.
+ROI_QUAD_MARGIN = 0.5
+
+
+def roi_rectangles(rois, height, width, quad_margin=ROI_QUAD_MARGIN):
+    """
+    Integer (x0, y0, x1, y1) rectangles, clipped to a (`height`, `width`)
+    image, covering each of `rois`. An ROI is either a rectangle
+    (x0, y0, x1, y1) or a predicted quad given as a (4, 2) array of
+    corners, which is grown by `quad_margin` of its size. Overlapping
+    rectangles are merged, so that no pixel is processed twice.
+    """
+    rects = []
+    for roi in rois:
+        roi = np.asarray(roi, dtype=np.float)
+        if roi.shape == (4, 2):
+            lo, hi = roi.min(axis=0), roi.max(axis=0)
+            pad = quad_margin * (hi - lo).max()
+            roi = np.r_[ lo - pad, hi + pad ]
+        elif roi.shape != (4,):
+            raise Exception("ROIs must be (x0, y0, x1, y1) rectangles or (4, 2) quads")
+
+        x0, y0 = max(0, int(np.floor(roi[0]))), max(0, int(np.floor(roi[1])))
+        x1, y1 = min(width, int(np.ceil(roi[2]))), min(height, int(np.ceil(roi[3])))
+        if x1 > x0 and y1 > y0:
+            rects.append((x0, y0, x1, y1))
+
+    merged = True
+    while merged:
+        merged = False
+        for i in xrange(len(rects)):
+            for j in xrange(i+1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = (min(a[0], b[0]), min(a[1], b[1]),
+                                max(a[2], b[2]), max(a[3], b[3]))
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return rects
+
+
+def translate_detections(detections, x0, y0):
+    """
+    Move `detections` (a list of AprilTagDetection or a DETECTION_DTYPE
+    array) found in a sub-image at (`x0`, `y0`) to image coordinates
+    """
+    T = np.array([ [1., 0., x0], [0., 1., y0], [0., 0., 1.] ])
+    offset = np.array([ x0, y0 ], dtype=np.float)
+
+    if isinstance(detections, np.ndarray):
+        detections['H'] = np.einsum('ij,njk->nik', T, detections['H'])
+        detections['c'] += offset
+        detections['p'] += offset
+        return detections
+
+    return [ d._replace(H=T.dot(d.H), c=d.c + offset, p=d.p + offset) for d in detections ]
+
+
+#--------------------------------------
+cdef class _TagFamily:
+#--------------------------------------
+    """
+    Owns a C tag family and its quick-decode table. The table is built
+    the first time the family is added to a detector and is only read
+    during detection, so any number of detectors can share one family.
+    """
+    cdef apriltag_family_t *tf
+    cdef readonly object name
+    cdef readonly int tag_bits
+
+    def __cinit__(self, name, border_size):
+        self.name = name
+        if name == "tag36h11":
+            self.tf = tag36h11_create()
+        elif name == "tag36h10":
+            self.tf = tag36h10_create()
+        elif name == "tag36artoolkit":
+            self.tf = tag36artoolkit_create()
+        elif name == "tag25h9":
+            self.tf = tag25h9_create()
+        elif name == "tag25h7":
+            self.tf = tag25h7_create()
+        else:
+            raise Exception("Unrecognized tag family name: " + name)
+
+        self.tf.black_border = border_size
+        self.tag_bits = self.tf.d + 2*border_size
+
+
+    def __dealloc__(self):
+        if self.tf == NULL:
+            return
+
+        quick_decode_uninit(self.tf)
+        if self.name == "tag36h11":
+            tag36h11_destroy(self.tf)
+        elif self.name == "tag36h10":
+            tag36h10_destroy(self.tf)
+        elif self.name == "tag36artoolkit":
+            tag36artoolkit_destroy(self.tf)
+        elif self.name == "tag25h9":
+            tag25h9_destroy(self.tf)
+        elif self.name == "tag25h7":
+            tag25h7_destroy(self.tf)
+
+
+#--------------------------------------
+cdef class _Detector:
+#--------------------------------------
+    """
+    Owns a C detector. Holds a reference to its family, so the family
+    outlives it, and detaches the family before the detector is
+    destroyed so that the shared quick-decode table is left alone.
+    """
+    cdef apriltag_detector_t *td
+    cdef readonly _TagFamily family
+
+    def __cinit__(self, _TagFamily family):
+        self.family = family
+        self.td = apriltag_detector_create()
+        apriltag_detector_add_family(self.td, family.tf)
+
+
+    def configure(self, decimate, blur_sigma, n_threads, debug,
+                  refine_edges, refine_decode, refine_pose):
+        self.td.quad_decimate = decimate
+        self.td.quad_sigma = blur_sigma
+        self.td.nthreads = n_threads
+        self.td.debug = debug
+        self.td.refine_edges = refine_edges
+        self.td.refine_decode = refine_decode
+        self.td.refine_pose = refine_pose
+
+
+    def close(self):
+        if self.td == NULL:
+            return
+
+        zarray_clear(self.td.tag_families)
+        apriltag_detector_destroy(self.td)
+        self.td = NULL
+
+
+    def __dealloc__(self):
+        self.close()
+
+
+_families = {}
+_detectors = {}
+_registry_lock = threading.Lock()
+
+
+def get_family(tagfamily='tag36h11', border_size=1):
+    """
+    The cached C tag family for (`tagfamily`, `border_size`). Creating
+    a family and its quick-decode table is the bulk of the cost of
+    setting up a detector.
+    """
+    key = (tagfamily, border_size)
+    with _registry_lock:
+        if key not in _families:
+            _families[key] = _TagFamily(tagfamily, border_size)
+        return _families[key]
+
+
 #--------------------------------------
 class AprilTagDetector(object):
 #--------------------------------------
     def __init__(self, tagfamily='tag36h11', debug=False,
-                 border_size=1, n_threads=1, decimate=1., blur_sigma=0.,
-                 refine_edges=1, refine_decode=0, refine_pose=0):
+                 border_size=1, n_threads=None, decimate=1., blur_sigma=0.,
+                 refine_edges=1, refine_decode=0, refine_pose=0, profile=None):
+        """
+        `n_threads` defaults to 1. With `profile='throughput'`, it
+        defaults to the number of cpus and `decimate` is chosen per
+        frame from the image size (see `throughput_decimation`). Quads
+        are then found on the decimated image and tags are decoded at
+        full resolution. Corners, centers and homographies are then
+        refined against the full resolution image (see `refine`).
+        """
         self.tagfamily = tagfamily
+        self.profile = profile
+        self._params = dict(tagfamily=tagfamily, debug=debug,
+                            border_size=border_size, n_threads=n_threads,
+                            decimate=decimate, blur_sigma=blur_sigma,
+                            refine_edges=refine_edges, refine_decode=refine_decode,
+                            refine_pose=refine_pose, profile=profile)
 
-        cdef apriltag_family_t *tf_
-        if tagfamily == "tag36h11":
-            tf_ = tag36h11_create()
-        elif tagfamily == "tag36h10":
-            tf_ = tag36h10_create()
-        elif tagfamily == "tag36artoolkit":
-            tf_ = tag36artoolkit_create()
-        elif tagfamily == "tag25h9":
-            tf_ = tag25h9_create()
-        elif tagfamily == "tag25h7":
-            tf_ = tag25h7_create()
-        else:
-            raise Exception("Unrecognized tag family name: " + tagfamily)
+        if profile == 'throughput':
+            if n_threads is None:
+                n_threads = cpu_count()
+            refine_edges = 1
+        elif profile is not None:
+            raise Exception("Unrecognized detector profile: " + profile)
 
-        tf_.black_border = border_size
-        self.tf = PyCObject_FromVoidPtr(tf_, NULL)
+        if n_threads is None:
+            n_threads = 1
 
-        cdef apriltag_detector_t *td_
-        td_ = apriltag_detector_create()
-        td_.quad_decimate = decimate
-        td_.quad_sigma = blur_sigma
-        td_.nthreads = n_threads
-        td_.debug = debug
-        td_.refine_edges = refine_edges
-        td_.refine_decode = refine_decode
-        td_.refine_pose = refine_pose
-        self.td = PyCObject_FromVoidPtr(td_, NULL)
-
-        apriltag_detector_add_family(td_, tf_)
-
-
-    def __del__(self):
-        apriltag_detector_destroy(<apriltag_detector_t *>PyCObject_AsVoidPtr(self.td))
-
-        cdef apriltag_family_t *tf_
-        tf_ = <apriltag_family_t*>PyCObject_AsVoidPtr(self.tf)
-        if self.tagfamily == "tag36h11":
-            tag36h11_destroy(tf_)
-        elif self.tagfamily == "tag36h10":
-            tag36h10_destroy(tf_)
-        elif self.tagfamily == "tag36artoolkit":
-            tag36artoolkit_destroy(tf_)
-        elif self.tagfamily == "tag25h9":
-            tag25h9_destroy(tf_)
-        elif self.tagfamily == "tag25h7":
-            tag25h7_destroy(tf_)
-
-
-    def detect(self, np.ndarray[np.uint8_t, ndim=2, mode='c'] im):
-        cdef image_u8_t* im_u8
-        im_u8 = image_u8_create_from_ndarray(im)
+        # the C detector keeps per-frame state, so a single instance
+        # can only run one detection at a time
+        self._lock = threading.Lock()
+        self._workers = []
+
+        # set on detectors handed out by `get_detector`, which only
+        # `clear_detectors` may free
+        self._shared = False
+
+        family = get_family(tagfamily, border_size)
+        self.tag_bits = family.tag_bits
+
+        self._td = _Detector(family)
+        self._td.configure(decimate, blur_sigma, n_threads, debug,
+                           refine_edges, refine_decode, refine_pose)
 
+
+    def close(self):
+        """
+        Free the C detector (and its worker threads) now rather than
+        whenever the garbage collector gets to it. The tag family stays
+        cached for other detectors.
+
+        Detectors from `get_detector` are shared by the whole process,
+        so closing one (e.g. at the end of a `with` block) does nothing;
+        they are freed by `clear_detectors`.
+        """
+        if not self._shared:
+            self._close()
+
+
+    def _close(self):
+        with self._lock:
+            self._td.close()
+
+        for detector in self._workers:
+            detector._close()
+        self._workers = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def detect(self, im, as_array=False, rois=None, ids=None):
+        """
+        Detect tags in the grayscale image `im`. Rows of `im` may be
+        strided (e.g. a view from `aligned_ndarray`); if pixels within
+        a row are not contiguous, a contiguous copy is made first.
+        `im` may be read-only.
+
+        Returns a list of AprilTagDetection, or with `as_array=True`,
+        a single DETECTION_DTYPE array with one record per tag.
+
+        When the tags are known to be near given positions (e.g. from
+        the previous frame), pass those as `rois` (see `roi_rectangles`)
+        and only those parts of `im` are searched. `ids` restricts the
+        detections to the given tag ids, which must be non-negative
+        integers (ValueError otherwise).
+        """
+        if rois is None:
+            detections = self._detect(im, as_array, ids)
+        else:
+            detections = self._detect_rois(im, rois, as_array, ids)
+
+        if self.profile == 'throughput':
+            detections = self.refine(im, detections)
+
+        return detections
+
+
+    def detect_multiscale(self, im, factors=(2, 4), as_array=False):
+        """
+        Coarse-to-fine detection. Tags are detected on each level of an
+        image pyramid that downsamples `im` by `factors`, merged by tag id
+        (the finest level that found a tag wins), and then re-localized
+        on the full resolution image. Large tags that the detector misses
+        at full resolution are found on the coarser levels.
+
+        Detections are sorted by id. See `detect` for `as_array`.
+        """
+        levels = sorted(zip(factors, image_pyramid(im, factors)), key=lambda l: -l[0])
+
+        if as_array:
+            scaled = []
+            for f, level in levels:
+                dets = self._detect(level, True)
+                dets['H'][:,:2,:] *= f
+                dets['c'] *= f
+                dets['p'] *= f
+                scaled.append(dets)
+
+            # last occurrence of each id, i.e. from the finest level
+            scaled = np.concatenate(scaled)[::-1]
+            _, first = np.unique(scaled['id'], return_index=True)
+            return self.refine(im, scaled[first])
+
+        merged = {}
+        for f, level in levels:
+            S = np.diag([ f, f, 1. ])
+            for d in self._detect(level):
+                merged[d.id] = d._replace(H=S.dot(d.H), c=d.c*f, p=d.p*f)
+
+        return self.refine(im, [ merged[k] for k in sorted(merged) ])
+
+
+    def _detect_rois(self, im, rois, as_array=False, ids=None):
+        """
+        Detect tags in each ROI as a sub-image of its own, so that no
+        stage of the detector looks at the rest of `im`. A tag seen in
+        several ROIs is reported once.
+        """
+        found = []
+        for x0, y0, x1, y1 in roi_rectangles(rois, im.shape[0], im.shape[1]):
+            detections = self._detect(im[y0:y1, x0:x1], as_array, ids)
+            found.append(translate_detections(detections, x0, y0))
+
+        if as_array:
+            if not found:
+                return np.empty(0, dtype=DETECTION_DTYPE)
+            found = np.concatenate(found)
+            _, first = np.unique(found['id'], return_index=True)
+            return found[np.sort(first)]
+
+        unique = {}
+        for d in sum(found, []):
+            unique.setdefault(d.id, d)
+        return unique.values()
+
+
+    def _detect(self, const np.uint8_t[:, :] im, as_array=False, ids=None):
+        if im.strides[1] != 1:
+            im = np.ascontiguousarray(im)
+
+        cdef _Detector detector = self._td
         cdef apriltag_detector_t *td_
-        td_ = <apriltag_detector_t*>PyCObject_AsVoidPtr(self.td)
 
+        cdef image_u8_view_t view
+        cdef image_u8_t* im_u8 = <image_u8_t*>&view
+        cdef bint wrap
         cdef zarray_t *c_detections
-        c_detections = apriltag_detector_detect(td_, im_u8)
-        image_u8_destroy(im_u8)
+
+        # allowed_ids[i] != 0 for each allowed id i
+        cdef np.uint8_t[::1] allowed_ids = None
+        if ids is not None:
+            ids = np.asarray(sorted(ids))
+            if len(ids) and (ids.dtype.kind not in 'iu' or ids[0] < 0):
+                raise ValueError("Tag ids must be non-negative integers, got %s" % list(ids))
+            ids = ids.astype(np.intp)
+            mask = np.zeros(ids[-1]+1 if len(ids) else 1, dtype=np.uint8)
+            mask[ids] = 1
+            allowed_ids = mask
+
+        with self._lock:
+            td_ = detector.td
+            if td_ == NULL:
+                raise Exception("AprilTagDetector has been closed")
+
+            if self.profile == 'throughput':
+                td_.quad_decimate = throughput_decimation(im.shape[0], im.shape[1])
+
+            if allowed_ids is not None:
+                td_.allowed_ids = &allowed_ids[0]
+                td_.nallowed_ids = allowed_ids.shape[0]
+
+            wrap = image_u8_can_wrap(td_, im)
+            if wrap:
+                view.width = im.shape[1]
+                view.height = im.shape[0]
+                view.stride = im.strides[0]
+                view.buf = <np.uint8_t*>&im[0,0]
+
+            # The C detector does not touch any python objects, so let
+            # other threads run while it works
+            with nogil:
+                if not wrap:
+                    im_u8 = image_u8_create_from_ndarray(im)
+
+                c_detections = apriltag_detector_detect(td_, im_u8)
+
+                if not wrap:
+                    image_u8_destroy(im_u8)
+
+            td_.allowed_ids = NULL
+            td_.nallowed_ids = 0
+
+        if as_array:
+            try:
+                return create_detection_array(c_detections)
+            finally:
+                apriltag_detections_destroy(c_detections)
 
         cdef apriltag_detection_t *det
         py_detections = []
@@ -227,3 +707,88 @@ class AprilTagDetector(object):
 
         apriltag_detections_destroy(c_detections)
         return py_detections
+
+
+    def refine(self, im, detections):
+        """
+        Snap the edges of `detections` to the full resolution image `im`
+        and recompute their corners, centers and homographies. The quads
+        found by the detector can be off by a good fraction of a bit,
+        especially when detecting on a decimated image.
+        """
+        return refine_detections(im, detections, self.tag_bits)
+
+
+    def detect_many(self, images, max_workers=None, as_array=False):
+        """
+        Detect tags in each image of `images` using a pool of
+        `max_workers` threads (default: one per cpu). Returns a list
+        with the detections of each image, in input order. See `detect`
+        for `as_array`.
+        """
+        if max_workers is None:
+            max_workers = cpu_count()
+
+        max_workers = max(1, min(max_workers, len(images)))
+
+        # Each thread needs a C detector of its own. Extra detectors
+        # are kept around for subsequent calls
+        while len(self._workers) < max_workers - 1:
+            self._workers.append(AprilTagDetector(**self._params))
+
+        idle = Queue()
+        for detector in [ self ] + self._workers[:max_workers-1]:
+            idle.put(detector)
+
+        def detect_one(im):
+            detector = idle.get()
+            try:
+                return detector.detect(im, as_array)
+            finally:
+                idle.put(detector)
+
+        pool = ThreadPool(max_workers)
+        try:
+            return pool.map(detect_one, images)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def get_detector(tagfamily='tag36h11', **kwargs):
+    """
+    A process-wide AprilTagDetector for `tagfamily` and the detector
+    parameters `kwargs` (see `AprilTagDetector`). Repeated calls with
+    the same arguments return the same detector, so the C detector,
+    its family and its worker threads are only set up once. Detection
+    on a shared detector is serialized; use `detect_many` to work on
+    several frames at once. Its `close` does nothing, see
+    `clear_detectors`.
+    """
+    key = (tagfamily, frozenset(kwargs.items()))
+    with _registry_lock:
+        detector = _detectors.get(key)
+
+    if detector is None:
+        detector = AprilTagDetector(tagfamily, **kwargs)
+        with _registry_lock:
+            detector = _detectors.setdefault(key, detector)
+            detector._shared = True
+
+    return detector
+
+
+@atexit.register
+def clear_detectors():
+    """
+    Close all detectors handed out by `get_detector` and drop the
+    cached tag families. Runs at interpreter exit, while the C library
+    is still loaded.
+    """
+    with _registry_lock:
+        detectors = _detectors.values()
+        _detectors.clear()
+        _families.clear()
+
+    for detector in detectors:
+        detector._close()
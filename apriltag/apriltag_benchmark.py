@@ -0,0 +1,239 @@
+import re
+import sys
+import os.path
+import numpy as np
+from time import time
+from multiprocessing import cpu_count
+from skimage.io import imread
+from skimage.color import rgb2gray
+from skimage.util import img_as_ubyte
+from skimage.transform import rescale
+from apriltag import AprilTagDetector, aligned_ndarray, get_detector, clear_detectors
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAMILIES = [ 'tag36h11', 'tag36h10', 'tag36artoolkit', 'tag25h9', 'tag25h7' ]
+
+
+def load_family_codes(tagfamily):
+    """ Read the bit size and codes of `tagfamily` from its C source """
+    with open(os.path.join(HERE, tagfamily + '.c')) as f:
+        src = f.read()
+
+    d = int(re.search(r'tf->d = (\d+);', src).group(1))
+    codes = [ int(c, 16) for c in re.findall(r'codes\[\d+\] = 0x([0-9a-f]+)UL', src) ]
+    return d, codes
+
+
+def render_family_mosaic(tagfamily, ntags, side_px):
+    """
+    Render up to `ntags` tags of `tagfamily` on a square grid about
+    `side_px` pixels wide. Each tag has a one bit black border and
+    a one bit white margin. Returns the image and the true outer
+    corners of each tag, keyed by tag id.
+    """
+    d, codes = load_family_codes(tagfamily)
+    codes = codes[:ntags]
+
+    cols = int(np.ceil(np.sqrt(len(codes))))
+    rows = int(np.ceil(len(codes) / float(cols)))
+    cell = d + 4
+    bit_px = max(1, side_px // (cols*cell))
+
+    im = np.empty((rows*cell, cols*cell), dtype=np.uint8)
+    im.fill(255)
+    corners = {}
+    for k, code in enumerate(codes):
+        r, c = divmod(k, cols)
+        bits = [ (code >> (d*d-1-i)) & 1 for i in xrange(d*d) ]
+        tag = np.zeros((d+2, d+2), dtype=np.uint8)
+        tag[1:-1,1:-1] = np.reshape(bits, (d, d)) * 255
+        im[r*cell+1:r*cell+d+3, c*cell+1:c*cell+d+3] = tag
+
+        x0, y0 = (c*cell+1)*bit_px, (r*cell+1)*bit_px
+        x1, y1 = (c*cell+d+3)*bit_px, (r*cell+d+3)*bit_px
+        corners[k] = np.array([ [x0, y0], [x1, y0], [x1, y1], [x0, y1] ], dtype=np.float)
+
+    im = np.kron(im, np.ones((bit_px, bit_px), dtype=np.uint8))
+    return im, corners
+
+
+def corner_rmse(detections, corners):
+    """ RMS distance of detected tag corners to the nearest true corner """
+    sqerr = [ ((p[:,None,:] - corners[d.id][None,:,:])**2).sum(axis=2).min(axis=1)
+                for d in detections for p in [ d.p ] ]
+    return np.sqrt(np.mean(sqerr)) if sqerr else np.nan
+
+
+def load_frame():
+    """
+    Load the image given on the command line, or synthesize a ~24 MP
+    frame by upscaling the calibration target mosaic
+    """
+    if len(sys.argv) > 1:
+        im = imread(sys.argv[1])
+        scale = 1
+    else:
+        im = imread(os.path.join(HERE, '..', 'target', 'mosaic.png'))
+        scale = 20
+
+    if len(im.shape) == 3:
+        im = rgb2gray(im)
+
+    im = img_as_ubyte(im)
+    im = np.kron(im, np.ones((scale, scale), dtype=np.uint8))
+
+    # make sure the row length is not a multiple of the alignment,
+    # otherwise the plain array is already zero-copy
+    if im.shape[1] % 96 == 0:
+        im = np.ascontiguousarray(im[:,:-1])
+
+    return im
+
+
+def time_detect(detector, im, repeat=3):
+    t0 = time()
+    for _ in xrange(repeat):
+        detections = detector.detect(im)
+    return (time()-t0) / repeat, detections
+
+
+def setup_overhead(repeat=20):
+    """ Per-call cost of setting up a detector, with and without the registry """
+    frame, _ = render_family_mosaic('tag36h11', 4, 200)
+
+    def fresh():
+        # what every call site used to do: new family, new detector
+        clear_detectors()
+        return AprilTagDetector(profile='throughput').detect(frame)
+
+    def cached_family():
+        return AprilTagDetector(profile='throughput').detect(frame)
+
+    def registry():
+        return get_detector(profile='throughput').detect(frame)
+
+    print '  %dx%d frame, %d tags' % (frame.shape[1], frame.shape[0], len(registry()))
+    for title, f in [ ('fresh', fresh), ('cached family', cached_family), ('get_detector', registry) ]:
+        t0 = time()
+        for _ in xrange(repeat):
+            f()
+        print '  %16s: %.5fs/call' % (title, (time()-t0) / repeat)
+
+
+def main():
+    print '\n--setup overhead--------------------\n'
+    setup_overhead()
+
+    im = load_frame()
+    print '\n  frame: %dx%d (%.1f MP)' % (im.shape[1], im.shape[0], im.size/1e6)
+
+    aligned = aligned_ndarray(*im.shape)
+    aligned[:] = im
+
+    for title, kwargs in [ ('full resolution', {}), ('decimate=2', {'decimate': 2.}) ]:
+        print '\n--%s--------------------\n' % title
+        detector = AprilTagDetector(**kwargs)
+
+        t_copy, copied = time_detect(detector, im)
+        print '    unaligned: %.4fs/frame' % t_copy
+
+        t_view, viewed = time_detect(detector, aligned)
+        print '      aligned: %.4fs/frame' % t_view
+
+        key = lambda d: d.id
+        assert len(copied) == len(viewed)
+        assert all(a.id == b.id and np.allclose(a.p, b.p) for a, b in
+                    zip(sorted(copied, key=key), sorted(viewed, key=key)))
+
+    print '\n--threads--------------------\n'
+    detector = AprilTagDetector()
+    frames = [ aligned ] * cpu_count() * 2
+
+    t0 = time()
+    sequential = [ detector.detect(f) for f in frames ]
+    print '      detect: %.4fs/frame' % ((time()-t0) / len(frames))
+
+    t0 = time()
+    threaded = detector.detect_many(frames)
+    print ' detect_many: %.4fs/frame (%d threads)' % ((time()-t0) / len(frames), cpu_count())
+
+    assert [ len(d) for d in sequential ] == [ len(d) for d in threaded ]
+
+    print '\n--structured output--------------------\n'
+    frame, corners = render_family_mosaic('tag36h11', 587, 4000)
+    detector = get_detector(decimate=2.)
+
+    t0 = time()
+    detections = detector.detect(frame)
+    c, p = np.array([ d.c for d in detections ]), np.array([ d.p for d in detections ])
+    t_list = time() - t0
+
+    t0 = time()
+    dets = detector.detect(frame, as_array=True)
+    t_array = time() - t0
+
+    assert np.allclose(c, dets['c']) and np.allclose(p, dets['p'])
+    print '  %d tags' % len(dets)
+    print '   namedtuples: %.4fs/frame' % t_list
+    print '         array: %.4fs/frame' % t_array
+
+    print '\n--regions of interest--------------------\n'
+    # a target that fills part of a 24 MP frame, with tag positions
+    # predicted to within a few pixels
+    tags, corners = render_family_mosaic('tag36h11', 36, 1500)
+    frame = np.empty((4000, 6000), dtype=np.uint8)
+    frame.fill(128)
+    frame[1000:1000+tags.shape[0], 2000:2000+tags.shape[1]] = tags
+    corners = dict((k, p + [ 2000, 1000 ]) for k, p in corners.items())
+    predicted = [ p + np.random.uniform(-10, 10, p.shape) for p in corners.values() ]
+    detector = get_detector()
+
+    t0 = time()
+    full = detector.detect(frame)
+    t_full = time() - t0
+
+    t0 = time()
+    tracked = detector.detect(frame, rois=predicted, ids=corners.keys())
+    t_tracked = time() - t0
+
+    print '   full frame: %.4fs/frame, %d tags' % (t_full, len(full))
+    print '         rois: %.4fs/frame, %d tags' % (t_tracked, len(tracked))
+
+    print '\n--throughput profile--------------------\n'
+    print '  %-16s %6s %17s %17s %17s' % ('', '', 'found', 'time/frame', 'corner rmse')
+    print '  %-16s %6s %8s %8s %8s %8s %8s %8s' % (
+        'family', 'tags', 'default', 'profile', 'default', 'profile', 'default', 'profile')
+
+    for tagfamily in FAMILIES:
+        frame, corners = render_family_mosaic(tagfamily, 300, 4000)
+
+        t_default, default = time_detect(AprilTagDetector(tagfamily=tagfamily), frame, 1)
+        t_profile, profile = time_detect(
+                AprilTagDetector(tagfamily=tagfamily, profile='throughput'), frame, 1)
+
+        print '  %-16s %6d %8d %8d %7.3fs %7.3fs %6.2fpx %6.2fpx' % (
+            tagfamily, len(corners), len(default), len(profile), t_default, t_profile,
+            corner_rmse(default, corners), corner_rmse(profile, corners))
+    print '\n--multiscale--------------------\n'
+    frame, corners = render_family_mosaic('tag36h11', 587, 5000)
+    detector = AprilTagDetector(profile='throughput')
+
+    # what get_tag_detections used to do: detect at full and quarter
+    # resolution with fresh detectors, keep the larger set
+    t0 = time()
+    full = AprilTagDetector().detect(frame)
+    quarter = AprilTagDetector().detect(img_as_ubyte(rescale(frame, 1./4)))
+    t_two_scale = time() - t0
+
+    t0 = time()
+    pyramid = detector.detect_multiscale(frame)
+    t_pyramid = time() - t0
+
+    print '   two scales: %.4fs/frame, %d + %d tags, corner rmse %.3fpx' % (
+        t_two_scale, len(full), len(quarter), corner_rmse(full, corners))
+    print '      pyramid: %.4fs/frame, %d tags, corner rmse %.3fpx' % (
+        t_pyramid, len(pyramid), corner_rmse(pyramid, corners))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import numpy as np
+from apriltag import AprilTagDetector, DETECTION_DTYPE, aligned_ndarray, roi_rectangles
+from apriltag import get_detector, clear_detectors
+from apriltag_benchmark import render_family_mosaic, corner_rmse
+
+
+np.random.seed(0)
+
+
+def same_detections(a, b, atol=1e-8):
+    """ Lists of AprilTagDetection with the same tags at the same places """
+    key = lambda d: d.id
+    a, b = sorted(a, key=key), sorted(b, key=key)
+    return [ d.id for d in a ] == [ d.id for d in b ] and all(
+                np.allclose(da.p, db.p, atol=atol) and np.allclose(da.c, db.c, atol=atol) and
+                np.allclose(da.H / da.H[2,2], db.H / db.H[2,2], atol=atol)
+                    for da, db in zip(a, b))
+
+
+frame, corners = render_family_mosaic('tag36h11', 36, 900)
+if frame.shape[1] % 96 == 0:
+    frame = np.ascontiguousarray(frame[:,:-1])
+detector = AprilTagDetector()
+full = detector.detect(frame)
+assert sorted(d.id for d in full) == sorted(corners)
+
+
+print '\n--zero-copy vs copy--------------------\n'
+aligned = aligned_ndarray(*frame.shape)
+aligned[:] = frame
+padded = np.zeros((frame.shape[0], frame.shape[1]+1), dtype=np.uint8)
+padded[:,:-1] = frame
+readonly = frame.copy()
+readonly.flags.writeable = False
+
+for im in [ aligned, padded[:,:-1], np.asfortranarray(frame), readonly ]:
+    assert same_detections(detector.detect(im), full)
+assert np.array_equal(aligned, frame)
+print '  ok'
+
+
+print '\n--detect_many--------------------\n'
+# crops with different tags, so that a mixed up order shows
+crops = [ np.ascontiguousarray(frame[:h,:w]) for h, w in
+            np.random.randint(200, min(frame.shape), (12, 2)) ]
+sequential = [ detector.detect(im) for im in crops ]
+assert len(set(len(d) for d in sequential)) > 1
+
+for max_workers in [ 1, 3, 12 ]:
+    threaded = detector.detect_many(crops, max_workers=max_workers)
+    assert len(threaded) == len(crops)
+    assert all(same_detections(a, b) for a, b in zip(sequential, threaded))
+
+arrays = detector.detect_many(crops, max_workers=3, as_array=True)
+assert [ sorted(a['id']) for a in arrays ] == [ sorted(d.id for d in s) for s in sequential ]
+print '  ok'
+
+
+print '\n--rois and ids--------------------\n'
+tracked = [ 3, 4, 17, 35 ]
+ids = [ 3, 17, 35, 100 ]
+assert same_detections(detector.detect(frame, ids=ids), [ d for d in full if d.id in ids ])
+assert same_detections(detector.detect(frame, rois=[ (0, 0) + frame.shape[::-1] ]), full)
+
+# The quads found in a sub-image can be a pixel off those found in the
+# full frame (the thresholding tiles move with it), so compare refined
+# detections
+refining = AprilTagDetector(profile='throughput')
+refined = refining.detect(frame)
+by_id = dict((d.id, d) for d in refined)
+predicted = [ by_id[k].p + np.random.uniform(-3, 3, (4, 2)) for k in tracked ]
+
+expected = [ d for d in refined if d.id in ids and d.id in tracked ]
+assert same_detections(refining.detect(frame, rois=predicted, ids=ids), expected, 1e-3)
+assert same_detections(refining.detect(frame, rois=predicted),
+                       [ d for d in refined if d.id in tracked ], 1e-3)
+
+dets = refining.detect(frame, rois=predicted, ids=ids, as_array=True)
+assert sorted(dets['id']) == sorted(d.id for d in expected)
+assert detector.detect(frame, ids=[]) == []
+assert detector.detect(frame, rois=[ (0, 0, 1, 1) ], as_array=True).shape == (0,)
+assert roi_rectangles([ (-5, -5, 10, 10), (5, 5, 20, 20) ], 15, 15) == [ (0, 0, 15, 15) ]
+
+for bad in [ [ -1 ], [ 2, -3 ], [ 1.5 ], [ 'a' ] ]:
+    try:
+        detector.detect(frame, ids=bad)
+        assert False, bad
+    except ValueError:
+        pass
+print '  ok'
+
+
+print '\n--as_array vs namedtuples--------------------\n'
+for kwargs in [ {}, { 'decimate': 2. }, { 'profile': 'throughput' } ]:
+    d = AprilTagDetector(**kwargs)
+    listed = d.detect(frame)
+    dets = d.detect(frame, as_array=True)
+    assert dets.dtype == DETECTION_DTYPE and len(dets) == len(listed)
+    for rec, t in zip(dets, listed):
+        for name in DETECTION_DTYPE.names:
+            assert np.allclose(rec[name], getattr(t, name), rtol=1e-6), name
+    d.close()
+print '  ok'
+
+
+print '\n--detect_multiscale vs single scale--------------------\n'
+# detect_multiscale refines its detections, so compare with refined ones
+single = dict((d.id, d) for d in detector.refine(frame, full))
+pyramid = detector.detect_multiscale(frame)
+assert [ d.id for d in pyramid ] == sorted(single)
+assert corner_rmse(pyramid, corners) < 0.01
+assert max(abs(d.p - single[d.id].p).max() for d in pyramid) < 0.01
+
+dets = detector.detect_multiscale(frame, as_array=True)
+assert list(dets['id']) == [ d.id for d in pyramid ]
+assert np.allclose(dets['p'], [ d.p for d in pyramid ])
+
+big, big_corners = render_family_mosaic('tag36h11', 4, 3000)
+pyramid = detector.detect_multiscale(big)
+assert [ d.id for d in pyramid ] == sorted(big_corners)
+assert corner_rmse(pyramid, big_corners) < 0.01
+print '  ok'
+
+
+print '\n--shared detectors--------------------\n'
+with get_detector() as shared:
+    assert same_detections(shared.detect(frame), full)
+shared.close()
+assert get_detector() is shared
+assert same_detections(shared.detect(frame), full)
+
+clear_detectors()
+try:
+    shared.detect(frame)
+    closed = False
+except Exception:
+    closed = True
+assert closed
+assert get_detector() is not shared
+print '  ok'
@@ -0,0 +1,183 @@
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+
+# Tag coordinates of the corners in `AprilTagDetection.p`
+TAG_CORNERS = np.array([ [-1., -1.], [1., -1.], [1., 1.], [-1., 1.] ])
+
+
+def _sample(im, x, y):
+    """
+    Bilinearly interpolated intensities of `im` at (`x`, `y`). As in the
+    detector, pixel (i, j) covers [i, i+1) x [j, j+1).
+    """
+    coords = np.array([ y.ravel() - .5, x.ravel() - .5 ])
+    v = map_coordinates(im, coords, output=np.float64, order=1, mode='nearest', prefilter=False)
+    return v.reshape(x.shape)
+
+
+def _refine_edges(im, P, search_px, nsamples=16, step_px=0.25):
+    """
+    One pass of edge refinement, vectorized over all tags. This follows
+    `refine_edges` in apriltag.c, but searches `search_px` pixels (one
+    value per tag) on either side of each edge instead of a range tied
+    to the quad decimation.
+
+    `P` is the (N, 4, 2) array of tag corners. Returns the refined
+    corners and a boolean mask of the tags that could be refined.
+    """
+    A = P
+    B = np.roll(P, -1, axis=1)
+    D = B - A
+    length = np.sqrt((D**2).sum(axis=2))
+
+    # outward normal of each edge. The sign depends on the winding of
+    # the corners, which is the same for all edges of a tag.
+    N = np.dstack([ D[:,:,1], -D[:,:,0] ]) / length[:,:,None]
+    winding = np.sign((A[:,:,0]*B[:,:,1] - B[:,:,0]*A[:,:,1]).sum(axis=1))
+    N *= winding[:,None,None]
+
+    # points along each edge, avoiding the corners themselves
+    alpha = (1. + np.arange(nsamples)) / (nsamples + 1)
+    E = A[:,:,None,:] + alpha[None,None,:,None] * D[:,:,None,:]
+
+    # Intensity profiles along the normal through each point, in steps
+    # of no less than `step_px`. Gradients are taken `m` steps (about a
+    # pixel) to either side, from the same profile.
+    nsteps = int(np.clip(np.ceil(search_px.max() / step_px), 2, 16))
+    step = search_px / nsteps
+    m = max(1, int(round(1. / step.min())))
+    j = np.arange(-nsteps-m, nsteps+m+1)
+    offsets = j[None,:] * step[:,None]
+    X = E[:,:,:,None,0] + offsets[:,None,None,:] * N[:,:,None,None,0]
+    Y = E[:,:,:,None,1] + offsets[:,None,None,:] * N[:,:,None,None,1]
+    V = _sample(im, X, Y)
+
+    n = offsets[:,m:-m]
+    g = V[...,2*m:] - V[...,:-2*m]
+
+    # going outward, the black border gives way to the white margin.
+    # Gradients the other way around can only hurt
+    w = np.where(g > 0, g*g, 0.)
+    wsum = w.sum(axis=3)
+    valid = wsum > 0
+    n0 = (w * n[:,None,None,:]).sum(axis=3) / np.where(valid, wsum, 1.)
+    Q = E + n0[...,None] * N[:,:,None,:]
+
+    # weighted line fit through the edge points of each edge
+    mask = valid.astype(np.float)
+    count = mask.sum(axis=2)
+    ok = (count >= 2).all(axis=1)
+    count = np.maximum(count, 1.)
+    Ex = (mask * Q[...,0]).sum(axis=2) / count
+    Ey = (mask * Q[...,1]).sum(axis=2) / count
+    Cxx = (mask * Q[...,0]**2).sum(axis=2) / count - Ex*Ex
+    Cxy = (mask * Q[...,0]*Q[...,1]).sum(axis=2) / count - Ex*Ey
+    Cyy = (mask * Q[...,1]**2).sum(axis=2) / count - Ey*Ey
+    theta = .5 * np.arctan2(-2*Cxy, Cyy - Cxx)
+    nx, ny = np.cos(theta), np.sin(theta)
+
+    # corner i is the intersection of edges i-1 and i
+    Ex0, Ey0, nx0, ny0 = [ np.roll(v, 1, axis=1) for v in (Ex, Ey, nx, ny) ]
+    det = ny0*nx - (-nx0)*(-ny)
+    ok &= (np.abs(det) > 1e-3).all(axis=1)
+    det = np.where(np.abs(det) > 1e-3, det, 1.)
+    L0 = (nx*(Ex - Ex0) + ny*(Ey - Ey0)) / det
+    R = np.dstack([ Ex0 + L0*ny0, Ey0 - L0*nx0 ])
+
+    return np.where(ok[:,None,None], R, P), ok
+
+
+def homographies_from_corners(P, max_cond=1e12):
+    """
+    Homographies that map the tag corners `TAG_CORNERS` to each set
+    of (4, 2) image corners in `P`. Returns an (N, 3, 3) array and a
+    boolean mask of the quads that define a homography. Degenerate
+    quads (e.g. with three collinear corners, or a condition number
+    above `max_cond`) get NaN homographies instead of failing the
+    whole batch.
+    """
+    P = np.asarray(P, dtype=np.float)
+    N = len(P)
+
+    M = np.zeros((N, 8, 8))
+    b = np.zeros((N, 8))
+    for i, (x, y) in enumerate(TAG_CORNERS):
+        u, v = P[:,i,0], P[:,i,1]
+        M[:,2*i,0:3] = x, y, 1.
+        M[:,2*i,6:8] = np.array([ -x*u, -y*u ]).T
+        M[:,2*i+1,3:6] = x, y, 1.
+        M[:,2*i+1,6:8] = np.array([ -x*v, -y*v ]).T
+        b[:,2*i] = u
+        b[:,2*i+1] = v
+
+    ok = np.isfinite(M).all(axis=(1,2))
+    ok[ok] = np.linalg.cond(M[ok]) < max_cond
+
+    h = np.empty((N, 8))
+    h.fill(np.nan)
+    h[ok] = np.linalg.solve(M[ok], b[ok,:,None])[...,0]
+    return np.hstack([ h, np.ones((N, 1)) ]).reshape((N, 3, 3)), ok
+
+
+def refine_corners(im, P0, tag_bits, iterations=3):
+    """
+    Refine the (N, 4, 2) tag corners `P0` against the full resolution
+    image `im`. Each edge is snapped to the strongest nearby black to
+    white transition, searching most of a bit width at first and
+    narrowing the search on each of `iterations` passes.
+
+    `tag_bits` is the width of the tags in bits, black border included
+    (e.g. 8 for tag36h11). Returns the refined corners and a boolean
+    mask of the tags that could be refined; the others are unchanged.
+    """
+    im = np.asarray(im)
+    P0 = np.asarray(P0, dtype=np.float)
+
+    bit_px = np.sqrt(((P0 - np.roll(P0, -1, axis=1))**2).sum(axis=2)).mean(axis=1) / tag_bits
+    search_px = 0.75 * bit_px
+
+    P, ok = P0, np.ones(len(P0), dtype=bool)
+    for _ in xrange(iterations):
+        P, ok_ = _refine_edges(im, P, search_px)
+        ok &= ok_
+        search_px = np.maximum(1., search_px / 4.)
+
+    return np.where(ok[:,None,None], P, P0), ok
+
+
+def refine_detections(im, detections, tag_bits, iterations=3):
+    """
+    Refine corners, homography and center of each detection against the
+    full resolution image `im` (see `refine_corners`). `detections` is
+    either a list of AprilTagDetection or a structured array with the
+    same fields; a new one of the same kind is returned. Detections
+    that cannot be refined, or whose refined corners do not define a
+    homography, are returned unchanged.
+    """
+    if len(detections) == 0:
+        return detections[:]
+
+    if isinstance(detections, np.ndarray):
+        P, ok = refine_corners(im, detections['p'], tag_bits, iterations)
+        H, ok_H = homographies_from_corners(P)
+        ok &= ok_H
+
+        refined = detections.copy()
+        refined['p'][ok] = P[ok]
+        refined['H'][ok] = H[ok]
+        refined['c'][ok] = H[ok,:2,2]
+        return refined
+
+    P0 = np.array([ d.p for d in detections ], dtype=np.float)
+    P, ok = refine_corners(im, P0, tag_bits, iterations)
+    H, ok_H = homographies_from_corners(P)
+    ok &= ok_H
+
+    refined = []
+    for d, p, h, ok_ in zip(detections, P, H, ok):
+        if ok_:
+            d = d._replace(H=h, c=h[:2,2].copy(), p=p)
+        refined.append(d)
+
+    return refined
@@ -210,6 +210,67 @@ def xyzrph_to_matrix(x, y, z, r, p, h):
         [ translate(x, y, z), rotz(h), roty(p), rotx(r) ])
 
 
+def _rph_rotations(r, p, h):
+    """
+    Kx3x3 rotations about x, y and z by each of the angles in the
+    arrays `r`, `p` and `h`, each followed by its derivative
+    """
+    one, zero = np.ones_like(r), np.zeros_like(r)
+    cr, sr = np.cos(r), np.sin(r)
+    cp, sp = np.cos(p), np.sin(p)
+    ch, sh = np.cos(h), np.sin(h)
+
+    stack = lambda rows: np.array(rows).transpose(2, 0, 1)
+
+    Rx  = stack([[  one, zero, zero ], [ zero,   cr,  -sr ], [ zero,   sr,   cr ]])
+    dRx = stack([[ zero, zero, zero ], [ zero,  -sr,  -cr ], [ zero,   cr,  -sr ]])
+    Ry  = stack([[   cp, zero,   sp ], [ zero,  one, zero ], [  -sp, zero,   cp ]])
+    dRy = stack([[  -sp, zero,   cp ], [ zero, zero, zero ], [  -cp, zero,  -sp ]])
+    Rz  = stack([[   ch,  -sh, zero ], [   sh,   ch, zero ], [ zero, zero,  one ]])
+    dRz = stack([[  -sh,  -ch, zero ], [   ch,  -sh, zero ], [ zero, zero, zero ]])
+
+    return Rx, dRx, Ry, dRy, Rz, dRz
+
+
+def xyzrph_to_matrices(xyzrph):
+    """
+    `xyzrph_to_matrix` of each row of the Kx6 array `xyzrph`,
+    as a Kx4x4 array
+    """
+    xyzrph = np.atleast_2d(xyzrph)
+    Rx, _, Ry, _, Rz, _ = _rph_rotations(*xyzrph[:,3:].T)
+
+    E = np.zeros((len(xyzrph), 4, 4))
+    E[:,:3,:3] = np.matmul(Rz, np.matmul(Ry, Rx))
+    E[:,:3,3] = xyzrph[:,:3]
+    E[:,3,3] = 1.
+    return E
+
+
+def xyzrph_to_matrices_and_derivatives(xyzrph):
+    """
+    `xyzrph_to_matrices` together with the derivatives of each
+    matrix with respect to each of (x, y, z, r, p, h), as a
+    Kx6x4x4 array
+    """
+    xyzrph = np.atleast_2d(xyzrph)
+    Rx, dRx, Ry, dRy, Rz, dRz = _rph_rotations(*xyzrph[:,3:].T)
+    RzRy = np.matmul(Rz, Ry)
+
+    E = np.zeros((len(xyzrph), 4, 4))
+    E[:,:3,:3] = np.matmul(RzRy, Rx)
+    E[:,:3,3] = xyzrph[:,:3]
+    E[:,3,3] = 1.
+
+    dE = np.zeros((len(xyzrph), 6, 4, 4))
+    dE[:,0,0,3] = dE[:,1,1,3] = dE[:,2,2,3] = 1.
+    dE[:,3,:3,:3] = np.matmul(RzRy, dRx)
+    dE[:,4,:3,:3] = np.matmul(Rz, np.matmul(dRy, Rx))
+    dE[:,5,:3,:3] = np.matmul(dRz, np.matmul(Ry, Rx))
+
+    return E, dE
+
+
 def matrix_to_xyzrph(M):
     tx = M[0,3]
     ty = M[1,3]
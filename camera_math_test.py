@@ -0,0 +1,29 @@
+import numpy as np
+from camera_math import xyzrph_to_matrix, xyzrph_to_matrices
+from camera_math import xyzrph_to_matrices_and_derivatives
+
+
+np.set_printoptions(precision=4, suppress=True)
+np.random.seed(0)
+
+xyzrph = np.c_[ np.random.uniform(-1, 1, (10, 3)), np.random.uniform(-np.pi, np.pi, (10, 3)) ]
+
+print '\n--batched xyzrph--------------------\n'
+E = xyzrph_to_matrices(xyzrph)
+assert E.shape == (10, 4, 4)
+assert np.allclose(E, [ xyzrph_to_matrix(*v) for v in xyzrph ])
+assert np.allclose(xyzrph_to_matrices(xyzrph[0]), xyzrph_to_matrix(*xyzrph[0]))
+print '  ok'
+
+print '\n--xyzrph derivatives--------------------\n'
+E, dE = xyzrph_to_matrices_and_derivatives(xyzrph)
+assert np.allclose(E, xyzrph_to_matrices(xyzrph))
+
+eps = 1e-6
+for k in xrange(6):
+    hi, lo = xyzrph.copy(), xyzrph.copy()
+    hi[:,k] += eps
+    lo[:,k] -= eps
+    fd = (xyzrph_to_matrices(hi) - xyzrph_to_matrices(lo)) / (2*eps)
+    assert np.allclose(dE[:,k], fd, atol=1e-8)
+print '  ok'
@@ -10,32 +10,16 @@ def get_tag_detections(im, cache_tag):
     #
     # Because of a bug in the tag detector, it doesn't seem
     # to detect tags larger than a certain size. To work-around
-    # this limitation, we detect tags on two different image
-    # scales and use the one with more detections
+    # this limitation, we detect tags on a pyramid of coarser
+    # image scales and re-localize them at full resolution
     #
     assert len(im.shape) == 2
 
-    from skimage.transform import rescale as imrescale
-    im4 = imrescale(im, 1./4)
-
     from skimage.util import img_as_ubyte
     im = img_as_ubyte(im)
-    im4 = img_as_ubyte(im4)
-
-    from apriltag import AprilTagDetector, AprilTagDetection
-    detections1 = AprilTagDetector().detect(im)
-    detections4 = AprilTagDetector().detect(im4)
-    for d in detections4:
-        d.c[0] *= 4.
-        d.c[1] *= 4.
-
-    # note that everything other than the tag center is wrong
-    # in detections4
-
-    if len(detections4) > len(detections1):
-        return detections4
-    else:
-        return detections1
+
+    from apriltag import get_detector
+    return get_detector(profile='throughput').detect_multiscale(im)
 
 
 HomographyInfo = namedtuple('HomographyInfo',
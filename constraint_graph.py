@@ -0,0 +1,377 @@
+"""
+Graphs of camera intrinsics and extrinsics nodes linked by homography
+constraints, shared by the refine_homographies* scripts
+"""
+import numpy as np
+from collections import OrderedDict
+from scipy.sparse import coo_matrix
+
+from camera_math import xyzrph_to_matrix, intrinsics_to_matrix
+from camera_math import xyzrph_to_matrices, xyzrph_to_matrices_and_derivatives
+
+
+
+def pseudo_huber_loss(abserr, delta=1.):
+    return np.where(abserr <= delta, abserr**2/2., delta*(abserr - delta/2.))
+
+
+def _state_field(k):
+    """ Property for the `k`-th value of a node in its state vector """
+    def fget(self):
+        return self._state[self._offset + k]
+    def fset(self, value):
+        self._state[self._offset + k] = value
+    return property(fget, fset)
+
+
+#-------------------------------------
+class IntrinsicsNode(object):
+#-------------------------------------
+    """
+    View of the values (fx, fy, cx, cy) at `_offset` in the state
+    vector `_state`. The vector is the node's own until the node is
+    bound into the state of a `ConstraintGraph`.
+    """
+    __slots__ = ('_state', '_offset', 'tag')
+    size = 4
+
+    def __init__(self, fx, fy, cx, cy, tag):
+        self._state = np.array([ fx, fy, cx, cy ], dtype=np.float64)
+        self._offset = 0
+        self.tag = tag # convenient identification
+
+    fx = _state_field(0)
+    fy = _state_field(1)
+    cx = _state_field(2)
+    cy = _state_field(3)
+
+    @property
+    def value(self):
+        return self._state[self._offset:self._offset+self.size]
+
+    def to_tuple(self):
+        return tuple(self.value)
+
+    def set_value(self, *tupl):
+        self.value[:] = tupl
+
+    def __repr__(self):
+        return repr(self.to_tuple())
+
+    def to_matrix(self):
+        return intrinsics_to_matrix(*self.to_tuple())
+
+
+#-------------------------------------
+class ExtrinsicsNode(object):
+#-------------------------------------
+    """
+    View of the values (x, y, z, r, p, h) at `_offset` in the state
+    vector `_state`. The vector is the node's own until the node is
+    bound into the state of a `ConstraintGraph`.
+    """
+    __slots__ = ('_state', '_offset', 'tag')
+    size = 6
+
+    def __init__(self, x, y, z, r, p, h, tag):
+        self._state = np.array([ x, y, z, r, p, h ], dtype=np.float64)
+        self._offset = 0
+        self.tag = tag # convenient identification
+
+    x = _state_field(0)
+    y = _state_field(1)
+    z = _state_field(2)
+    r = _state_field(3)
+    p = _state_field(4)
+    h = _state_field(5)
+
+    @property
+    def value(self):
+        return self._state[self._offset:self._offset+self.size]
+
+    def to_tuple(self):
+        return tuple(self.value)
+
+    def set_value(self, *tupl):
+        self.value[:] = tupl
+
+    def __repr__(self):
+        return repr(self.to_tuple())
+
+    def to_matrix(self):
+        return xyzrph_to_matrix(*self.to_tuple())
+
+
+#--------------------------------------
+class HomographyConstraint(object):
+#--------------------------------------
+    """
+    Links the world to image correspondences of a homography model
+    (`hmodel.hinfo` is a `WorldImageHomographyInfo`) to the intrinsics
+    and extrinsics nodes of its image. The `weights` of the points are
+    those of the local homography at the center, for the weighted
+    squared errors of `WeightedPackedHomographyConstraints`.
+    """
+    def __init__(self, hmodel, inode, enode):
+        H_wi, c_w, _ = hmodel.hinfo
+
+        # 3-D homogeneous form with z=0
+        p_src = [ c.source for c in H_wi._corrs ]
+        N = len(p_src)
+        p_src = np.hstack([ p_src, np.zeros((N,1)), np.ones((N,1)) ])
+
+        self.p_src = p_src.T
+        self.p_tgt = np.array([ c.target for c in H_wi._corrs ]).T
+        self.weights = H_wi.get_correspondence_weights(c_w)
+        self.inode = inode
+        self.enode = enode
+
+    def sq_unweighted_reprojection_errors(self):
+        """
+        compute the geometric reprojection error of the world
+        points `self.p_w` through the homography described
+        the composition of intrinsics and extrinsics.
+        """
+        K = self.inode.to_matrix()
+        E = self.enode.to_matrix()
+        H = K.dot(E)
+
+        p_mapped = H.dot(self.p_src)[:3,:]
+
+        # normalize homogeneous coordinates
+        p_mapped = p_mapped[:2,:] / p_mapped[2,:]
+
+        return ((p_mapped - self.p_tgt)**2)
+
+
+#--------------------------------------
+class PackedHomographyConstraints(object):
+#--------------------------------------
+    """
+    The `HomographyConstraint`s of a graph packed into flat arrays,
+    so the errors of all of them come from a few array operations
+
+    Members:
+    --------
+              `p_src`: 3xP world points (x, y, 1) of all constraints
+              `p_tgt`: 2xP image points of all constraints
+        `inode_index`: intrinsics node of each point, by position in the graph
+        `enode_index`: extrinsics node of each point, by position in the graph
+              `links`: (inode, enode) positions of each constraint
+             `bounds`: first point of each constraint, followed by P
+    """
+    def __init__(self, constraints, inodes, enodes):
+        iindex = dict( (id(n), k) for k, n in enumerate(inodes) )
+        eindex = dict( (id(n), k) for k, n in enumerate(enodes) )
+        links = [ (iindex[id(c.inode)], eindex[id(c.enode)]) for c in constraints ]
+        sizes = [ c.p_tgt.shape[1] for c in constraints ]
+
+        self.p_src = np.hstack([ c.p_src[[0,1,3]] for c in constraints ])
+        self.p_tgt = np.hstack([ c.p_tgt for c in constraints ])
+        self.links = np.reshape(links, (-1, 2))
+        self.inode_index = np.repeat(self.links[:,0], sizes)
+        self.enode_index = np.repeat(self.links[:,1], sizes)
+        self.bounds = np.r_[ 0, np.cumsum(sizes) ]
+        self.num_inodes = len(inodes)
+        self.num_enodes = len(enodes)
+
+
+    def _split(self, state):
+        """ intrinsics (Nx4) and extrinsics (Mx6) in the graph `state` """
+        n = 4*self.num_inodes
+        return np.reshape(state[:n], (-1, 4)), np.reshape(state[n:], (-1, 6))
+
+
+    def reprojection_errors(self, state):
+        """
+        Signed reprojection errors (2xP) of all points at the graph `state`
+        """
+        istate, estate = self._split(state)
+
+        # the world points have z=0, so the third column drops out
+        E = xyzrph_to_matrices(estate)[:,:3,[0,1,3]]
+        X, Y, Z = np.einsum('pij,jp->ip', E[self.enode_index], self.p_src)
+        fx, fy, cx, cy = istate[self.inode_index].T
+
+        return np.vstack(( fx*X/Z + cx - self.p_tgt[0], fy*Y/Z + cy - self.p_tgt[1] ))
+
+
+    def reprojection_errors_and_jacobians(self, state):
+        """
+        `reprojection_errors` and their jacobians with respect to the
+        intrinsics (fx, fy, cx, cy) and the extrinsics (x, y, z, r, p, h)
+        of each point, as 2xPx4 and 2xPx6 arrays
+        """
+        istate, estate = self._split(state)
+
+        E, dE = xyzrph_to_matrices_and_derivatives(estate)
+        E, dE = E[:,:3,[0,1,3]], dE[:,:,:3,[0,1,3]]
+        X, Y, Z = np.einsum('pij,jp->ip', E[self.enode_index], self.p_src)
+        dX, dY, dZ = np.einsum('pkij,jp->ipk', dE[self.enode_index], self.p_src)
+        fx, fy, cx, cy = istate[self.inode_index].T
+        x, y = X/Z, Y/Z
+
+        err = np.vstack(( fx*x + cx - self.p_tgt[0], fy*y + cy - self.p_tgt[1] ))
+
+        Ji = np.zeros((2, len(Z), 4))
+        Ji[0,:,0] = x
+        Ji[0,:,2] = 1.
+        Ji[1,:,1] = y
+        Ji[1,:,3] = 1.
+
+        Je = np.array(( (fx/Z)[:,np.newaxis] * (dX - x[:,np.newaxis]*dZ),
+                        (fy/Z)[:,np.newaxis] * (dY - y[:,np.newaxis]*dZ) ))
+
+        return err, Ji, Je
+
+
+    def sq_errors(self, state):
+        """ `HomographyConstraint.sq_errors` of all points, all u's then all v's """
+        return pseudo_huber_loss(np.abs(self.reprojection_errors(state)).ravel(), 1.)
+
+
+    def sq_errors_and_jacobians(self, state):
+        """
+        `sq_errors` and their jacobians through the derivative of the
+        pseudo-huber loss, as 2xPx4 and 2xPx6 arrays
+        """
+        err, Ji, Je = self.reprojection_errors_and_jacobians(state)
+        psi = np.clip(err, -1., 1.)[:,:,np.newaxis]
+        return pseudo_huber_loss(np.abs(err).ravel(), 1.), psi*Ji, psi*Je
+
+
+#--------------------------------------
+class WeightedPackedHomographyConstraints(PackedHomographyConstraints):
+#--------------------------------------
+    """
+    `PackedHomographyConstraints` with the weighted squared errors of
+    constraints that carry per-point `weights`, instead of the
+    pseudo-huber loss
+    """
+    def __init__(self, constraints, inodes, enodes):
+        super(WeightedPackedHomographyConstraints, self).__init__(constraints, inodes, enodes)
+        self.weights = np.hstack([ c.weights for c in constraints ])
+
+
+    def sq_errors(self, state):
+        """ `HomographyConstraint.sq_errors` of all points, all u's then all v's """
+        return (self.reprojection_errors(state)**2 * self.weights).ravel()
+
+
+    def sq_errors_and_jacobians(self, state):
+        """
+        `sq_errors` and their jacobians, as 2xPx4 and 2xPx6 arrays
+        """
+        err, Ji, Je = self.reprojection_errors_and_jacobians(state)
+        dsq = (2. * self.weights * err)[:,:,np.newaxis]
+        return (err**2 * self.weights).ravel(), dsq*Ji, dsq*Je
+
+
+#--------------------------------------
+class ConstraintGraph(object):
+#--------------------------------------
+    # how the errors of the constraints are evaluated
+    packed_class = PackedHomographyConstraints
+
+    def __init__(self):
+        self.inodes = OrderedDict()
+        self.enodes = OrderedDict()
+        self.constraints = list()
+        self._packed = None
+        self._state = np.empty(0)
+        self._bound_key = None
+
+
+    @property
+    def packed(self):
+        """
+        `packed_class` of the constraints of the graph, packed again
+        whenever nodes or constraints have been added, removed or
+        replaced. The key holds the objects themselves, so it can't
+        match a different graph by a reused id.
+        """
+        key = (tuple(self.constraints), tuple(self.inodes.values()), tuple(self.enodes.values()))
+        if self._packed is None or self._packed[0] != key:
+            packed = self.packed_class(self.constraints, key[1], key[2])
+            self._packed = key, packed
+        return self._packed[1]
+
+
+    def constraint_errors(self):
+        return self.packed.sq_errors(self.state)
+
+
+    def constraint_jacobian(self):
+        """
+        Sparse jacobian of `constraint_errors` with respect to `state`.
+        Each row only touches the 4 columns of its intrinsics node and
+        the 6 columns of its extrinsics node.
+        """
+        packed = self.packed
+        _, Ji, Je = packed.sq_errors_and_jacobians(self.state)
+
+        icols = 4*packed.inode_index[:,np.newaxis] + np.arange(4)
+        ecols = 4*packed.num_inodes + 6*packed.enode_index[:,np.newaxis] + np.arange(6)
+        cols = np.tile(np.hstack(( icols, ecols )), (2, 1))
+        rows = np.repeat(np.arange(len(cols)), 10)
+        vals = np.concatenate(( Ji, Je ), axis=2)
+
+        shape = (len(cols), 4*packed.num_inodes + 6*packed.num_enodes)
+        J = coo_matrix((vals.ravel(), (rows, cols.ravel())), shape=shape)
+        return J.tocsr()
+
+
+    def sq_pixel_errors(self):
+        return self.packed.reprojection_errors(self.state)**2
+
+
+    def _bind_nodes(self):
+        """
+        Copy the node values into one state vector owned by the graph,
+        and point the nodes at their place in it. Done again whenever
+        nodes have been added, removed or replaced, which is told by
+        the node objects themselves rather than by their number.
+        """
+        key = (tuple(self.inodes.values()), tuple(self.enodes.values()))
+        if self._bound_key == key:
+            return
+
+        nodes = key[0] + key[1]
+        state = np.hstack([ n.value for n in nodes ] + [ np.empty(0) ])
+        offset = 0
+        for n in nodes:
+            n._state, n._offset = state, offset
+            offset += n.size
+
+        self._state = state
+        self._bound_key = key
+
+
+    def _pack_into_vector(self):
+        """ copy of the node states, all intrinsics then all extrinsics """
+        self._bind_nodes()
+        return self._state.copy()
+
+
+    def _unpack_from_vector(self, v):
+        """ Set node values from the vector `v` """
+        self._bind_nodes()
+        self._state[:] = v
+
+
+    state = property(_pack_into_vector, _unpack_from_vector)
+
+
+    def _pack_intrinsics_into_vector(self):
+        """ copy of the intrinsic node states """
+        self._bind_nodes()
+        return self._state[:4*len(self.inodes)].copy()
+
+
+    def _unpack_intrinsics_from_vector(self, v):
+        """ Set intrinsic node values from the vector `v` """
+        self._bind_nodes()
+        self._state[:4*len(self.inodes)] = v
+
+
+    istate = property(_pack_intrinsics_into_vector, _unpack_intrinsics_from_vector)
@@ -0,0 +1,119 @@
+import numpy as np
+from camera_math import intrinsics_to_matrix, xyzrph_to_matrix
+from constraint_graph import IntrinsicsNode, ExtrinsicsNode, ConstraintGraph
+from constraint_graph import PackedHomographyConstraints, WeightedPackedHomographyConstraints
+
+
+np.set_printoptions(precision=4, suppress=True)
+np.random.seed(0)
+
+
+class PointsConstraint(object):
+    """ The world points `p_w` seen through `inode` and `enode`, plus `offset` pixels """
+    def __init__(self, p_w, inode, enode, offset=0.):
+        N = len(p_w)
+        self.p_src = np.hstack([ p_w, np.zeros((N,1)), np.ones((N,1)) ]).T
+        p_i = intrinsics_to_matrix(*inode.to_tuple()).dot(
+                xyzrph_to_matrix(*enode.to_tuple())).dot(self.p_src)
+        self.p_tgt = p_i[:2] / p_i[2] + offset
+        self.weights = np.random.uniform(0.5, 2., N)
+        self.inode = inode
+        self.enode = enode
+
+
+def create_graph():
+    graph = ConstraintGraph()
+    inode = IntrinsicsNode(2500., 2500., 2000., 1500., tag='zoom0')
+    graph.inodes[inode.tag] = inode
+    for k in xrange(3):
+        enode = ExtrinsicsNode(0.01*k, 0., 1., np.pi, 0.1*k, 0., tag='pose%d' % k)
+        graph.enodes[enode.tag] = enode
+        graph.constraints.append(PointsConstraint(np.random.uniform(-.1, .1, (20, 2)), inode, enode))
+    return graph
+
+
+print '\n--constraints replaced in place--------------------\n'
+graph = create_graph()
+assert np.allclose(graph.sq_pixel_errors(), 0.)
+
+c = graph.constraints[1]
+graph.constraints[1] = PointsConstraint(c.p_src[:2].T, c.inode, c.enode, offset=1.)
+assert np.allclose(graph.sq_pixel_errors()[:,20:40], 1.)
+assert np.allclose(graph.constraint_errors().reshape((2, -1))[:,20:40], 0.5)
+
+graph.constraints = list(graph.constraints[:2]) + [ graph.constraints[1] ]
+assert np.allclose(graph.sq_pixel_errors()[:,40:], 1.)
+print '  ok'
+
+print '\n--nodes replaced--------------------\n'
+graph = create_graph()
+graph.state = graph.state
+assert np.allclose(graph.istate, [ 2500., 2500., 2000., 1500. ])
+
+old_inode = graph.inodes['zoom0']
+inode = IntrinsicsNode(2600., 2601., 2002., 1503., tag='zoom0')
+graph.inodes['zoom0'] = inode
+for c in graph.constraints:
+    c.inode = inode
+assert np.allclose(graph.istate, [ 2600., 2601., 2002., 1503. ])
+
+graph.istate = [ 2700., 2701., 2003., 1504. ]
+assert inode.fx == 2700. and inode.cy == 1504.
+assert old_inode.fx == 2500.
+
+enode = ExtrinsicsNode(1., 2., 3., 0., 0., 0., tag='pose1')
+graph.enodes['pose1'] = enode
+assert np.allclose(graph.state[4+6:4+12], [ 1., 2., 3., 0., 0., 0. ])
+graph.state = np.arange(22.)
+assert enode.to_tuple() == (10., 11., 12., 13., 14., 15.)
+print '  ok'
+
+print '\n--jacobians--------------------\n'
+def create_mixed_graph(packed_class):
+    """ 2 intrinsics and 3 extrinsics nodes, linked in several ways """
+    graph = ConstraintGraph()
+    graph.packed_class = packed_class
+    for k in xrange(2):
+        inode = IntrinsicsNode(2500.+100*k, 2510.+100*k, 2000., 1500., tag='zoom%d' % k)
+        graph.inodes[inode.tag] = inode
+    for k in xrange(3):
+        enode = ExtrinsicsNode(0.01*k, -0.02*k, 1.+0.1*k, np.pi+0.05*k, 0.1*k, 0.02, tag='pose%d' % k)
+        graph.enodes[enode.tag] = enode
+
+    inodes, enodes = graph.inodes.values(), graph.enodes.values()
+    for i, e in [ (1, 0), (0, 2), (1, 1), (0, 0), (1, 2) ]:
+        # pixel noise, so that errors fall on both sides of the
+        # pseudo-huber threshold of 1
+        p_w = np.random.uniform(-.1, .1, (20, 2))
+        graph.constraints.append(PointsConstraint(p_w, inodes[i], enodes[e], np.random.randn(2, 20)))
+    return graph
+
+
+for packed_class in [ PackedHomographyConstraints, WeightedPackedHomographyConstraints ]:
+    graph = create_mixed_graph(packed_class)
+    err = graph.sq_pixel_errors()
+    assert (err < 0.9).any() and (err > 1.1).any()
+
+    state = graph.state
+    J = graph.constraint_jacobian().toarray()
+    assert J.shape == (len(graph.constraint_errors()), len(state))
+
+    fd = np.empty_like(J)
+    for k in xrange(len(state)):
+        eps = 1e-6 * max(1., abs(state[k]))
+        hi, lo = state.copy(), state.copy()
+        hi[k] += eps
+        lo[k] -= eps
+        graph.state = hi
+        e_hi = graph.constraint_errors()
+        graph.state = lo
+        e_lo = graph.constraint_errors()
+        fd[:,k] = (e_hi - e_lo) / (2*eps)
+    graph.state = state
+
+    print '  %s: max error %.2g (max %.2g)' % (packed_class.__name__, abs(J - fd).max(), abs(J).max())
+    assert np.allclose(J, fd, rtol=1e-5, atol=1e-8 * abs(J).max())
+
+    # each row only depends on the nodes of its constraint
+    assert ((J != 0) <= (fd != 0)).all()
+print '  ok'
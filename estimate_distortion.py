@@ -4,13 +4,13 @@ import numpy as np
 from math import sqrt
 from skimage.io import imread
 from skimage.color import rgb2gray
-from scipy.optimize import minimize
-from sklearn.cross_validation import LeaveOneOut
 
-from apriltag import AprilTagDetector
+from apriltag import get_detector
 from tag36h11_mosaic import TagMosaic
-from projective_math import WeightedLocalHomography, SqExpWeightingFunction
-from gp import GaussianProcess, sqexp2D_covariancef
+from projective_math import WeightedLocalHomography, SqExpWeightingFunction, HomographyField
+from projective_math import LocalHomographyLOOCV
+from gp import GaussianProcess, MultiOutputGaussianProcess, sqexp2D_covariancef
+from gp import set_num_threads
 
 
 
@@ -23,35 +23,10 @@ def create_local_homography_object(bandwidth, magnitude, lambda_):
     return H
 
 
-def local_homography_error(theta, t_src, t_tgt, v_src, v_tgt):
-    """
-    This is the objective function used for optimizing parameters of
-    the `SqExpWeightingFunction` used for local homography fitting
-
-    Parameters:
-    -----------
-       `theta` = [ `bandwidth`, `magnitude`, `lambda_` ]:
-            parameters of the `SqExpWeightingFunction`
-
-    Arguments:
-    -----------
-        `t_src`: list of training source points
-        `t_tgt`: list of training target points
-        `v_src`: list of validation source points
-        `v_tgt`: list of validation target points
-    """
-    H = create_local_homography_object(*theta)
-    for s, t in zip(t_src, t_tgt):
-        H.add_correspondence(s, t)
-
-    v_mapped = np.array([ H.map(s)[:2] for s in v_src ])
-    return ((v_mapped - v_tgt)**2).sum(axis=1).mean()
-
-
 #--------------------------------------
 class GPModel(object):
 #--------------------------------------
-    def __init__(self, points_i, values):
+    def __init__(self, points_i, values, joint=True):
         assert len(points_i) == len(values)
 
         X = points_i
@@ -61,30 +36,45 @@ class GPModel(object):
         V = values - np.tile(meanV, (len(values), 1))
 
         self._meanV = meanV
-        self._gp_x = GPModel._fit_gp(X, S, V[:,0])
-        self._gp_y = GPModel._fit_gp(X, S, V[:,1])
-
+        if joint:
+            # one set of length-scales for both components
+            self._gp, = MultiOutputGaussianProcess.fit_restarts([
+                (X, V, sqexp2D_covariancef, GPModel._initial_thetas(S, V)) ],
+                processes=GPModel.processes, prune_after=GPModel.prune_after)
+        else:
+            self._gp_x, self._gp_y = GaussianProcess.fit_restarts([
+                (X, V[:,0], sqexp2D_covariancef, GPModel._initial_thetas(S, V[:,0])),
+                (X, V[:,1], sqexp2D_covariancef, GPModel._initial_thetas(S, V[:,1])) ],
+                processes=GPModel.processes, prune_after=GPModel.prune_after)
+
+
+    # Run all restarts for this many iterations, then only those close
+    # to the best one to the end (None to run all of them to the end)
+    prune_after = None
+
+    # Worker processes for the restarts (None: one per cpu). A pool only
+    # pays off when the fits take longer than starting it, so the default
+    # is to fit in this process
+    processes = 1
 
     @staticmethod
-    def _fit_gp(X, covX, t):
+    def _initial_thetas(covX, t):
         xx, xy, yy = covX[0,0], covX[0,1], covX[1,1]
 
         # Perform hyper-parameter optimization with different
         # initial points and choose the GP with best model evidence
-        theta0 = np.array(( t.std(), sqrt(xx), sqrt(yy), xy, 10. ))
-        best_gp = GaussianProcess.fit(X, t, sqexp2D_covariancef, theta0)
-
+        theta0s = [ np.array(( t.std(), sqrt(xx), sqrt(yy), xy, 10. )) ]
         for tau in xrange(50, 800, 100):
-            theta0 = np.array(( t.std(), tau, tau, 0, 10. ))
-            gp = GaussianProcess.fit(X, t, sqexp2D_covariancef, theta0)
-            if gp.model_evidence() > best_gp.model_evidence():
-                best_gp = gp
+            theta0s.append(np.array(( t.std(), tau, tau, 0, 10. )))
 
-        return best_gp
+        return theta0s
 
 
     def predict(self, X):
-        V = np.vstack([ self._gp_x.predict(X), self._gp_y.predict(X) ]).T
+        if getattr(self, '_gp', None) is not None:
+            V = self._gp.predict(X)
+        else:
+            V = np.vstack([ self._gp_x.predict(X), self._gp_y.predict(X) ]).T
         return V + np.tile(self._meanV, (len(X), 1))
 
 
@@ -105,7 +95,7 @@ def process(filename):
     im = (im * 255.).astype(np.uint8)
 
     tag_mosaic = TagMosaic(0.0254)
-    detections = AprilTagDetector().detect(im)
+    detections = get_detector(profile='throughput').detect(im)
     print '  %d tags detected.' % len(detections)
 
     #
@@ -131,18 +121,8 @@ def process(filename):
     det_i9 = det_i[:9]
     det_w9 = det_w[:9]
 
-    def local_homography_loocv_error(theta, args):
-        src, tgt = args
-        errs = [ local_homography_error(theta, src[t_ix], tgt[t_ix], src[v_ix], tgt[v_ix])
-                    for t_ix, v_ix in LeaveOneOut(len(src)) ]
-        return np.mean(errs)
-
     def learn_homography_i2w():
-        result = minimize( local_homography_loocv_error,
-                    x0=[ 50, 1, 1e-3 ],
-                    args=[ det_i9, det_w9 ],
-                    method='Powell',
-                    options={'ftol': 1e-3} )
+        result = LocalHomographyLOOCV(det_i9, det_w9).fit([ 50, 1, 1e-3 ])
 
         print '\nHomography: i->w'
         print '------------------'
@@ -158,11 +138,7 @@ def process(filename):
         return H
 
     def learn_homography_w2i():
-        result = minimize( local_homography_loocv_error,
-                    x0=[ 0.0254, 1, 1e-3 ],
-                    method='Powell',
-                    args=[ det_w9, det_i9 ],
-                    options={'ftol': 1e-3} )
+        result = LocalHomographyLOOCV(det_w9, det_i9).fit([ 0.0254, 1, 1e-3 ])
 
         print '\nHomography: w->i'
         print '------------------'
@@ -224,16 +200,12 @@ def process(filename):
 
     print '\nGP Hyper-parameters'
     print '---------------------'
-    print '  x: ', model._gp_x._covf.theta
-    print '        log-likelihood: %.4f' % model._gp_x.model_evidence()
-    print '  y: ', model._gp_y._covf.theta
-    print '        log-likelihood: %.4f' % model._gp_y.model_evidence()
+    print '  x, y: ', model._gp._covf.theta
+    print '  scales:', model._gp.scales()
+    print '        log-likelihood: %.4f' % model._gp.model_evidence()
     print ''
     print '  Optimization detail:'
-    print '  [ x ]'
-    print '  ' + str(model._gp_x.fit_result).replace('\n', '\n      ')
-    print '  [ y ]'
-    print '  ' + str(model._gp_y.fit_result).replace('\n', '\n      ')
+    print '  ' + str(model._gp.fit_result).replace('\n', '\n      ')
 
     #
     # Visualization
@@ -271,18 +243,23 @@ def process(filename):
             row_groups[row] += [ d.id ]
             col_groups[col] += [ d.id ]
 
+        # rows and columns of the target, mapped through the local
+        # homographies interpolated to within a hundredth of a pixel
+        bounds = np.r_[ det_w.min(axis=0), det_w.max(axis=0) ]
+        H_field = HomographyField(H_wi, bounds, tolerance=0.01)
+
         for k, v in row_groups.iteritems():
             a = tag_mosaic.get_position_meters(np.min(v))
             b = tag_mosaic.get_position_meters(np.max(v))
             x_coords = np.linspace(a[0], b[0], 100)
-            points = np.array([ H_wi.map([x, a[1]]) for x in x_coords ])
+            points = H_field.map_many([ [x, a[1]] for x in x_coords ])
             plt.plot(points[:,0], points[:,1], '-',color='#CF4457', linewidth=2)
 
         for k, v in col_groups.iteritems():
             a = tag_mosaic.get_position_meters(np.min(v))
             b = tag_mosaic.get_position_meters(np.max(v))
             y_coords = np.linspace(a[1], b[1], 100)
-            points = np.array([ H_wi.map([a[0], y]) for y in y_coords ])
+            points = H_field.map_many([ [a[0], y] for y in y_coords ])
             plt.plot(points[:,0], points[:,1], '-',color='#CF4457', linewidth=2)
 
         plt.plot(det_i[:,0], det_i[:,1], 'kx')
@@ -325,14 +302,31 @@ def process(filename):
 
 
 def main():
+    """
+    usage: estimate_distortion.py [-j N] [-t N] image ...
+
+    -j N  fit the GP restarts on N worker processes (0: one per cpu)
+    -t N  compute the gram matrices on N threads (each worker uses one)
+    """
     import sys
 
     np.set_printoptions(precision=4, suppress=True)
 
-    if len(sys.argv)==1:
+    args = sys.argv[1:]
+    while args and args[0].startswith('-'):
+        opt = args.pop(0)
+        if opt == '-j' and args:
+            GPModel.processes = int(args.pop(0)) or None
+        elif opt == '-t' and args:
+            set_num_threads(int(args.pop(0)))
+        else:
+            print main.__doc__
+            sys.exit(2)
+
+    if len(args)==0:
         imfiles = ["/var/tmp/capture/070.png"]
     else:
-        imfiles = sys.argv[1:]
+        imfiles = args
 
     for filename in imfiles:
         process(filename)
@@ -2,7 +2,7 @@
 
 FOLDER=$1
 
-parallel -X ./homography_at_center.py ::: $FOLDER/pose?/*.png
+./homography_at_center.py "$FOLDER/pose?/*.png"
 echo ''
 echo ''
 ./refine_homographies.py $FOLDER pose0
@@ -1,6 +1,9 @@
 import numpy as np
-from numpy.linalg import solve, slogdet
+from multiprocessing import Pool, cpu_count
+from numpy.linalg import solve, slogdet, inv, LinAlgError
 from scipy import optimize
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from scipy.cluster.vq import kmeans2
 
 import pyximport; pyximport.install()
 from gram_matrix import *
@@ -16,7 +19,9 @@ class GaussianProcess(object):
         self._train_t = train_t
         self._covf = covf
         self._C = None
+        self._L = None
         self._Cinvt = None
+        self._evidence = None
         self.fit_result = None
 
 
@@ -24,12 +29,66 @@ class GaussianProcess(object):
         if self._C is not None:
             return
 
-        self._C = self._covf.compute_gram_matrix(self._train_x)
-        self._Cinvt = solve(self._C, self._train_t)
+        # only the lower triangle, unless the Cholesky factorization fails
+        self._C = self._covf.compute_gram_matrix(self._train_x, lower_only=True)
+        self._Cinvt = self._solve(self._train_t)
+
+
+    def _cholesky(self):
+        """ Lower Cholesky factor of the Gram matrix, computed once.
+        False if the Gram matrix is not positive definite """
+        if getattr(self, '_L', None) is None:
+            try:
+                self._L = cholesky(self._C, lower=True, check_finite=False)
+            except LinAlgError:
+                self._L = False
+                self._C = np.tril(self._C) + np.tril(self._C, -1).T
+        return self._L
+
+
+    def _solve(self, b):
+        """ C^-1 * b, for the Gram matrix C """
+        L = self._cholesky()
+        if L is False:
+            return solve(self._C, b)
+        return cho_solve((L, True), b, check_finite=False)
+
+
+    def predict(self, query, cov=False, var=False, chunk_size=4096):
+        """
+        Predictive mean at each of the M points in `query`. With `cov`,
+        also returns the (M, M) predictive covariance; with `var`, only
+        its diagonal. The mean and variances are computed `chunk_size`
+        points at a time, so memory stays O(N*chunk_size).
+        """
+        query = np.asarray(query, dtype=float)
+        if cov:
+            return self.__predict(query)
+
+        if not hasattr(self._covf, 'compute_cross_matrix'):
+            assert not var
+            return self.__predict_mean(query)
 
+        self.ensure_gram_matrix()
+        L = self._cholesky() if var else None
+
+        M = len(query)
+        y_mean = np.empty((M,) + self._Cinvt.shape[1:])
+        y_var = np.empty(M) if var else None
+        for i in xrange(0, M, chunk_size):
+            Kt = self._covf.compute_cross_matrix(query[i:i+chunk_size], self._train_x)
+            y_mean[i:i+chunk_size] = Kt.dot(self._Cinvt)
+
+            if var:
+                if L is False:
+                    KtCinvK = (Kt * solve(self._C, Kt.T).T).sum(axis=1)
+                else:
+                    V = solve_triangular(L, Kt.T, lower=True, check_finite=False)
+                    KtCinvK = (V*V).sum(axis=0)
+                diag = self._covf.compute_gram_diagonal(query[i:i+chunk_size])
+                y_var[i:i+chunk_size] = diag - KtCinvK
 
-    def predict(self, query, cov=False):
-        return self.__predict(query) if cov else self.__predict_mean(query)
+        return (y_mean, y_var) if var else y_mean
 
 
     def __predict_mean(self, query):
@@ -38,7 +97,6 @@ class GaussianProcess(object):
 
         data = np.concatenate((self._train_x, query))
 
-        # TODO: compute only relevant parts of A
         A = self._covf.compute_gram_matrix(data)
         Kt = A[N:,:N]
 
@@ -52,60 +110,462 @@ class GaussianProcess(object):
         N = len(self._train_x)
         M = len(query)
 
-        data = np.concatenate((self._train_x, query))
-
-        # TODO: compute only relevant parts of A
-        A = self._covf.compute_gram_matrix(data)
-        Kt = A[N:,:N]
-        Cq = A[N:,N:]
+        if hasattr(self._covf, 'compute_cross_matrix'):
+            Kt = self._covf.compute_cross_matrix(query, self._train_x)
+            Cq = self._covf.compute_gram_matrix(query)
+        else:
+            A = self._covf.compute_gram_matrix(np.concatenate((self._train_x, query)))
+            Kt = A[N:,:N]
+            Cq = A[N:,N:]
 
         self.ensure_gram_matrix()
         y_mean = Kt.dot(self._Cinvt)
-        y_cov  = Cq - Kt.dot(solve(self._C, Kt.T))
+
+        L = self._cholesky()
+        if L is False:
+            y_cov = Cq - Kt.dot(solve(self._C, Kt.T))
+        else:
+            # Kt C^-1 Kt^T = V^T V, with V = L^-1 Kt^T
+            V = solve_triangular(L, Kt.T, lower=True, check_finite=False)
+            y_cov = Cq - V.T.dot(V)
 
         return (y_mean, y_cov)
 
 
     def model_evidence(self):
+        if getattr(self, '_evidence', None) is not None:
+            return self._evidence
+
         self.ensure_gram_matrix()
         t = self._train_t
 
         datafit = t.T.dot(self._Cinvt)
-        s, logdet = slogdet(self._C)
-        complexity = s*logdet
+
+        L = self._cholesky()
+        if L is False:
+            s, logdet = slogdet(self._C)
+            complexity = s*logdet
+        else:
+            complexity = 2*np.log(np.diag(L)).sum()
         nomalization = len(t)*np.log(np.pi*2)
 
-        return -0.5 * (datafit + complexity + nomalization)
+        self._evidence = -0.5 * (datafit + complexity + nomalization)
+        return self._evidence
+
+
+    def model_evidence_and_grad(self):
+        """
+        Log model evidence and its gradient with respect to the
+        covariance function parameters,
+            d/dtheta = 0.5 * tr((a a^T - C^-1) dC/dtheta), a = C^-1 t
+        """
+        C, dC = self._covf.compute_gram_matrix_and_grad(self._train_x)
+        self._C, self._L = C, None
+        self._Cinvt = self._solve(self._train_t)
+
+        L = self._cholesky()
+        if L is False:
+            Cinv = inv(C)
+        else:
+            Cinv = cho_solve((L, True), np.eye(len(C)), check_finite=False)
+
+        a = self._Cinvt
+        W = np.outer(a, a) - Cinv
+        grad = 0.5 * np.einsum('ij,kij->k', W, dC)
+
+        return self.model_evidence(), grad
 
 
     @classmethod
-    def fit(cls, x, t, covf, theta0):
+    def fit(cls, x, t, covf, theta0, maxiter=None):
         evidence = lambda theta: \
             -cls(x, t, covf(theta)).model_evidence()
 
+        def evidence_and_grad(theta):
+            e, grad = cls(x, t, covf(theta)).model_evidence_and_grad()
+            return -e, -grad
+
         if False:
             options = { 'xtol': 0.0001, 'ftol': 0.0001 }
             fit_result = optimize.minimize(evidence, x0=theta0, method='Powell', options=options)
             fit_result.x0 = theta0
+        elif hasattr(covf, 'compute_gram_matrix_and_grad'):
+            options = { 'gtol': 1e-05, 'norm': 2, 'maxiter': maxiter }
+            fit_result = optimize.minimize(evidence_and_grad, x0=theta0, method='CG', jac=True, options=options)
+            fit_result.x0 = theta0
         else:
-            options = { 'gtol': 1e-05, 'norm': 2 }
+            options = { 'gtol': 1e-05, 'norm': 2, 'maxiter': maxiter }
             fit_result = optimize.minimize(evidence, x0=theta0, method='CG', options=options)
             fit_result.x0 = theta0
 
         theta_opt = fit_result.x
         new_gp = cls(x, t, covf(theta_opt))
         new_gp.fit_result = fit_result
+        new_gp._evidence = -fit_result.fun
+        return new_gp
+
+
+    @classmethod
+    def fit_restarts(cls, problems, processes=1, prune_after=None, prune_margin=5.):
+        """
+        Fit several GPs, each from several initial hyper-parameters.
+        `problems` is a list of (x, t, covf, theta0s); returns the GP
+        with the best model evidence for each problem.
+
+        The fits run in this process unless `processes` asks for a pool
+        of worker processes (None: one per cpu). For the few hundred
+        points of a calibration image a fit takes a fraction of a
+        second, and a pool costs about as much as it saves, so only use
+        one for large problems on several cpus.
+
+        With `prune_after`, all restarts first run for that many
+        iterations, and only those whose log evidence is within
+        `prune_margin` of the best of their problem are run to the end.
+        """
+        problems = [ (x, t, covf, theta0s, {}) for x, t, covf, theta0s in problems ]
+        return cls._fit_restarts(problems, processes, prune_after, prune_margin)
+
+
+    @classmethod
+    def _fit_restarts(cls, problems, processes, prune_after, prune_margin):
+        """
+        `fit_restarts` for (x, t, covf, theta0s, kwargs) problems, where
+        `kwargs` are passed to `fit` and to the constructor
+        """
+        jobs = [ (cls, x, t, covf, theta0, kwargs, k)
+                    for k, (x, t, covf, theta0s, kwargs) in enumerate(problems)
+                        for theta0 in theta0s ]
+
+        if processes is None:
+            processes = cpu_count()
+        pool = Pool(min(processes, len(jobs))) if processes > 1 else None
+        map_ = pool.map if pool else map
+
+        try:
+            if prune_after:
+                results = map_(_fit_restart, [ job + (prune_after,) for job in jobs ])
+
+                best = {}
+                for job, r in zip(jobs, results):
+                    best[job[-1]] = max(best.get(job[-1], -np.inf), -r.fun)
+
+                survivors = [ (job, r.x) for job, r in zip(jobs, results)
+                                if -r.fun >= best[job[-1]] - prune_margin ]
+                jobs = [ job for job, _ in survivors ]
+                starts = [ job[:4] + (theta,) + job[5:] + (None,) for job, theta in survivors ]
+            else:
+                starts = [ job + (None,) for job in jobs ]
+
+            results = map_(_fit_restart, starts)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        best_gps = [ None ] * len(problems)
+        for (_, x, t, covf, theta0, kwargs, k), r in zip(jobs, results):
+            r.x0 = theta0
+            if best_gps[k] is None or -r.fun > best_gps[k].model_evidence():
+                gp = cls(x, t, covf(r.x), **kwargs)
+                gp.fit_result = r
+                gp._evidence = -r.fun
+                best_gps[k] = gp
+
+        return best_gps
+
+
+def _fit_restart(args):
+    """ Worker for `GaussianProcess.fit_restarts` """
+    cls, x, t, covf, theta0, kwargs, k, maxiter = args
+    return cls.fit(x, t, covf, theta0, maxiter, **kwargs).fit_result
+
+
+#--------------------------------------
+class MultiOutputGaussianProcess(GaussianProcess):
+#--------------------------------------
+    """
+    GP for D outputs on the same inputs, `train_t` is (N, D). All
+    outputs share the covariance function; output k has the Gram
+    matrix scales[k] * C, so one factorization of C serves every
+    output. The scales are not hyper-parameters; the evidence is
+    maximized over them in closed form, scales[k] = t_k^T C^-1 t_k / N.
+    """
+
+    def scales(self):
+        self.ensure_gram_matrix()
+        return (self._train_t * self._Cinvt).sum(axis=0) / len(self._train_t)
+
+
+    def predict(self, query, cov=False, var=False, chunk_size=4096):
+        """
+        Predictive mean (M, D). With `cov` also the predictive
+        covariance (D, M, M) and with `var` the variances (M, D).
+        """
+        if not (cov or var):
+            return GaussianProcess.predict(self, query, chunk_size=chunk_size)
+
+        y_mean, y_cov = GaussianProcess.predict(self, query, cov, var, chunk_size)
+        scales = self.scales()
+        if cov:
+            return y_mean, scales[:,None,None] * y_cov[None,:,:]
+        return y_mean, y_cov[:,None] * scales[None,:]
+
+
+    def model_evidence(self):
+        if getattr(self, '_evidence', None) is not None:
+            return self._evidence
+
+        self.ensure_gram_matrix()
+        N, D = self._train_t.shape
+
+        L = self._cholesky()
+        if L is False:
+            s, logdet = slogdet(self._C)
+            logdet = s*logdet
+        else:
+            logdet = 2*np.log(np.diag(L)).sum()
+
+        # with the optimal scales the data fit term is N for each output
+        complexity = D*logdet + N*np.log(self.scales()).sum()
+        self._evidence = -0.5 * (D*N + complexity + D*N*np.log(np.pi*2))
+        return self._evidence
+
+
+    def model_evidence_and_grad(self):
+        """
+        Log model evidence and its gradient, the sum over outputs of
+            0.5 * tr((a_k a_k^T / scales[k] - C^-1) dC/dtheta)
+        """
+        C, dC = self._covf.compute_gram_matrix_and_grad(self._train_x)
+        self._C, self._L = C, None
+        self._Cinvt = self._solve(self._train_t)
+
+        L = self._cholesky()
+        if L is False:
+            Cinv = inv(C)
+        else:
+            Cinv = cho_solve((L, True), np.eye(len(C)), check_finite=False)
+
+        A = self._Cinvt
+        W = (A / self.scales()).dot(A.T) - A.shape[1]*Cinv
+        grad = 0.5 * np.einsum('ij,kij->k', W, dC)
+
+        return self.model_evidence(), grad
+
+
+    @classmethod
+    def fit(cls, x, t, covf, theta0, maxiter=None):
+        """
+        As `GaussianProcess.fit`, but the signal variance theta[0] only
+        scales C like the `scales` do, so it is held at theta0[0]
+        instead of leaving CG a direction along which nothing changes.
+        """
+        theta0 = np.asarray(theta0, dtype=float)
+
+        def evidence_and_grad(params):
+            e, grad = cls(x, t, covf(np.r_[theta0[0], params])).model_evidence_and_grad()
+            return -e, -grad[1:]
+
+        options = { 'gtol': 1e-05, 'norm': 2, 'maxiter': maxiter }
+        fit_result = optimize.minimize(evidence_and_grad, x0=theta0[1:], method='CG', jac=True, options=options)
+        fit_result.x = np.r_[theta0[0], fit_result.x]
+        fit_result.x0 = theta0
+
+        new_gp = cls(x, t, covf(fit_result.x))
+        new_gp.fit_result = fit_result
+        new_gp._evidence = -fit_result.fun
         return new_gp
 
 
+#--------------------------------------
+class SparseGaussianProcess(GaussianProcess):
+#--------------------------------------
+    """
+    Inducing point approximation of `GaussianProcess`, for large N.
+    The N training points are summarized by M `inducing` points, so
+    the evidence costs O(N*M^2) and prediction O(M) per query point.
+    `method` is 'vfe' (Titsias' variational bound, the default) or
+    'fitc' (Snelson's fully independent training conditional).
+    """
+    num_inducing = 256
+
+    # relative jitter on the diagonal of the inducing point covariance
+    jitter = 1e-6
+
+    def __init__(self, train_x, train_t, covf, inducing=None, method='vfe'):
+        GaussianProcess.__init__(self, train_x, train_t, covf)
+        if inducing is None:
+            inducing = select_inducing_points(train_x, self.num_inducing)
+        if method not in ('vfe', 'fitc'):
+            raise Exception("Unknown sparse GP method: " + method)
+
+        self._Z = inducing
+        self.method = method
+
+
+    def ensure_gram_matrix(self):
+        if self._C is not None:
+            return
+
+        x, t, Z = self._train_x, self._train_t, self._Z
+
+        Kuu = self._covf.compute_cross_matrix(Z, Z)
+        Kuf = self._covf.compute_cross_matrix(Z, x)
+
+        # the covariance functions are stationary, so the prior variance
+        # without noise is the same everywhere
+        noise = self._covf.compute_gram_diagonal(Z[:1])[0] - Kuu[0,0]
+        self._noise = noise
+        self._kff = Kuu[0,0]
+
+        Kuu.flat[::len(Z)+1] += self.jitter * Kuu[0,0]
+        Luu = cholesky(Kuu, lower=True, check_finite=False)
+        V = solve_triangular(Luu, Kuf, lower=True, check_finite=False)
+        qff = (V*V).sum(axis=0)
+
+        if self.method == 'fitc':
+            lam = noise + self._kff - qff
+        else:
+            lam = np.empty(len(x))
+            lam.fill(noise)
+
+        # (Qff + Lambda)^-1 = Lambda^-1 - Lambda^-1 V^T A^-1 V Lambda^-1
+        V_lam = V / lam
+        A = V_lam.dot(V.T)
+        A.flat[::len(Z)+1] += 1
+        LA = cholesky(A, lower=True, check_finite=False)
+        c = solve_triangular(LA, V_lam.dot(t), lower=True, check_finite=False)
+
+        self._C = Kuu
+        self._Luu, self._LA, self._lam, self._c = Luu, LA, lam, c
+        self._trace = (self._kff - qff).sum()
+
+        # mean = Kqu w
+        self._Cinvt = solve_triangular(Luu, solve_triangular(LA, c, lower=True, trans='T', check_finite=False),
+                                       lower=True, trans='T', check_finite=False)
+
+
+    def predict(self, query, cov=False, var=False, chunk_size=4096):
+        query = np.asarray(query, dtype=float)
+        self.ensure_gram_matrix()
+        Luu, LA = self._Luu, self._LA
+
+        if cov:
+            Kuq = self._covf.compute_cross_matrix(self._Z, query)
+            V = solve_triangular(Luu, Kuq, lower=True, check_finite=False)
+            W = solve_triangular(LA, V, lower=True, check_finite=False)
+            Cq = self._covf.compute_gram_matrix(query)
+            return Kuq.T.dot(self._Cinvt), Cq - V.T.dot(V) + W.T.dot(W)
+
+        M = len(query)
+        y_mean = np.empty(M)
+        y_var = np.empty(M) if var else None
+        for i in xrange(0, M, chunk_size):
+            Kuq = self._covf.compute_cross_matrix(self._Z, query[i:i+chunk_size])
+            y_mean[i:i+chunk_size] = Kuq.T.dot(self._Cinvt)
+
+            if var:
+                V = solve_triangular(Luu, Kuq, lower=True, check_finite=False)
+                W = solve_triangular(LA, V, lower=True, check_finite=False)
+                diag = self._covf.compute_gram_diagonal(query[i:i+chunk_size])
+                y_var[i:i+chunk_size] = diag - (V*V).sum(axis=0) + (W*W).sum(axis=0)
+
+        return (y_mean, y_var) if var else y_mean
+
+
+    def model_evidence(self):
+        if getattr(self, '_evidence', None) is not None:
+            return self._evidence
+
+        self.ensure_gram_matrix()
+        t, lam, c = self._train_t, self._lam, self._c
+
+        datafit = (t*t/lam).sum() - c.dot(c)
+        complexity = np.log(lam).sum() + 2*np.log(np.diag(self._LA)).sum()
+        nomalization = len(t)*np.log(np.pi*2)
+
+        self._evidence = -0.5 * (datafit + complexity + nomalization)
+        if self.method == 'vfe':
+            self._evidence -= 0.5 * self._trace / self._noise
+        return self._evidence
+
+
+    def model_evidence_and_grad(self):
+        """
+        Not available: the gradient of `GaussianProcess` is that of the
+        exact evidence, not of the sparse bound that `model_evidence`
+        returns. `fit` uses numerical gradients instead.
+        """
+        raise TypeError("SparseGaussianProcess has no analytic evidence gradient")
+
+
+    @classmethod
+    def fit(cls, x, t, covf, theta0, maxiter=None, inducing=None, method='vfe'):
+        """
+        As `GaussianProcess.fit`, with the inducing points held fixed
+        """
+        if inducing is None:
+            inducing = select_inducing_points(x, cls.num_inducing)
+
+        evidence = lambda theta: \
+            -cls(x, t, covf(theta), inducing, method).model_evidence()
+
+        options = { 'gtol': 1e-05, 'norm': 2, 'maxiter': maxiter }
+        fit_result = optimize.minimize(evidence, x0=theta0, method='CG', options=options)
+        fit_result.x0 = theta0
+
+        new_gp = cls(x, t, covf(fit_result.x), inducing, method)
+        new_gp.fit_result = fit_result
+        new_gp._evidence = -fit_result.fun
+        return new_gp
+
+
+    @classmethod
+    def fit_restarts(cls, problems, processes=1, prune_after=None, prune_margin=5., method='vfe'):
+        """
+        As `GaussianProcess.fit_restarts`, maximizing the bound of
+        `method`. The inducing points of each problem are selected once
+        and shared by all of its restarts and the GP returned for it.
+        """
+        problems = [ (x, t, covf, theta0s,
+                      dict(inducing=select_inducing_points(x, cls.num_inducing), method=method))
+                        for x, t, covf, theta0s in problems ]
+        return cls._fit_restarts(problems, processes, prune_after, prune_margin)
+
+
+def select_inducing_points(x, m, iterations=10):
+    """
+    `m` inducing points for the training inputs `x`: the centers of
+    a k-means clustering, started from evenly spaced training points
+    so that the choice is repeatable
+    """
+    if len(x) <= m:
+        return np.array(x, dtype=float)
+
+    x = np.asarray(x, dtype=float)
+    init = x[np.linspace(0, len(x)-1, m).astype(int)]
+    Z, _ = kmeans2(x, init, iter=iterations, minit='matrix')
+    return Z
+
+
 #--------------------------------------
 class sqexp1D_covariancef(object):
 #--------------------------------------
     def __init__(self, theta):
         self.theta = theta
 
-    def compute_gram_matrix(self, data):
-        return gram_matrix_sq_exp_1D(data, *self.theta)
+    def compute_gram_matrix(self, data, lower_only=False):
+        return gram_matrix_sq_exp_1D(data, *self.theta, lower_only=lower_only)
+
+    def compute_gram_matrix_and_grad(self, data):
+        return gram_matrix_sq_exp_1D_grad(data, *self.theta)
+
+    def compute_cross_matrix(self, A, B):
+        A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+        return cross_matrix_sq_exp_1D(A, B, *self.theta)
+
+    def compute_gram_diagonal(self, data):
+        return gram_diagonal_sq_exp(len(data), self.theta[0], self.theta[-1])
 
 
 #--------------------------------------
@@ -114,8 +574,18 @@ class sqexp2D_covariancef(object):
     def __init__(self, theta):
         self.theta = theta
 
-    def compute_gram_matrix(self, data):
-        return gram_matrix_sq_exp_2D(data, *self.theta)
+    def compute_gram_matrix(self, data, lower_only=False):
+        return gram_matrix_sq_exp_2D(data, *self.theta, lower_only=lower_only)
+
+    def compute_gram_matrix_and_grad(self, data):
+        return gram_matrix_sq_exp_2D_grad(data, *self.theta)
+
+    def compute_cross_matrix(self, A, B):
+        A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+        return cross_matrix_sq_exp_2D(A, B, *self.theta)
+
+    def compute_gram_diagonal(self, data):
+        return gram_diagonal_sq_exp(len(data), self.theta[0], self.theta[-1])
 
 
 #--------------------------------------
@@ -124,8 +594,18 @@ class sqexp3D_covariancef(object):
     def __init__(self, theta):
         self.theta = theta
 
-    def compute_gram_matrix(self, data):
-        return gram_matrix_sq_exp_3D(data, *self.theta)
+    def compute_gram_matrix(self, data, lower_only=False):
+        return gram_matrix_sq_exp_3D(data, *self.theta, lower_only=lower_only)
+
+    def compute_gram_matrix_and_grad(self, data):
+        return gram_matrix_sq_exp_3D_grad(data, *self.theta)
+
+    def compute_cross_matrix(self, A, B):
+        A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+        return cross_matrix_sq_exp_3D(A, B, *self.theta)
+
+    def compute_gram_diagonal(self, data):
+        return gram_diagonal_sq_exp(len(data), self.theta[0], self.theta[-1])
 
 
 #--------------------------------------
@@ -134,6 +614,6 @@ class linear_covariancef(object):
     def __init__(self, theta):
         self.theta = theta
 
-    def compute_gram_matrix(self, data):
+    def compute_gram_matrix(self, data, lower_only=False):
         betaInvI = np.identity(len(data)) / self.theta[0]
         return np.cov(data) + betaInvI
@@ -0,0 +1,266 @@
+import os
+import sys
+import numpy as np
+from numpy.linalg import solve, slogdet
+from time import time
+
+# runs from gp/, like the other tests here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gp import GaussianProcess, MultiOutputGaussianProcess, SparseGaussianProcess, sqexp2D_covariancef
+
+
+#--------------------------------------
+class LUGaussianProcess(GaussianProcess):
+#--------------------------------------
+    """ Reference implementation, with a general solve per use """
+    def ensure_gram_matrix(self):
+        if self._C is not None:
+            return
+
+        self._C = self._covf.compute_gram_matrix(self._train_x)
+        self._Cinvt = solve(self._C, self._train_t)
+
+    def predict(self, query, cov=False):
+        N = len(self._train_x)
+        A = self._covf.compute_gram_matrix(np.concatenate((self._train_x, query)))
+        Kt, Cq = A[N:,:N], A[N:,N:]
+
+        self.ensure_gram_matrix()
+        y_mean = Kt.dot(self._Cinvt)
+        return (y_mean, Cq - Kt.dot(solve(self._C, Kt.T))) if cov else y_mean
+
+    def model_evidence(self):
+        self.ensure_gram_matrix()
+        t = self._train_t
+        s, logdet = slogdet(self._C)
+        return -0.5 * (t.T.dot(self._Cinvt) + s*logdet + len(t)*np.log(np.pi*2))
+
+
+#--------------------------------------
+class fd_sqexp2D_covariancef(object):
+#--------------------------------------
+    """ Without the analytic derivatives, so fitting uses finite differences """
+    def __init__(self, theta):
+        self.theta = theta
+        self._covf = sqexp2D_covariancef(theta)
+
+    def compute_gram_matrix(self, data, lower_only=False):
+        return self._covf.compute_gram_matrix(data, lower_only)
+
+
+np.set_printoptions(precision=4, suppress=True)
+np.random.seed(0)
+
+x = np.random.uniform(0, 1000, (200, 2))
+t = np.sin(x[:,0] / 200.) + np.cos(x[:,1] / 300.) + 0.05*np.random.randn(len(x))
+t = t - np.mean(t)
+q = np.random.uniform(0, 1000, (300, 2))
+
+
+print '\n--evidence and predictions--------------------\n'
+for theta in [ [ t.std(), 200, 200, 0, 10. ], [ 1., 50, 400, 100, 20. ] ]:
+    ref = LUGaussianProcess(x, t, sqexp2D_covariancef(theta))
+    gp = GaussianProcess(x, t, sqexp2D_covariancef(theta))
+
+    assert np.allclose(ref.model_evidence(), gp.model_evidence())
+
+    ref_mean, ref_cov = ref.predict(q, cov=True)
+    mean, cov = gp.predict(q, cov=True)
+    assert np.allclose(ref_mean, mean)
+    assert np.allclose(ref_cov, cov)
+    assert (mean == gp.predict(q)).all()
+
+    mean, var = gp.predict(q, var=True, chunk_size=64)
+    assert np.allclose(ref_mean, mean)
+    assert np.allclose(np.diag(ref_cov), var)
+
+# integer pixel grids, as the calibration scripts build them
+grid = np.array([ [ u, v ] for u in xrange(0, 1000, 50) for v in xrange(0, 1000, 50) ])
+assert grid.dtype.kind == 'i'
+for predict in [ gp.predict, SparseGaussianProcess(x, t, gp._covf, x[::4]).predict ]:
+    mean, var = predict(grid, var=True)
+    assert np.allclose(mean, predict(grid.astype(float)))
+    assert np.allclose(predict(grid, cov=True)[1], predict(grid.astype(float), cov=True)[1])
+
+
+print '\n--prediction cost--------------------\n'
+gp = GaussianProcess(x, t, sqexp2D_covariancef([ t.std(), 200, 200, 0, 10. ]))
+grid = np.random.uniform(0, 1000, (4000, 2))
+
+t0 = time()
+ref_mean = LUGaussianProcess(x, t, gp._covf).predict(grid)
+print '  concatenated: %.4fs' % (time()-t0)
+
+t0 = time()
+mean = gp.predict(grid, chunk_size=1000)
+print '         cross: %.4fs' % (time()-t0)
+
+assert np.allclose(ref_mean, mean)
+
+
+print '\n--evidence gradient--------------------\n'
+for theta in [ [ t.std(), 200, 200, 0, 10. ], [ 1., 50, 400, 100, 20. ] ]:
+    e, grad = GaussianProcess(x, t, sqexp2D_covariancef(theta)).model_evidence_and_grad()
+    assert np.allclose(e, GaussianProcess(x, t, sqexp2D_covariancef(theta)).model_evidence())
+
+    fd = np.empty(len(theta))
+    for k in xrange(len(theta)):
+        eps = 1e-5 * max(1., abs(theta[k]))
+        hi, lo = np.array(theta), np.array(theta)
+        hi[k] += eps
+        lo[k] -= eps
+        fd[k] = (GaussianProcess(x, t, sqexp2D_covariancef(hi)).model_evidence() -
+                 GaussianProcess(x, t, sqexp2D_covariancef(lo)).model_evidence()) / (2*eps)
+
+    print '  analytic:', grad
+    print '   fin.dif:', fd
+    assert np.allclose(grad, fd, rtol=1e-4, atol=1e-6)
+
+
+print '\n--fit--------------------\n'
+theta0 = [ t.std(), 200, 200, 0, 10. ]
+
+t0 = time()
+ref = LUGaussianProcess.fit(x, t, fd_sqexp2D_covariancef, theta0)
+print '      lu, finite differences: %.4fs, %d evaluations' % (time()-t0, ref.fit_result.nfev)
+
+t0 = time()
+gp = GaussianProcess.fit(x, t, sqexp2D_covariancef, theta0)
+print '  cholesky, analytic gradient: %.4fs, %d evaluations' % (time()-t0, gp.fit_result.nfev)
+
+print '  theta:', ref._covf.theta, gp._covf.theta
+print '  evidence:', ref.model_evidence(), gp.model_evidence()
+
+# The evidence surface is flat around the optimum, so finite difference
+# gradients that differ in the last digits can end CG at different
+# points. Both should be equally good.
+assert np.allclose(ref.model_evidence(), gp.model_evidence(), rtol=1e-3)
+
+
+print '\n--multiple outputs--------------------\n'
+T = np.vstack([ t, 3*np.cos(x[:,0] / 200.) - 3*np.sin(x[:,1] / 300.) + 0.15*np.random.randn(len(x)) ]).T
+T = T - T.mean(axis=0)
+
+theta = np.array([ 1., 200, 300, 10, 10. ])
+joint = MultiOutputGaussianProcess(x, T, sqexp2D_covariancef(theta))
+scales = joint.scales()
+
+# each output on its own, with the whole covariance scaled
+single = [ GaussianProcess(x, T[:,k], sqexp2D_covariancef(theta * [ np.sqrt(a), 1, 1, 1, 1/np.sqrt(a) ]))
+            for k, a in enumerate(scales) ]
+
+assert np.allclose(joint.model_evidence(), sum(gp.model_evidence() for gp in single))
+mean, var = joint.predict(q, var=True)
+for k, gp in enumerate(single):
+    single_mean, single_var = gp.predict(q, var=True)
+    assert np.allclose(mean[:,k], single_mean)
+    assert np.allclose(var[:,k], single_var)
+
+e, grad = MultiOutputGaussianProcess(x, T, sqexp2D_covariancef(theta)).model_evidence_and_grad()
+fd = np.empty(len(theta))
+for k in xrange(len(theta)):
+    eps = 1e-5 * max(1., abs(theta[k]))
+    hi, lo = theta.copy(), theta.copy()
+    hi[k] += eps
+    lo[k] -= eps
+    fd[k] = (MultiOutputGaussianProcess(x, T, sqexp2D_covariancef(hi)).model_evidence() -
+             MultiOutputGaussianProcess(x, T, sqexp2D_covariancef(lo)).model_evidence()) / (2*eps)
+print '  analytic:', grad
+print '   fin.dif:', fd
+assert np.allclose(grad, fd, rtol=1e-4, atol=1e-6)
+
+# what a fit iteration costs, for both outputs
+t0 = time()
+for _ in xrange(10):
+    for k in xrange(2):
+        GaussianProcess(x, T[:,k], sqexp2D_covariancef(theta)).model_evidence_and_grad()
+print '  separate: %.4fs/evaluation' % ((time()-t0) / 10)
+
+t0 = time()
+for _ in xrange(10):
+    MultiOutputGaussianProcess(x, T, sqexp2D_covariancef(theta)).model_evidence_and_grad()
+print '     joint: %.4fs/evaluation' % ((time()-t0) / 10)
+
+grid = np.random.uniform(0, 1000, (20000, 2))
+t0 = time()
+for k in xrange(2):
+    single[k].predict(grid)
+print '  separate: %.4fs/prediction' % (time()-t0)
+
+t0 = time()
+joint.predict(grid)
+print '     joint: %.4fs/prediction' % (time()-t0)
+
+
+print '\n--inducing points--------------------\n'
+theta = [ t.std(), 200, 200, 0, 10. ]
+exact = GaussianProcess(x, t, sqexp2D_covariancef(theta))
+exact_mean, exact_var = exact.predict(q, var=True)
+
+for method in [ 'vfe', 'fitc' ]:
+    # with every training point as an inducing point, the
+    # approximations are exact, up to the jitter
+    gp = SparseGaussianProcess(x, t, sqexp2D_covariancef(theta), inducing=x, method=method)
+    mean, var = gp.predict(q, var=True)
+    assert np.allclose(exact.model_evidence(), gp.model_evidence(), rtol=1e-4)
+    assert np.allclose(exact_mean, mean, atol=1e-3)
+    assert np.allclose(exact_var, var, atol=1e-4)
+    assert np.allclose(exact.predict(q, cov=True)[1], gp.predict(q, cov=True)[1], atol=1e-4)
+
+    gp = SparseGaussianProcess(x, t, sqexp2D_covariancef(theta), inducing=x[:50], method=method)
+    print '  %s, 50 inducing points: evidence %.4f (exact %.4f), max error %.4f' % (
+        method, gp.model_evidence(), exact.model_evidence(), abs(gp.predict(q) - exact_mean).max())
+
+
+print '\n--restarts--------------------\n'
+x, t = x[:80], t[:80]
+theta0s = [ np.array(( t.std(), tau, tau, 0, 10. )) for tau in xrange(50, 800, 100) ]
+problems = [ (x, t, sqexp2D_covariancef, theta0s), (x, -t, sqexp2D_covariancef, theta0s) ]
+
+t0 = time()
+sequential = []
+for x_, t_, covf, _ in problems:
+    fits = [ GaussianProcess.fit(x_, t_, covf, theta0) for theta0 in theta0s ]
+    sequential.append(max(fits, key=lambda gp: gp.model_evidence()))
+print '  sequential: %.4fs' % (time()-t0)
+
+t0 = time()
+restarts = GaussianProcess.fit_restarts(problems)
+print '    restarts: %.4fs' % (time()-t0)
+
+t0 = time()
+pooled = GaussianProcess.fit_restarts(problems, processes=4)
+print '        pool: %.4fs' % (time()-t0)
+
+t0 = time()
+pruned = GaussianProcess.fit_restarts(problems, prune_after=5)
+print '      pruned: %.4fs' % (time()-t0)
+
+for a, b, c, d in zip(sequential, restarts, pooled, pruned):
+    print '  evidence:', a.model_evidence(), b.model_evidence(), c.model_evidence(), d.model_evidence()
+    assert np.allclose(a.model_evidence(), b.model_evidence())
+    assert np.allclose(a.model_evidence(), c.model_evidence())
+    assert np.allclose(b.model_evidence(), GaussianProcess(b._train_x, b._train_t, b._covf).model_evidence())
+    assert d.model_evidence() >= a.model_evidence() - 1.
+
+# the sparse bound has no analytic gradient, and its restarts keep the
+# method and the inducing points
+Z = x[::4]
+try:
+    SparseGaussianProcess(x, t, sqexp2D_covariancef(theta0s[0]), Z).model_evidence_and_grad()
+    assert False
+except TypeError:
+    pass
+
+SparseGaussianProcess.num_inducing = len(Z)
+for method in [ 'vfe', 'fitc' ]:
+    sparse = [ max([ SparseGaussianProcess.fit(x_, t_, covf, theta0, method=method) for theta0 in theta0s[:3] ],
+                   key=lambda gp: gp.model_evidence()) for x_, t_, covf, _ in problems ]
+    restarts = SparseGaussianProcess.fit_restarts(
+                    [ (x_, t_, covf, theta0s[:3]) for x_, t_, covf, _ in problems ], method=method)
+    for a, b in zip(sparse, restarts):
+        print '  %s evidence:' % method, a.model_evidence(), b.model_evidence()
+        assert b.method == method and np.allclose(a._Z, b._Z)
+        assert np.allclose(a.model_evidence(), b.model_evidence())
+        assert np.allclose(b.model_evidence(),
+                           SparseGaussianProcess(x, b._train_t, b._covf, b._Z, method).model_evidence())
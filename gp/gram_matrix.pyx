@@ -2,15 +2,368 @@ import numpy as np
 import cython
 
 cimport numpy as np
+from cython.parallel cimport prange
 from libc.math cimport exp
+from posix.unistd cimport getpid
 
 
 
 ctypedef np.float64_t float64_t
 
+#
+# The gram matrix kernels compute the lower triangle row by row, with
+# the rows spread over `set_num_threads` OpenMP threads. Unless
+# `lower_only` is set, each value is also written to the upper triangle;
+# with `lower_only` the upper triangle is left zero, which is all a
+# lower Cholesky factorization reads, and the strided writes are saved.
+#
+# Threads are opt-in: the OpenMP thread pool does not survive fork(),
+# and a child forked by a process that ran a parallel region hangs in
+# its own first one. `GaussianProcess.fit_restarts` and the batch
+# scripts use forking pools, so the kernels run on one thread unless
+# `set_num_threads` asks for more, and always on one thread in a
+# process forked after that call.
+#
+
+cdef int _num_threads = 1
+cdef int _num_threads_pid = 0
+
+
+def set_num_threads(int n):
+    """
+    Run the gram matrix kernels of this process on `n` OpenMP threads.
+    Processes forked from it keep using one thread.
+    """
+    global _num_threads, _num_threads_pid
+    _num_threads = max(n, 1)
+    _num_threads_pid = getpid()
+
+
+def get_num_threads():
+    """ Number of threads the gram matrix kernels use in this process """
+    return _kernel_threads()
+
+
+cdef int _kernel_threads():
+    if _num_threads > 1 and getpid() == _num_threads_pid:
+        return _num_threads
+    return 1
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cpdef gram_matrix_sq_exp_1D(
+    np.ndarray[float64_t, ndim=1] data,
+    float64_t sigma_f,          # function/signal variance
+    float64_t sigma_x,          # length-scale
+    float64_t sigma_inv_noise,  # sqrt(noise precision)
+    bint lower_only=False
+    ):
+
+    cdef int N
+    N = data.shape[0]
+
+    cdef float64_t noise_variance, x_precision, sigma_f2
+    noise_variance = 1./(sigma_inv_noise*sigma_inv_noise)
+    x_precision = 1./(sigma_x*sigma_x)
+    sigma_f2 = sigma_f*sigma_f
+
+    cdef int i, j
+    cdef float64_t z, v
+
+    cdef float64_t[::1] X = np.ascontiguousarray(data)
+
+    K = np.zeros((N, N)) if lower_only else np.empty((N, N))
+    cdef float64_t[:, ::1] Kv = K
+
+    cdef int num_threads = _kernel_threads()
+
+    with nogil:
+        for i in prange(N, schedule='guided', num_threads=num_threads):
+            for j in range(i+1):
+                z = X[i] - X[j]
+                v = sigma_f2*exp(-0.5*(z*z*x_precision))
+                Kv[i,j] = v
+                if not lower_only:
+                    Kv[j,i] = v
+            Kv[i,i] += noise_variance
+
+    return K
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef gram_matrix_sq_exp_2D(
+    np.ndarray[float64_t, ndim=2] data,
+    float64_t sigma_f,          # Function/signal variance
+    float64_t sigma_xx,         # 2D length-scale parameters
+    float64_t sigma_yy,         #   ..
+    float64_t corr_xy,          #   ..
+    float64_t sigma_inv_noise,  # sqrt(noise precision)
+    bint lower_only=False
+    ):
+
+    cdef np.ndarray[float64_t, ndim=2] Sigma, Sigma_inv
+    Sigma = np.array([ [ sigma_xx**2,  corr_xy    ],
+                       [  corr_xy,    sigma_yy**2 ] ])
+    Sigma_inv = np.linalg.inv(Sigma)
+
+    cdef float64_t p, q, r, s
+    p = Sigma_inv[0,0]
+    q = Sigma_inv[0,1]
+    r = Sigma_inv[1,0]
+    s = Sigma_inv[1,1]
+
+    cdef int N
+    N = data.shape[0]
+
+    cdef float64_t noise_variance, sigma_f2
+    noise_variance = 1./(sigma_inv_noise*sigma_inv_noise)
+    sigma_f2 = sigma_f*sigma_f
+
+    cdef int i, j
+    cdef float64_t g, h, v
+
+    cdef float64_t[:, ::1] X = np.ascontiguousarray(data)
+
+    K = np.zeros((N, N)) if lower_only else np.empty((N, N))
+    cdef float64_t[:, ::1] Kv = K
+
+    cdef int num_threads = _kernel_threads()
+
+    with nogil:
+        for i in prange(N, schedule='guided', num_threads=num_threads):
+            for j in range(i+1):
+                g = X[i,0] - X[j,0]
+                h = X[i,1] - X[j,1]
+                v = sigma_f2*exp(-0.5*(g*(p*g+q*h) + h*(r*g+s*h)))
+                Kv[i,j] = v
+                if not lower_only:
+                    Kv[j,i] = v
+            Kv[i,i] += noise_variance
+
+    return K
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef gram_matrix_sq_exp_3D(
+    np.ndarray[float64_t, ndim=2] data,
+    float64_t sigma_f,          # Function/signal variance
+    float64_t sigma_xx,         # 3D length-scale parameters
+    float64_t sigma_yy,         #   ..
+    float64_t sigma_zz,         #   ..
+    float64_t corr_xy,          #   ..
+    float64_t corr_yz,          #   ..
+    float64_t corr_xz,          #   ..
+    float64_t sigma_inv_noise,  # sqrt(noise precision)
+    bint lower_only=False
+    ):
+
+    cdef np.ndarray[float64_t, ndim=2] Sigma, Sigma_inv
+    Sigma = np.array([ [ sigma_xx**2,   corr_xy,     corr_xz   ],
+                       [  corr_xy,     sigma_yy**2,  corr_yz   ],
+                       [  corr_xz,      corr_yz,    sigma_zz**2 ] ])
+    Sigma_inv = np.linalg.inv(Sigma)
+
+    cdef float64_t p, q, r, s, t, u
+    p = Sigma_inv[0,0]
+    q = Sigma_inv[0,1]
+    r = Sigma_inv[1,1]
+    s = Sigma_inv[0,2]
+    t = Sigma_inv[1,2]
+    u = Sigma_inv[2,2]
+
+    cdef int N
+    N = data.shape[0]
+
+    cdef float64_t noise_variance, sigma_f2
+    noise_variance = 1./(sigma_inv_noise*sigma_inv_noise)
+    sigma_f2 = sigma_f*sigma_f
+
+    cdef int i, j
+    cdef float64_t a, b, c, v
+
+    cdef float64_t[:, ::1] X = np.ascontiguousarray(data)
+
+    K = np.zeros((N, N)) if lower_only else np.empty((N, N))
+    cdef float64_t[:, ::1] Kv = K
+
+    cdef int num_threads = _kernel_threads()
+
+    with nogil:
+        for i in prange(N, schedule='guided', num_threads=num_threads):
+            for j in range(i+1):
+                a = X[i,0] - X[j,0]
+                b = X[i,1] - X[j,1]
+                c = X[i,2] - X[j,2]
+                v = sigma_f2*exp(-0.5*(a*(p*a + q*b + s*c) + b*(q*a + r*b + t*c) + c*(s*a + t*b + u*c)))
+                Kv[i,j] = v
+                if not lower_only:
+                    Kv[j,i] = v
+            Kv[i,i] += noise_variance
+
+    return K
+
+#
+# Cross-covariance kernels. These compute the (M, N) block of
+# covariances between points `A` and `B` only, without the noise term
+# (distinct points have independent noise). They take the same
+# parameters as the corresponding gram matrix kernels.
+#
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef cross_matrix_sq_exp_1D(
+    np.ndarray[float64_t, ndim=1] A,
+    np.ndarray[float64_t, ndim=1] B,
+    float64_t sigma_f,          # function/signal variance
+    float64_t sigma_x,          # length-scale
+    float64_t sigma_inv_noise   # sqrt(noise precision), unused
+    ):
+
+    cdef int M, N
+    M = A.shape[0]
+    N = B.shape[0]
+
+    cdef float64_t x_precision
+    x_precision = 1./(sigma_x*sigma_x)
+
+    cdef int i, j
+    cdef float64_t z
+
+    cdef np.ndarray[float64_t, ndim=2] K
+    K = np.empty((M, N))
+
+    for i in xrange(M):
+        for j in xrange(N):
+            z = A[i] - B[j]
+            K[i,j] = (sigma_f*sigma_f)*exp(-0.5*z*z*x_precision)
+
+    return K
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef cross_matrix_sq_exp_2D(
+    np.ndarray[float64_t, ndim=2] A,
+    np.ndarray[float64_t, ndim=2] B,
+    float64_t sigma_f,          # Function/signal variance
+    float64_t sigma_xx,         # 2D length-scale parameters
+    float64_t sigma_yy,         #   ..
+    float64_t corr_xy,          #   ..
+    float64_t sigma_inv_noise   # sqrt(noise precision), unused
+    ):
+
+    cdef np.ndarray[float64_t, ndim=2] Sigma, Sigma_inv
+    Sigma = np.array([ [ sigma_xx**2,  corr_xy    ],
+                       [  corr_xy,    sigma_yy**2 ] ])
+    Sigma_inv = np.linalg.inv(Sigma)
+
+    cdef float64_t p, q, r, s
+    p = Sigma_inv[0,0]
+    q = Sigma_inv[0,1]
+    r = Sigma_inv[1,0]
+    s = Sigma_inv[1,1]
+
+    cdef int M, N
+    M = A.shape[0]
+    N = B.shape[0]
+
+    cdef int i, j
+    cdef float64_t g, h, chi2
+
+    cdef np.ndarray[float64_t, ndim=2] K
+    K = np.empty((M, N))
+
+    for i in xrange(M):
+        for j in xrange(N):
+            g = A[i,0] - B[j,0]
+            h = A[i,1] - B[j,1]
+
+            chi2 = g*(p*g+q*h) + h*(r*g+s*h)
+            K[i,j] = (sigma_f*sigma_f)*exp(-0.5*chi2)
+
+    return K
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef cross_matrix_sq_exp_3D(
+    np.ndarray[float64_t, ndim=2] A,
+    np.ndarray[float64_t, ndim=2] B,
+    float64_t sigma_f,          # Function/signal variance
+    float64_t sigma_xx,         # 3D length-scale parameters
+    float64_t sigma_yy,         #   ..
+    float64_t sigma_zz,         #   ..
+    float64_t corr_xy,          #   ..
+    float64_t corr_yz,          #   ..
+    float64_t corr_xz,          #   ..
+    float64_t sigma_inv_noise   # sqrt(noise precision), unused
+    ):
+
+    cdef np.ndarray[float64_t, ndim=2] Sigma, Sigma_inv
+    Sigma = np.array([ [ sigma_xx**2,   corr_xy,     corr_xz   ],
+                       [  corr_xy,     sigma_yy**2,  corr_yz   ],
+                       [  corr_xz,      corr_yz,    sigma_zz**2 ] ])
+    Sigma_inv = np.linalg.inv(Sigma)
+
+    cdef float64_t p, q, r, s, t, u
+    p = Sigma_inv[0,0]
+    q = Sigma_inv[0,1]
+    r = Sigma_inv[1,1]
+    s = Sigma_inv[0,2]
+    t = Sigma_inv[1,2]
+    u = Sigma_inv[2,2]
+
+    cdef int M, N
+    M = A.shape[0]
+    N = B.shape[0]
+
+    cdef int i, j
+    cdef float64_t a, b, c, chi2
+
+    cdef np.ndarray[float64_t, ndim=2] K
+    K = np.empty((M, N))
+
+    for i in xrange(M):
+        for j in xrange(N):
+            a = A[i,0] - B[j,0]
+            b = A[i,1] - B[j,1]
+            c = A[i,2] - B[j,2]
+
+            chi2 = a*(p*a + q*b + s*c) + b*(q*a + r*b + t*c) + c*(s*a + t*b + u*c)
+            K[i,j] = (sigma_f*sigma_f)*exp(-0.5*chi2)
+
+    return K
+
+
+cpdef gram_diagonal_sq_exp(
+    int M,
+    float64_t sigma_f,          # Function/signal variance
+    float64_t sigma_inv_noise   # sqrt(noise precision)
+    ):
+    """
+    Diagonal of the gram matrix of `M` points, for any of the squared
+    exponential kernels: the prior variance of each point
+    """
+    cdef np.ndarray[float64_t, ndim=1] d
+    d = np.empty(M)
+    d.fill(sigma_f*sigma_f + 1./(sigma_inv_noise*sigma_inv_noise))
+    return d
+
+
+#
+# Gram matrices with their derivatives. These return the gram matrix K
+# and dK, where dK[k] is the derivative of K with respect to the k-th
+# parameter, in the order the parameters are passed in. With
+# w = Sigma^-1 z, the derivative with respect to a parameter of Sigma
+# is 0.5 * k(z) * w^T (dSigma/dtheta) w.
+#
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef gram_matrix_sq_exp_1D_grad(
     np.ndarray[float64_t, ndim=1] data,
     float64_t sigma_f,          # function/signal variance
     float64_t sigma_x,          # length-scale
@@ -25,26 +378,36 @@ cpdef gram_matrix_sq_exp_1D(
     x_precision = 1./(sigma_x*sigma_x)
 
     cdef int i, j
-    cdef float64_t z
+    cdef float64_t z, w, e, v
 
     cdef np.ndarray[float64_t, ndim=2] K
+    cdef np.ndarray[float64_t, ndim=3] dK
     K = np.empty((N, N))
+    dK = np.zeros((3, N, N))
 
     for i in xrange(N):
         for j in xrange(i+1):
             z = data[i] - data[j]
+            w = z*x_precision
 
-            v = (sigma_f*sigma_f)*exp(-0.5*z*z*x_precision)
-            if i==j: v += noise_variance
+            e = exp(-0.5*z*w)
+            v = (sigma_f*sigma_f)*e
+
+            dK[0,i,j] = dK[0,j,i] = 2*sigma_f*e
+            dK[1,i,j] = dK[1,j,i] = v*sigma_x*w*w
+
+            if i==j:
+                v += noise_variance
+                dK[2,i,i] = -2*noise_variance/sigma_inv_noise
 
             K[i,j] = K[j,i] = v
 
-    return K
+    return K, dK
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef gram_matrix_sq_exp_2D(
+cpdef gram_matrix_sq_exp_2D_grad(
     np.ndarray[float64_t, ndim=2] data,
     float64_t sigma_f,          # Function/signal variance
     float64_t sigma_xx,         # 2D length-scale parameters
@@ -71,28 +434,40 @@ cpdef gram_matrix_sq_exp_2D(
     noise_variance = 1./(sigma_inv_noise*sigma_inv_noise)
 
     cdef int i, j
-    cdef float64_t g, h, chi2, v
+    cdef float64_t g, h, wg, wh, e, v
 
     cdef np.ndarray[float64_t, ndim=2] K
+    cdef np.ndarray[float64_t, ndim=3] dK
     K = np.empty((N, N))
+    dK = np.zeros((5, N, N))
 
     for i in xrange(N):
         for j in xrange(i+1):
             g = data[i,0] - data[j,0]
             h = data[i,1] - data[j,1]
+            wg = p*g + q*h
+            wh = r*g + s*h
 
-            chi2 = g*(p*g+q*h) + h*(r*g+s*h)
-            v = (sigma_f*sigma_f)*exp(-0.5*chi2)
-            if i==j: v += noise_variance
+            e = exp(-0.5*(g*wg + h*wh))
+            v = (sigma_f*sigma_f)*e
+
+            dK[0,i,j] = dK[0,j,i] = 2*sigma_f*e
+            dK[1,i,j] = dK[1,j,i] = v*sigma_xx*wg*wg
+            dK[2,i,j] = dK[2,j,i] = v*sigma_yy*wh*wh
+            dK[3,i,j] = dK[3,j,i] = v*wg*wh
+
+            if i==j:
+                v += noise_variance
+                dK[4,i,i] = -2*noise_variance/sigma_inv_noise
 
             K[i,j] = K[j,i] = v
 
-    return K
+    return K, dK
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef gram_matrix_sq_exp_3D(
+cpdef gram_matrix_sq_exp_3D_grad(
     np.ndarray[float64_t, ndim=2] data,
     float64_t sigma_f,          # Function/signal variance
     float64_t sigma_xx,         # 3D length-scale parameters
@@ -125,21 +500,37 @@ cpdef gram_matrix_sq_exp_3D(
     noise_variance = 1./(sigma_inv_noise*sigma_inv_noise)
 
     cdef int i, j
-    cdef float64_t a, b, c, chi2, v
+    cdef float64_t a, b, c, wa, wb, wc, e, v
 
     cdef np.ndarray[float64_t, ndim=2] K
+    cdef np.ndarray[float64_t, ndim=3] dK
     K = np.empty((N, N))
+    dK = np.zeros((8, N, N))
 
     for i in xrange(N):
         for j in xrange(i+1):
             a = data[i,0] - data[j,0]
             b = data[i,1] - data[j,1]
             c = data[i,2] - data[j,2]
+            wa = p*a + q*b + s*c
+            wb = q*a + r*b + t*c
+            wc = s*a + t*b + u*c
 
-            chi2 = a*(p*a + q*b + s*c) + b*(q*a + r*b + t*c) + c*(s*a + t*b + u*c)
-            v = (sigma_f*sigma_f)*exp(-0.5*chi2)
-            if i==j: v += noise_variance
+            e = exp(-0.5*(a*wa + b*wb + c*wc))
+            v = (sigma_f*sigma_f)*e
+
+            dK[0,i,j] = dK[0,j,i] = 2*sigma_f*e
+            dK[1,i,j] = dK[1,j,i] = v*sigma_xx*wa*wa
+            dK[2,i,j] = dK[2,j,i] = v*sigma_yy*wb*wb
+            dK[3,i,j] = dK[3,j,i] = v*sigma_zz*wc*wc
+            dK[4,i,j] = dK[4,j,i] = v*wa*wb
+            dK[5,i,j] = dK[5,j,i] = v*wb*wc
+            dK[6,i,j] = dK[6,j,i] = v*wa*wc
+
+            if i==j:
+                v += noise_variance
+                dK[7,i,i] = -2*noise_variance/sigma_inv_noise
 
             K[i,j] = K[j,i] = v
 
-    return K
+    return K, dK
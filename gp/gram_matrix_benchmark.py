@@ -0,0 +1,79 @@
+import os
+import gc
+import numpy as np
+from time import time
+from scipy.linalg import cholesky
+
+import pyximport; pyximport.install()
+import gram_matrix
+
+
+def blas_gram_matrix_sq_exp_2D(data, sigma_f, sigma_xx, sigma_yy, corr_xy, sigma_inv_noise):
+    """
+    The same gram matrix through a whitening transform: with
+    W^T W = Sigma^-1 and Y = data W^T, chi2 = |y_i|^2 + |y_j|^2 - 2 y_i.y_j
+    """
+    Sigma = np.array([ [ sigma_xx**2, corr_xy ], [ corr_xy, sigma_yy**2 ] ])
+    W = cholesky(np.linalg.inv(Sigma))
+    Y = data.dot(W.T)
+    y2 = (Y*Y).sum(axis=1)
+
+    K = Y.dot(Y.T)
+    K *= 2
+    K -= y2[:,None]
+    K -= y2[None,:]
+    np.minimum(K, 0, out=K)
+    K *= 0.5
+    np.exp(K, out=K)
+    K *= sigma_f*sigma_f
+    K.flat[::len(K)+1] += 1./(sigma_inv_noise*sigma_inv_noise)
+    return K
+
+
+def best_of(f, repeat):
+    best = np.inf
+    for _ in xrange(repeat):
+        t0 = time()
+        f()
+        best = min(best, time()-t0)
+        gc.collect()
+    return best
+
+
+np.random.seed(0)
+theta2 = (1., 200., 300., 50., 10.)
+theta3 = (1., 200., 300., 100., 50., 0., 0., 10.)
+
+# threads are opt-in, see gram_matrix.pyx; not safe in a process that forks later
+gram_matrix.set_num_threads(int(os.environ.get('OMP_NUM_THREADS', 0) or
+                                __import__('multiprocessing').cpu_count()))
+print '\n  %d OpenMP threads (OMP_NUM_THREADS)' % gram_matrix.get_num_threads()
+
+data = np.random.uniform(0, 1000, (500, 2))
+assert np.allclose(blas_gram_matrix_sq_exp_2D(data, *theta2), gram_matrix.gram_matrix_sq_exp_2D(data, *theta2))
+
+print '\n  %6s %10s %10s %10s %10s %10s %10s' % (
+    'N', '2D', 'lower', 'blas', '3D', 'lower', 'cholesky')
+for N in [ 100, 200, 500, 1000, 2000, 5000, 10000, 20000 ]:
+    repeat = max(1, min(20, 2000000 / (N*N)))
+    data2 = np.random.uniform(0, 1000, (N, 2))
+    data3 = np.random.uniform(0, 1000, (N, 3))
+
+    t_2d = best_of(lambda: gram_matrix.gram_matrix_sq_exp_2D(data2, *theta2), repeat)
+    t_2d_lower = best_of(lambda: gram_matrix.gram_matrix_sq_exp_2D(data2, *theta2, lower_only=True), repeat)
+
+    # needs twice the memory
+    t_blas = best_of(lambda: blas_gram_matrix_sq_exp_2D(data2, *theta2), repeat) if N <= 10000 else np.nan
+
+    t_3d = best_of(lambda: gram_matrix.gram_matrix_sq_exp_3D(data3, *theta3), repeat)
+    t_3d_lower = best_of(lambda: gram_matrix.gram_matrix_sq_exp_3D(data3, *theta3, lower_only=True), repeat)
+
+    # for scale: what the factorization that follows costs
+    t_chol = np.nan
+    if N <= 10000:
+        K = gram_matrix.gram_matrix_sq_exp_2D(data2, *theta2, lower_only=True)
+        t_chol = best_of(lambda: cholesky(K, lower=True, check_finite=False), repeat)
+        del K
+
+    print '  %6d %9.4fs %9.4fs %9.4fs %9.4fs %9.4fs %9.4fs' % (
+        N, t_2d, t_2d_lower, t_blas, t_3d, t_3d_lower, t_chol)
@@ -158,4 +158,64 @@ print '  cy: %.4fs' % (time()-t0)
 # print 'py:\n', pyG
 # print 'cy:\n', cyG
 
-assert np.allclose(pyG, cyG)
\ No newline at end of file
+assert np.allclose(pyG, cyG)
+
+print '\n--cross matrices--------------------\n'
+for dim, theta in [ (1, (1, 1, 10)), (2, (1, 2, 1, .5, 10)), (3, (1, 1, 2, 1, .3, 0, .2, 10)) ]:
+    gram = getattr(gram_matrix, 'gram_matrix_sq_exp_%dD' % dim)
+    cross = getattr(gram_matrix, 'cross_matrix_sq_exp_%dD' % dim)
+
+    shape = lambda n: (n,) if dim == 1 else (n, dim)
+    A, B = np.random.randn(*shape(300)), np.random.randn(*shape(200))
+    G = gram(np.concatenate((B, A)), *theta)
+
+    assert np.allclose(cross(A, B, *theta), G[200:,:200])
+    assert np.allclose(gram_matrix.gram_diagonal_sq_exp(300, theta[0], theta[-1]), np.diag(G)[200:])
+    print '  %dD: ok' % dim
+
+
+print '\n--derivatives--------------------\n'
+for dim, theta in [ (1, (1.5, 2, 3)), (2, (1.5, 2, 1, .5, 3)), (3, (1.5, 1, 2, 1, .3, 0, .2, 3)) ]:
+    gram = getattr(gram_matrix, 'gram_matrix_sq_exp_%dD' % dim)
+    gram_grad = getattr(gram_matrix, 'gram_matrix_sq_exp_%dD_grad' % dim)
+
+    data = np.random.randn(*((100,) if dim == 1 else (100, dim)))
+    K, dK = gram_grad(data, *theta)
+    assert np.allclose(K, gram(data, *theta))
+
+    eps = 1e-6
+    for k in xrange(len(theta)):
+        hi, lo = np.array(theta, dtype=float), np.array(theta, dtype=float)
+        hi[k] += eps
+        lo[k] -= eps
+        fd = (gram(data, *hi) - gram(data, *lo)) / (2*eps)
+        assert np.allclose(dK[k], fd, atol=1e-6)
+    print '  %dD: ok' % dim
+
+
+print '\n--lower triangle--------------------\n'
+for dim, theta in [ (1, (1, 1, 10)), (2, (1, 2, 1, .5, 10)), (3, (1, 1, 2, 1, .3, 0, .2, 10)) ]:
+    gram = getattr(gram_matrix, 'gram_matrix_sq_exp_%dD' % dim)
+    data = np.random.randn(*((300,) if dim == 1 else (300, dim)))
+
+    G = gram(data, *theta)
+    L = gram(data, *theta, lower_only=True)
+    assert (G == G.T).all()
+    assert (np.tril(G) == L).all()
+    print '  %dD: ok' % dim
+
+
+print '\n--threads--------------------\n'
+assert gram_matrix.get_num_threads() == 1
+for dim, theta in [ (1, (1, 1, 10)), (2, (1, 2, 1, .5, 10)), (3, (1, 1, 2, 1, .3, 0, .2, 10)) ]:
+    gram = getattr(gram_matrix, 'gram_matrix_sq_exp_%dD' % dim)
+    data = np.random.randn(*((501,) if dim == 1 else (501, dim)))
+
+    G, L = gram(data, *theta), gram(data, *theta, lower_only=True)
+    gram_matrix.set_num_threads(4)
+    assert gram_matrix.get_num_threads() == 4
+    assert (gram(data, *theta) == G).all()
+    assert (gram(data, *theta, lower_only=True) == L).all()
+    gram_matrix.set_num_threads(1)
+    assert gram_matrix.get_num_threads() == 1
+    print '  %dD: ok' % dim
@@ -0,0 +1,69 @@
+import os
+import sys
+import numpy as np
+from time import time
+
+# runs from gp/, like the tests here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gp import GaussianProcess, SparseGaussianProcess, sqexp3D_covariancef, select_inducing_points
+
+
+def undistortion(X):
+    """
+    A synthetic x-component of the undistortion over (x, y, zoom):
+    radial distortion whose strength changes with the zoom setting
+    """
+    x, y, z = (X[:,0] - 2000) / 2000., (X[:,1] - 1500) / 2000., X[:,2]
+    k1 = -8. + 6*np.tanh((z - 500) / 300.)
+    return k1 * x * (x*x + y*y)
+
+
+def samples(N, noise=0.05):
+    X = np.random.uniform(0, 1, (N, 3)) * [ 4000, 3000, 1000 ]
+    return X, undistortion(X) + noise*np.random.randn(N)
+
+
+np.set_printoptions(precision=4, suppress=True)
+np.random.seed(0)
+
+# length-scales in pixels and zoom steps
+theta = np.array([ 3., 800, 800, 300, 0, 0, 0, 20. ])
+X_test, _ = samples(2000)
+t_test = undistortion(X_test)
+
+print '\n--fixed hyper-parameters--------------------\n'
+print '  %6s %6s %12s %12s %10s %14s' % ('N', 'M', 'evidence', 'time', 'rmse', 'vs. exact')
+for N in [ 500, 1000, 2000, 4000, 20000, 50000 ]:
+    X, t = samples(N)
+
+    exact_mean = None
+    if N <= 4000:
+        t0 = time()
+        gp = GaussianProcess(X, t, sqexp3D_covariancef(theta))
+        evidence = gp.model_evidence()
+        exact_mean = gp.predict(X_test)
+        print '  %6d %6s %12.2f %11.4fs %10.4f' % (
+            N, 'exact', evidence, time()-t0, np.sqrt(np.mean((exact_mean - t_test)**2)))
+
+    for M in [ 64, 256 ]:
+        t0 = time()
+        Z = select_inducing_points(X, M)
+        gp = SparseGaussianProcess(X, t, sqexp3D_covariancef(theta), inducing=Z)
+        evidence = gp.model_evidence()
+        mean = gp.predict(X_test)
+        print '  %6d %6d %12.2f %11.4fs %10.4f %14s' % (
+            N, M, evidence, time()-t0, np.sqrt(np.mean((mean - t_test)**2)),
+            '%.4f' % np.sqrt(np.mean((mean - exact_mean)**2)) if exact_mean is not None else '')
+
+
+print '\n--fit--------------------\n'
+X, t = samples(20000)
+theta0 = np.array([ t.std(), 1000, 1000, 500, 0, 0, 0, 10. ])
+for M in [ 128 ]:
+    t0 = time()
+    gp = SparseGaussianProcess.fit(X, t, sqexp3D_covariancef, theta0,
+            inducing=select_inducing_points(X, M))
+    mean = gp.predict(X_test)
+    print '  N=%d, M=%d: %.2fs, %d evaluations, rmse %.4f' % (
+        len(X), M, time()-t0, gp.fit_result.nfev, np.sqrt(np.mean((mean - t_test)**2)))
+    print '    theta:', gp._covf.theta
@@ -3,16 +3,22 @@
 import numpy as np
 from math import sqrt
 import os.path
+import sys
+import signal
+import traceback
+from glob import glob
+from time import time
+from Queue import Queue, Empty
+from cStringIO import StringIO
+from multiprocessing import Pool, cpu_count
 from skimage.io import imread
 from skimage.color import rgb2gray
-from skimage.transform import rescale as imrescale
 from skimage.util import img_as_ubyte
-from scipy.optimize import minimize
-from sklearn.cross_validation import LeaveOneOut
 
-from apriltag import AprilTagDetector
+from apriltag import get_detector
 from tag36h11_mosaic import TagMosaic
 from projective_math import WeightedLocalHomography, SqExpWeightingFunction
+from projective_math import LocalHomographyLOOCV
 from tupletypes import Correspondence, WorldImageHomographyInfo
 
 
@@ -26,60 +32,31 @@ def create_local_homography_object(bandwidth, magnitude, lambda_):
     return H
 
 
-def local_homography_error(theta, t_src, t_tgt, v_src, v_tgt):
-    """
-    This is the objective function used for optimizing parameters of
-    the `SqExpWeightingFunction` used for local homography fitting
-
-    Parameters:
-    -----------
-       `theta` = [ `bandwidth`, `magnitude`, `lambda_` ]:
-            parameters of the `SqExpWeightingFunction`
-
-    Arguments:
-    -----------
-        `t_src`: list of training source points
-        `t_tgt`: list of training target points
-        `v_src`: list of validation source points
-        `v_tgt`: list of validation target points
-    """
-    H = create_local_homography_object(*theta)
-    for s, t in zip(t_src, t_tgt):
-        H.add_correspondence(s, t)
+# Parameters of the detector used by `get_tag_detections`
+DETECTOR_PARAMS = dict(profile='throughput')
 
-    v_mapped = np.array([ H.map(s)[:2] for s in v_src ])
-    return ((v_mapped - v_tgt)**2).sum(axis=1).mean()
+# The same for the worker processes of `process_batch`, where the cpus
+# are shared between the processes rather than between detector threads
+WORKER_DETECTOR_PARAMS = dict(DETECTOR_PARAMS, n_threads=1)
 
 
-def get_tag_detections(im):
+def get_tag_detections(im, detector_params=DETECTOR_PARAMS, as_array=False):
     #
     # Because of a bug in the tag detector, it doesn't seem
     # to detect tags larger than a certain size. To work-around
-    # this limitation, we detect tags on two different image
-    # scales and use the one with more detections
+    # this limitation, we detect tags on a pyramid of coarser
+    # image scales and re-localize them at full resolution
+    #
+    # Returns a list of AprilTagDetection, or with `as_array` a
+    # structured array of detections (see apriltag.DETECTION_DTYPE)
     #
     assert len(im.shape) == 2
-    im4 = imrescale(im, 1./4)
-
-    im  = img_as_ubyte(im)
-    im4 = img_as_ubyte(im4)
+    im = img_as_ubyte(im)
 
-    detections1 = AprilTagDetector().detect(im)
-    detections4 = AprilTagDetector().detect(im4)
-    for d in detections4:
-        d.c[0] *= 4.
-        d.c[1] *= 4.
+    return get_detector(**detector_params).detect_multiscale(im, as_array=as_array)
 
-    # note that everything other than the tag center is wrong
-    # in detections4
 
-    if len(detections4) > len(detections1):
-        return detections4
-    else:
-        return detections1
-
-
-def get_homography_model(filename):
+def get_homography_model(filename, detector_params=DETECTOR_PARAMS):
     #
     # Conventions:
     # a_i, b_i
@@ -94,22 +71,20 @@ def get_homography_model(filename):
     im  = imread(filename)
     im  = rgb2gray(im)
 
-    detections = get_tag_detections(im)
+    detections = get_tag_detections(im, detector_params, as_array=True)
     print '  %d tags detected.' % len(detections)
 
     #
     # Sort detections by distance to center
     #
     c_i = np.array([im.shape[1], im.shape[0]]) / 2.
-    dist = lambda p_i: np.linalg.norm(p_i - c_i)
-    closer_to_center = lambda d1, d2: int(dist(d1.c) - dist(d2.c))
-    detections.sort(cmp=closer_to_center)
+    dist = np.sqrt(((detections['c'] - c_i)**2).sum(axis=1))
+    detections = detections[np.argsort(dist, kind='mergesort')]
 
     tag_mosaic = TagMosaic(0.0254)
-    mosaic_pos = lambda det: tag_mosaic.get_position_meters(det.id)
 
-    det_i = np.array([ d.c for d in detections ])
-    det_w = np.array([ mosaic_pos(d) for d in detections ])
+    det_i = detections['c']
+    det_w = np.array([ tag_mosaic.get_position_meters(id_) for id_ in detections['id'] ])
 
     #
     # To learn a weighted local homography, we find the weighting
@@ -121,18 +96,8 @@ def get_homography_model(filename):
     det_i9 = det_i[:9]
     det_w9 = det_w[:9]
 
-    def local_homography_loocv_error(theta, args):
-        src, tgt = args
-        errs = [ local_homography_error(theta, src[t_ix], tgt[t_ix], src[v_ix], tgt[v_ix])
-                    for t_ix, v_ix in LeaveOneOut(len(src)) ]
-        return np.mean(errs)
-
     def learn_homography_i2w():
-        result = minimize( local_homography_loocv_error,
-                    x0=[ 50, 1, 1e-3 ],
-                    args=[ det_i9, det_w9 ],
-                    method='Powell',
-                    options={'ftol': 1e-3} )
+        result = LocalHomographyLOOCV(det_i9, det_w9).fit([ 50, 1, 1e-3 ])
 
         print '\nHomography: i->w'
         print '------------------'
@@ -148,11 +113,7 @@ def get_homography_model(filename):
         return H
 
     def learn_homography_w2i():
-        result = minimize( local_homography_loocv_error,
-                    x0=[ 0.0254, 1, 1e-3 ],
-                    method='Powell',
-                    args=[ det_w9, det_i9 ],
-                    options={'ftol': 1e-3} )
+        result = LocalHomographyLOOCV(det_w9, det_i9).fit([ 0.0254, 1, 1e-3 ])
 
         print '\nHomography: w->i'
         print '------------------'
@@ -196,18 +157,160 @@ def get_homography_model(filename):
     return corrs, WorldImageHomographyInfo(H_wi, c_w, c_i)
 
 
+def save_homography_model(filename, corrs, model):
+    import cPickle as pickle
+
+    filestem = os.path.splitext(filename)[0]
+    with open(filestem + '.lh0', 'w') as f:
+        pickle.dump(model, f)
+    with open(filestem + '.corrs', 'w') as f:
+        pickle.dump(corrs, f)
+
+
+def expand_filenames(args):
+    """
+    Image files named by `args`, each of which is a file, a glob
+    pattern, or a folder to search for .png files
+    """
+    filenames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, _, files in sorted(os.walk(arg)):
+                filenames += [ os.path.join(root, f) for f in sorted(files) if f.endswith('.png') ]
+        elif any(c in arg for c in '*?['):
+            filenames += sorted(glob(arg))
+        else:
+            filenames.append(arg)
+    return filenames
+
+
+def init_worker():
+    """
+    Runs once in each worker process. The detector is created up front
+    and reused for every image. Ctrl-C is left to the parent, which
+    terminates the pool.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_detector(**WORKER_DETECTOR_PARAMS)
+
+
+def process_image(filename, detector_params=WORKER_DETECTOR_PARAMS):
+    """
+    Learn and save the homography model of `filename`. Returns the
+    filename, the number of tags, the time taken, everything printed
+    along the way, and the traceback if it failed.
+    """
+    stdout, sys.stdout = sys.stdout, StringIO()
+    t0 = time()
+    try:
+        corrs, model = get_homography_model(filename, detector_params)
+        save_homography_model(filename, corrs, model)
+        ntags, error = len(corrs), None
+    except Exception:
+        ntags, error = 0, traceback.format_exc()
+    except BaseException:
+        # e.g. KeyboardInterrupt or SystemExit: not a failure of this
+        # image, so let it through, but with stdout put back first
+        sys.stdout = stdout
+        raise
+
+    log, sys.stdout = sys.stdout.getvalue(), stdout
+    return filename, ntags, time() - t0, log, error
+
+
+def worker_pids(pool):
+    """ Process ids of the current workers of `pool` """
+    return set(p.pid for p in pool._pool)
+
+
+def process_batch(filenames, processes=None, verbose=False):
+    """
+    Run `process_image` on each of `filenames` across a pool of
+    `processes` workers (default: one per cpu). Results are printed as
+    they come in; a failed image is reported and skipped. Returns the
+    filenames that failed.
+
+    A worker process that dies (e.g. crashes in the C detector) takes
+    its image with it, and the pool would wait for it forever. When
+    that happens, the images without a result are reported as failed
+    and the pool is shut down.
+    """
+    processes = processes or cpu_count()
+    pool = Pool(min(processes, len(filenames)) or 1, init_worker)
+
+    workers = worker_pids(pool)
+
+    done = Queue()
+    for k, filename in enumerate(filenames):
+        pool.apply_async(process_image, (filename,), callback=lambda r, k=k: done.put((k, r)))
+
+    failed, pending = [], set(xrange(len(filenames)))
+    t0 = time()
+    try:
+        while pending:
+            try:
+                k, (filename, ntags, seconds, log, error) = done.get(timeout=1.)
+            except Empty:
+                # the pool replaces workers that died
+                if worker_pids(pool) != workers:
+                    break
+                continue
+
+            pending.discard(k)
+            status = 'FAILED' if error else '%d tags' % ntags
+            print '  [%d/%d] %7.2fs  %-10s %s' % (
+                len(filenames) - len(pending), len(filenames), seconds, status, filename)
+            if verbose:
+                print log
+            if error:
+                print '    ' + error.strip().replace('\n', '\n    ')
+                failed.append(filename)
+            sys.stdout.flush()
+
+        if pending:
+            print '\n  A worker process died; %d images were not processed:' % len(pending)
+            for k in sorted(pending):
+                print '    ' + filenames[k]
+                failed.append(filenames[k])
+            pool.terminate()
+        else:
+            pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    print '\n  %d images in %.2fs, %d failed' % (len(filenames), time() - t0, len(failed))
+    return failed
+
+
 def main():
+    """
+    usage: homography_at_center.py [-j N] [-v] (image | glob | folder) ...
+    """
     np.set_printoptions(precision=4, suppress=True)
-    import sys
-    import cPickle as pickle
 
-    for filename in sys.argv[1:]:
-        corrs, model = get_homography_model(filename)
-        filestem = os.path.splitext(filename)[0]
-        with open(filestem + '.lh0', 'w') as f:
-            pickle.dump(model, f)
-        with open(filestem + '.corrs', 'w') as f:
-            pickle.dump(corrs, f)
+    args = sys.argv[1:]
+    processes, verbose = None, False
+    while args and args[0].startswith('-'):
+        opt = args.pop(0)
+        if opt == '-j':
+            processes = int(args.pop(0))
+        elif opt == '-v':
+            verbose = True
+        else:
+            print main.__doc__
+            sys.exit(2)
+
+    filenames = expand_filenames(args)
+    if len(filenames) == 1:
+        corrs, model = get_homography_model(filenames[0])
+        save_homography_model(filenames[0], corrs, model)
+        return
+
+    failed = process_batch(filenames, processes, verbose)
+    sys.exit(1 if failed else 0)
 
 if __name__ == '__main__':
     main()
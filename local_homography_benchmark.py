@@ -0,0 +1,49 @@
+#! /usr/bin/python
+
+import sys
+import numpy as np
+import cPickle as pickle
+from time import time
+from projective_math import LocalHomographyLOOCV
+
+
+def load_correspondences():
+    """
+    9 correspondences nearest the image center from each `.corrs` file
+    given on the command line (see homography_at_center.py), or from a
+    synthetic capture if there are none
+    """
+    if len(sys.argv) > 1:
+        for filename in sys.argv[1:]:
+            with open(filename) as f:
+                corrs = pickle.load(f)[:9]
+            yield filename, np.array([ c.source for c in corrs ]), np.array([ c.target for c in corrs ])
+        return
+
+    H = np.array([ [ 4e4, 300., 2000. ], [ -200., 4e4, 1500. ], [ .5, .2, 1. ] ])
+    for k in xrange(3):
+        w = 0.0254 * np.array([ [ x, y ] for x in (-1, 0, 1) for y in (-1, 0, 1) ])
+        w += 1e-4 * np.random.randn(*w.shape)
+        m = np.column_stack([ w, np.ones(len(w)) ]).dot(H.T)
+        i = m[:,:2] / m[:,2:] + 0.3 * np.random.randn(len(w), 2)
+        yield 'synthetic %d' % k, w, i
+
+
+def main():
+    print '\n  %-24s %-10s %8s %8s %10s' % ('capture', 'method', 'evals', 'time', 'rmse')
+
+    for name, det_w, det_i in load_correspondences():
+        for title, src, tgt, x0 in [ ('i->w', det_i, det_w, [ 50, 1, 1e-3 ]),
+                                     ('w->i', det_w, det_i, [ 0.0254, 1, 1e-3 ]) ]:
+            loocv = LocalHomographyLOOCV(src, tgt)
+            for method in [ 'Powell', 'BFGS', 'L-BFGS-B' ]:
+                t0 = time()
+                result = loocv.fit(x0, method=method)
+                t = time() - t0
+
+                print '  %-24s %-10s %8d %7.4fs %10.6f' % (
+                    name[-19:] + ' ' + title, method, result.nfev, t, np.sqrt(result.fun))
+
+
+if __name__ == '__main__':
+    main()
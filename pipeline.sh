@@ -18,7 +18,7 @@ rsync -az --ignore-times --delete --exclude pipeline.sh rpradeep@rpradeep.webhop
 echo ''
 echo -e '\033[1;33m//  Homography at center  //'
 echo -e '\033[0m'
-parallel -X ./homography_at_center.py ::: $FOLDER/*/pose*.png
+./homography_at_center.py "$FOLDER/*/pose*.png"
 
 echo ''
 echo -e '\033[1;33m//  Refine homographies   //'
@@ -7,6 +7,9 @@ class UnitWeightingFunction(object):
     def __call__(self, p, q):
         return 1
 
+    def pairwise(self, P, Q):
+        return np.ones((len(P), len(Q)))
+
 
 class SqExpWeightingFunction(object):
     def __init__(self, bandwidth, magnitude=1.):
@@ -17,6 +20,11 @@ class SqExpWeightingFunction(object):
         z = np.subtract(p, q) / self._tau
         return self._nu*self._nu * np.exp(-(z*z).sum())
 
+    def pairwise(self, P, Q):
+        """ (M, N) matrix of weights between points `P` and `Q` """
+        Z = (np.asarray(P, dtype=np.float)[:,None,:] - np.asarray(Q, dtype=np.float)[None,:,:]) / self._tau
+        return self._nu*self._nu * np.exp(-(Z*Z).sum(axis=2))
+
 
 def _normalization_transform(points):
     muX, muY = np.mean(points, axis=0)
@@ -44,11 +52,18 @@ def _homogeneous_coords(p):
 #--------------------------------------
 class WeightedLocalHomography(object):
 #--------------------------------------
-    def __init__(self, wfunc=UnitWeightingFunction()):
+    # How local homographies are solved for:
+    #   'eigh': eigen-decomposition of the weighted 9x9 scatter matrix,
+    #           a weighted sum of per-correspondence scatter matrices
+    #   'svd':  SVD of the weighted 2Nx9 constraint matrix
+    solver = 'eigh'
+
+    def __init__(self, wfunc=UnitWeightingFunction(), solver='eigh'):
         self._corrs = []
         self.regularization_lambda = 0
         self._weighting_func = wfunc
         self._precompute_done = False
+        self.solver = solver
 
 
     def add_correspondence(self, source_xy, target_xy):
@@ -60,7 +75,7 @@ class WeightedLocalHomography(object):
     def _precompute(self):
         """ Precompute normalization transforms and constraint
         matrix. These remain the same for every homography query """
-        if self._precompute_done == True:
+        if self._precompute_done == True and hasattr(self, '_scatter_matrices'):
             return
 
         self._srcX, _             = _normalization_transform([ c.source for c in self._corrs ])
@@ -75,6 +90,12 @@ class WeightedLocalHomography(object):
             constraints.append( [0, 0, 0, -x, -y, -1, j*x, j*y, j] )
 
         self.constraint_matrix = np.array(constraints, dtype=np.float)
+
+        # A^T W A = sum_k w_k (a_k a_k^T + b_k b_k^T), where a_k and b_k are
+        # the two constraint rows of correspondence k. Kept as (N, 81)
+        A = self.constraint_matrix.reshape((-1, 2, 9))
+        self._scatter_matrices = np.einsum('nri,nrj->nij', A, A).reshape((-1, 81))
+
         self._precompute_done = True
 
 
@@ -84,29 +105,58 @@ class WeightedLocalHomography(object):
 
     def get_correspondence_weights(self, src_pt):
         """ How similar is `src_pt` to each source point in `self._corrs` """
-        return [ self.regularized_weighting_function(src_pt, c.source) for c in self._corrs ]
+        return self.get_correspondence_weights_many([ src_pt ])[0]
+
+
+    def get_correspondence_weights_many(self, src_pts):
+        """ (M, N) matrix of `get_correspondence_weights` for each of
+        the M points in `src_pts` """
+        src_pts = np.asarray(src_pts, dtype=np.float)[:,:2]
+        sources = np.array([ c.source for c in self._corrs ], dtype=np.float)
+
+        if hasattr(self._weighting_func, 'pairwise'):
+            W = self._weighting_func.pairwise(src_pts, sources)
+        else:
+            W = np.array([ [ self._weighting_func(p, q) for q in sources ] for p in src_pts ])
+
+        return W + self.regularization_lambda**2
 
 
     def get_homography_at(self, src_pt):
+        return self.get_homographies_at([ src_pt ])[0]
+
+
+    def get_homographies_at(self, src_pts, chunk_size=1024):
+        """ (M, 3, 3) stack of the local homographies at each of the M
+        points in `src_pts`. Points are processed `chunk_size` at a
+        time to bound the size of the weighted constraint matrices """
         self._precompute()
 
         A = self.constraint_matrix
+        src_pts = np.asarray(src_pts, dtype=np.float)
+
+        Hs = np.empty((len(src_pts), 3, 3))
+        for i in xrange(0, len(src_pts), chunk_size):
+            w = self.get_correspondence_weights_many(src_pts[i:i+chunk_size])
 
-        # The weighting is a diagonal matrix that encodes how similar
-        # `src_pt` is to each source point in `self._corrs`
-        w_diag = self.get_correspondence_weights(src_pt)
+            # Homography is the total least squares solution: The eigen-vector
+            # corresponding to the smallest eigen-value of A^T W A
+            if self.solver == 'eigh':
+                S = w.dot(self._scatter_matrices).reshape((-1, 9, 9))
+                _, V = np.linalg.eigh(S)
+                Hs[i:i+chunk_size] = V[:,:,0].reshape((-1, 3, 3))
 
-        # Each correspondence produces 2 constraints. So weights also
-        # need to be repeated
-        W = np.diag(np.sqrt(np.repeat(w_diag, 2)))
-        assert len(A) == len(W)
+            elif self.solver == 'svd':
+                # Each correspondence produces 2 constraints, whose rows are
+                # scaled by the square root of its weight
+                WA = np.repeat(np.sqrt(w), 2, axis=1)[:,:,None] * A[None,:,:]
+                U, s, Vt = np.linalg.svd(WA, full_matrices=False)
+                Hs[i:i+chunk_size] = Vt[:,-1,:].reshape((-1, 3, 3))
 
-        # Homography is the total least squares solution: The eigen-vector
-        # corresponding to the smallest eigen-value
-        U, s, Vt = np.linalg.svd(W.dot(A))
-        H = Vt.T[:,-1].reshape((3,3))
+            else:
+                raise Exception('Unknown local homography solver: ' + self.solver)
 
-        return reduce(np.dot, [self._tgtXinv, H, self._srcX])
+        return np.matmul(np.matmul(self._tgtXinv, Hs), self._srcX)
 
 
     def map(self, src_pt):
@@ -115,3 +165,245 @@ class WeightedLocalHomography(object):
         m = self.get_homography_at(src_pt).dot(_homogeneous_coords(src_pt))
         m /= m[2]
         return m
+
+
+    def map_many(self, src_pts):
+        """ Map each of the M points in `src_pts` to the target plane
+        using the local homography at that point. Returns an (M, 2)
+        array """
+        src_pts = np.asarray(src_pts, dtype=np.float)[:,:2]
+        Hs = self.get_homographies_at(src_pts)
+
+        m = np.matmul(Hs[:,:,:2], src_pts[:,:,None])[:,:,0] + Hs[:,:,2]
+        return m[:,:2] / m[:,2:]
+
+
+#--------------------------------------
+class LocalHomographyLOOCV(object):
+#--------------------------------------
+    """
+    Leave-one-out cross-validation error of a WeightedLocalHomography
+    with a `SqExpWeightingFunction`, as a function of its parameters.
+
+    Normalization and constraints are computed once from all
+    correspondences. Leaving out correspondence k removes its two
+    constraint rows, i.e. subtracts its weighted scatter matrix from the
+    9x9 scatter matrix at the validation point, so all folds are solved
+    together with one batched eigen-decomposition.
+    """
+    def __init__(self, sources, targets):
+        self._H = WeightedLocalHomography()
+        for s, t in zip(sources, targets):
+            self._H.add_correspondence(s, t)
+        self._H._precompute()
+
+        self._sources = np.asarray(sources, dtype=np.float)
+        self._targets = np.asarray(targets, dtype=np.float)
+
+
+    def fold_errors(self, bandwidth, magnitude, lambda_, grad=False):
+        """ Squared error of each left out correspondence. With `grad`,
+        also returns their (N, 3) gradients with respect to
+        (`bandwidth`, `magnitude`, `lambda_`) """
+        H = self._H
+        N = len(self._sources)
+
+        D2 = ((self._sources[:,None,:] - self._sources[None,:,:])**2).sum(axis=2)
+        E = np.exp(-D2 / (bandwidth*bandwidth))
+        E[np.diag_indices(N)] = 0.
+        offdiag = 1. - np.eye(N)
+
+        W = magnitude*magnitude*E + lambda_*lambda_*offdiag
+        S = W.dot(H._scatter_matrices).reshape((N, 9, 9))
+        evals, V = np.linalg.eigh(S)
+        v = V[:,:,0]
+
+        # u = srcX * s, m = tgtXinv * Hn * u
+        u = np.column_stack([ self._sources, np.ones(N) ]).dot(H._srcX.T)
+        Hn = v.reshape((N, 3, 3))
+        m = np.matmul(Hn, u[:,:,None])[:,:,0].dot(H._tgtXinv.T)
+        mapped = m[:,:2] / m[:,2:]
+        r = mapped - self._targets
+        errs = (r*r).sum(axis=1)
+
+        if not grad:
+            return errs
+
+        # derivatives of the weights, one (N, N) matrix per parameter
+        dW = np.array([ magnitude*magnitude*E * 2*D2 / bandwidth**3,
+                        2*magnitude*E,
+                        2*lambda_*offdiag ])
+        dS = np.einsum('pfk,kij->pfij', dW, H._scatter_matrices.reshape((N, 9, 9)))
+
+        # first order perturbation of the smallest eigenvector:
+        #   dv = sum_{i>0} v_i (v_i^T dS v) / (l_0 - l_i)
+        gap = evals[:,:1] - evals[:,1:]
+        proj = np.einsum('fia,pfij,fj->pfa', V[:,:,1:], dS, v)
+        dv = np.einsum('fia,pfa->pfi', V[:,:,1:], proj / gap[None])
+
+        dHn = dv.reshape((3, N, 3, 3))
+        dm = np.einsum('pfij,fj->pfi', dHn, u).dot(H._tgtXinv.T)
+        dmapped = (dm[:,:,:2] - mapped[None]*dm[:,:,2:]) / m[None,:,2:]
+        derrs = 2*(r[None]*dmapped).sum(axis=2)
+
+        return errs, derrs.T
+
+
+    def error(self, theta):
+        """ Mean squared LOOCV error for `theta` = [ `bandwidth`,
+        `magnitude`, `lambda_` ] """
+        return self.fold_errors(*theta).mean()
+
+
+    def error_and_grad(self, theta):
+        """ `error` and its gradient with respect to `theta` """
+        errs, derrs = self.fold_errors(*theta, grad=True)
+        return errs.mean(), derrs.mean(axis=0)
+
+
+    def fit(self, theta0, method='BFGS', options=None):
+        """ Minimize the LOOCV error starting from `theta0`. `method` is
+        passed to `scipy.optimize.minimize`; quasi-Newton methods (e.g.
+        'BFGS', 'L-BFGS-B') use the analytic gradient, 'Powell' does not """
+        from scipy.optimize import minimize
+
+        if method == 'Powell':
+            return minimize(self.error, x0=theta0, method=method,
+                            options=options or {'ftol': 1e-3})
+
+        # The parameters and the error have very different magnitudes
+        # (pixels or meters, squared), so optimize relative to `theta0`
+        # and to the error there
+        theta0 = np.asarray(theta0, dtype=np.float)
+        scale = np.where(theta0 != 0, np.abs(theta0), 1.)
+        err0 = self.error(theta0) or 1.
+
+        def scaled_error_and_grad(x):
+            err, grad = self.error_and_grad(x * scale)
+            return err / err0, grad * scale / err0
+
+        result = minimize(scaled_error_and_grad, x0=np.ones(len(theta0)),
+                          method=method, jac=True, options=options)
+        result.x = result.x * scale
+        result.fun = result.fun * err0
+        result.jac = result.jac * err0 / scale
+        return result
+
+
+#--------------------------------------
+class HomographyField(object):
+#--------------------------------------
+    """
+    The local homographies of a WeightedLocalHomography, solved once on
+    a lattice of source points and bilinearly interpolated in between.
+
+    With a `tolerance` (in target units), the interpolated mapping is
+    checked against the exact one at the middle of each lattice cell.
+    The lattice is refined up to `max_refinements` times until all cells
+    pass; queries in cells that still fail, or outside `bounds`, are
+    solved exactly.
+
+    `bounds` (x0, y0, x1, y1) must have a positive extent in both x and
+    y, and `shape` at least two lattice points along each axis;
+    otherwise (e.g. for collinear source points) ValueError is raised.
+    """
+    def __init__(self, H, bounds=None, shape=(32, 32), tolerance=None, max_refinements=3):
+        self.H = H
+        self.tolerance = tolerance
+
+        if bounds is None:
+            sources = np.array([ c.source for c in H._corrs ], dtype=np.float)
+            bounds = np.r_[ sources.min(axis=0), sources.max(axis=0) ]
+        self.bounds = tuple(np.asarray(bounds, dtype=np.float))
+
+        x0, y0, x1, y1 = self.bounds
+        if not (x1 > x0 and y1 > y0):
+            raise ValueError("HomographyField bounds %s have no extent in x or y" % (self.bounds,))
+
+        ny, nx = shape
+        if ny < 2 or nx < 2:
+            raise ValueError("HomographyField shape %s needs at least 2x2 lattice points" % (shape,))
+        self._build(ny, nx)
+
+        for _ in xrange(max_refinements):
+            if tolerance is None or self.max_error <= tolerance:
+                break
+            self._build(2*ny - 1, 2*nx - 1)
+            ny, nx = self.shape
+
+
+    def _build(self, ny, nx):
+        x0, y0, x1, y1 = self.bounds
+        self.shape = (ny, nx)
+        self._xs = np.linspace(x0, x1, nx)
+        self._ys = np.linspace(y0, y1, ny)
+
+        X, Y = np.meshgrid(self._xs, self._ys)
+        lattice = np.column_stack([ X.ravel(), Y.ravel() ])
+        Hs = self.H.get_homographies_at(lattice)
+        self._lattice = (Hs / Hs[:,2:,2:]).reshape((ny, nx, 3, 3))
+
+        self._exact_cells = np.zeros((ny-1, nx-1), dtype=bool)
+        self.max_error = 0.
+        if self.tolerance is None:
+            return
+
+        # cell midpoints
+        X, Y = np.meshgrid(.5*(self._xs[1:] + self._xs[:-1]), .5*(self._ys[1:] + self._ys[:-1]))
+        mid = np.column_stack([ X.ravel(), Y.ravel() ])
+        err = np.sqrt(((self.H.map_many(mid) - self.map_many(mid))**2).sum(axis=1))
+
+        self.max_error = err.max()
+        self._exact_cells = (err > self.tolerance).reshape((ny-1, nx-1))
+
+
+    def _locate(self, pts):
+        """ Lattice cell of each point, the position within the cell,
+        and whether the cell can be interpolated """
+        x0, y0, x1, y1 = self.bounds
+        ny, nx = self.shape
+
+        fx = (pts[:,0] - x0) / (x1 - x0) * (nx - 1)
+        fy = (pts[:,1] - y0) / (y1 - y0) * (ny - 1)
+        i = np.clip(np.floor(fx).astype(np.int), 0, nx-2)
+        j = np.clip(np.floor(fy).astype(np.int), 0, ny-2)
+
+        inside = (fx >= 0) & (fx <= nx-1) & (fy >= 0) & (fy <= ny-1)
+        ok = inside & ~self._exact_cells[j,i]
+        return i, j, fx - i, fy - j, ok
+
+
+    def get_homographies_at(self, src_pts):
+        """ (M, 3, 3) stack of the local homographies at `src_pts` """
+        src_pts = np.asarray(src_pts, dtype=np.float)[:,:2]
+        i, j, tx, ty, ok = self._locate(src_pts)
+
+        G = self._lattice
+        tx, ty = tx[:,None,None], ty[:,None,None]
+        Hs = (G[j,i]*(1-tx)*(1-ty) + G[j,i+1]*tx*(1-ty) +
+              G[j+1,i]*(1-tx)*ty + G[j+1,i+1]*tx*ty)
+
+        if not ok.all():
+            Hs[~ok] = self.H.get_homographies_at(src_pts[~ok])
+
+        return Hs
+
+
+    def get_homography_at(self, src_pt):
+        return self.get_homographies_at([ src_pt ])[0]
+
+
+    def map(self, src_pt):
+        m = self.get_homography_at(src_pt).dot(_homogeneous_coords(src_pt))
+        m /= m[2]
+        return m
+
+
+    def map_many(self, src_pts):
+        """ Map each of the M points in `src_pts` to the target
+        plane. Returns an (M, 2) array """
+        src_pts = np.asarray(src_pts, dtype=np.float)[:,:2]
+        Hs = self.get_homographies_at(src_pts)
+
+        m = np.matmul(Hs[:,:,:2], src_pts[:,:,None])[:,:,0] + Hs[:,:,2]
+        return m[:,:2] / m[:,2:]
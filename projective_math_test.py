@@ -0,0 +1,141 @@
+import numpy as np
+from time import time
+from projective_math import WeightedLocalHomography, SqExpWeightingFunction
+from projective_math import HomographyField, LocalHomographyLOOCV
+
+
+def random_correspondences(N, noise=0.5):
+    """ `N` noisy correspondences under a random homography """
+    H = np.eye(3) + np.random.randn(3,3) * [ [.1, .1, 10], [.1, .1, 10], [1e-4, 1e-4, 0] ]
+    src = np.random.uniform(0, 1000, (N, 2))
+    tgt = np.array([ H.dot([x, y, 1.]) for x, y in src ])
+    tgt = tgt[:,:2] / tgt[:,2:] + noise*np.random.randn(N, 2)
+    return src, tgt
+
+
+def create_local_homography(src, tgt, solver):
+    H = WeightedLocalHomography(SqExpWeightingFunction(bandwidth=300.), solver=solver)
+    H.regularization_lambda = 1e-3
+    for s, t in zip(src, tgt):
+        H.add_correspondence(s, t)
+    return H
+
+
+def same_homographies(A, B):
+    """ Equal up to scale and sign """
+    A = A.reshape((-1, 9)) / np.sqrt((A.reshape((-1, 9))**2).sum(axis=1))[:,None]
+    B = B.reshape((-1, 9)) / np.sqrt((B.reshape((-1, 9))**2).sum(axis=1))[:,None]
+    return np.allclose(np.abs((A*B).sum(axis=1)), 1.)
+
+
+np.set_printoptions(precision=4, suppress=True)
+
+
+for N in [ 9, 50, 500 ]:
+    print '\n--N=%d--------------------\n' % N
+    src, tgt = random_correspondences(N)
+    queries = np.random.uniform(0, 1000, (2000, 2))
+
+    H_svd = create_local_homography(src, tgt, 'svd')
+    H_eigh = create_local_homography(src, tgt, 'eigh')
+
+    t0 = time()
+    Hs_svd = H_svd.get_homographies_at(queries)
+    print '   svd: %.4fs' % (time()-t0)
+
+    t0 = time()
+    Hs_eigh = H_eigh.get_homographies_at(queries)
+    print '  eigh: %.4fs' % (time()-t0)
+
+    assert same_homographies(Hs_svd, Hs_eigh)
+    assert np.allclose(H_svd.map_many(queries), H_eigh.map_many(queries))
+    assert np.allclose(H_svd.map(queries[0]), H_eigh.map(queries[0]))
+
+
+print '\n--HomographyField--------------------\n'
+src, tgt = random_correspondences(50)
+H = create_local_homography(src, tgt, 'eigh')
+queries = np.random.uniform(src.min(), src.max(), (20000, 2))
+
+t0 = time()
+field = HomographyField(H, tolerance=1e-3)
+print '  build: %.4fs (%dx%d lattice, max error %.2g)' % ((time()-t0,) + field.shape + (field.max_error,))
+
+t0 = time()
+exact = H.map_many(queries)
+print '  exact: %.4fs' % (time()-t0)
+
+t0 = time()
+interpolated = field.map_many(queries)
+print '  field: %.4fs' % (time()-t0)
+
+err = np.sqrt(((exact - interpolated)**2).sum(axis=1))
+print '  error: %.2g max, %.2g mean' % (err.max(), err.mean())
+assert err.max() < 1e-2
+
+# outside of the lattice, points are mapped exactly
+outside = np.array([ [-500., -500.], [2000., 100.] ])
+assert np.allclose(field.map_many(outside), H.map_many(outside))
+
+# a lattice needs an extent in both x and y
+for bounds, shape in [ ((0., 0., 0., 100.), (32, 32)), ((0., 5., 100., 5.), (32, 32)),
+                       ((0., 0., 100., 100.), (1, 32)) ]:
+    try:
+        HomographyField(H, bounds=bounds, shape=shape)
+        assert False, bounds
+    except ValueError:
+        pass
+
+
+print '\n--LocalHomographyLOOCV--------------------\n'
+np.random.seed(0)
+src, tgt = random_correspondences(9)
+theta = [ 300., 1., 1e-3 ]
+
+def reference_fold_errors(theta):
+    """ One WeightedLocalHomography per fold, normalized like the
+    shared constraints of LocalHomographyLOOCV """
+    errs = []
+    for k in xrange(len(src)):
+        H = create_local_homography(src, tgt, 'svd')
+        H._weighting_func = SqExpWeightingFunction(theta[0], theta[1])
+        H.regularization_lambda = theta[2]
+        H._precompute()
+
+        # drop the constraints of the left out correspondence, but
+        # keep the normalization of all of them
+        w = H.get_correspondence_weights(src[k])
+        w[k] = 0.
+        WA = np.repeat(np.sqrt(w), 2)[:,None] * H.constraint_matrix
+        Hk = np.linalg.svd(WA)[2][-1].reshape((3, 3))
+        Hk = H._tgtXinv.dot(Hk).dot(H._srcX)
+
+        m = Hk.dot([ src[k,0], src[k,1], 1. ])
+        errs.append(((m[:2] / m[2] - tgt[k])**2).sum())
+    return np.array(errs)
+
+t0 = time()
+reference = reference_fold_errors(theta)
+print '  per fold: %.4fs' % (time()-t0)
+
+loocv = LocalHomographyLOOCV(src, tgt)
+t0 = time()
+batched = loocv.fold_errors(*theta)
+print '   batched: %.4fs' % (time()-t0)
+
+assert np.allclose(reference, batched)
+assert np.allclose(loocv.error(theta), reference.mean())
+
+# analytic gradients against central differences
+for theta in [ [ 500., 1., 1e-2 ], [ 1500., 2., .5 ] ]:
+    err, grad = loocv.error_and_grad(theta)
+    fd = []
+    for i in xrange(3):
+        h = 1e-6 * max(1., abs(theta[i]))
+        tp, tm = list(theta), list(theta)
+        tp[i] += h
+        tm[i] -= h
+        fd.append((loocv.error(tp) - loocv.error(tm)) / (2*h))
+    print '  gradient:', grad
+    print '      f.d.:', np.array(fd)
+    assert np.allclose(grad, fd, rtol=1e-3, atol=1e-3*np.abs(fd).max())
@@ -3,16 +3,17 @@
 import os.path
 import numpy as np
 import cPickle as pickle
-from collections import OrderedDict
-from scipy.optimize import root
+from scipy.optimize import least_squares
 
 from projective_math import SqExpWeightingFunction
 from camera_math import estimate_intrinsics_noskew_assume_cxy
 from camera_math import estimate_intrinsics_noskew
 from camera_math import get_extrinsics_from_homography
 from camera_math import matrix_to_xyzrph, matrix_to_intrinsics
-from camera_math import xyzrph_to_matrix, intrinsics_to_matrix
 from tupletypes import WorldImageHomographyInfo
+import constraint_graph
+from constraint_graph import IntrinsicsNode, ExtrinsicsNode, HomographyConstraint
+from constraint_graph import WeightedPackedHomographyConstraints
 
 
 
@@ -60,159 +61,14 @@ class HomographyModel(object):
         return self.H0
 
 
-#-------------------------------------
-class IntrinsicsNode(object):
-#-------------------------------------
-    def __init__(self, fx, fy, cx, cy, tag):
-        self.fx = fx
-        self.fy = fy
-        self.cx = cx
-        self.cy = cy
-        self.tag = tag # convenient identification
-
-    def to_tuple(self):
-        return self.fx, self.fy, self.cx, self.cy
-
-    def set_value(self, *tupl):
-        self.fx = tupl[0]
-        self.fy = tupl[1]
-        self.cx = tupl[2]
-        self.cy = tupl[3]
-
-    def __repr__(self):
-        return repr(self.to_tuple())
-
-    def to_matrix(self):
-        return intrinsics_to_matrix(*self.to_tuple())
-
-
-#-------------------------------------
-class ExtrinsicsNode(object):
-#-------------------------------------
-    def __init__(self, x, y, z, r, p, h, tag):
-        self.x = x
-        self.y = y
-        self.z = z
-        self.r = r
-        self.p = p
-        self.h = h
-        self.tag = tag # convenient identification
-
-    def to_tuple(self):
-        return self.x, self.y, self.z, self.r, self.p, self.h
-
-    def set_value(self, *tupl):
-        self.x = tupl[0]
-        self.y = tupl[1]
-        self.z = tupl[2]
-        self.r = tupl[3]
-        self.p = tupl[4]
-        self.h = tupl[5]
-
-    def __repr__(self):
-        return repr(self.to_tuple())
-
-    def to_matrix(self):
-        return xyzrph_to_matrix(*self.to_tuple())
-
-
 #--------------------------------------
-class HomographyConstraint(object):
+class ConstraintGraph(constraint_graph.ConstraintGraph):
 #--------------------------------------
-    def __init__(self, hmodel, inode, enode):
-        H_wi, c_w, _ = hmodel.hinfo
-        weights = H_wi.get_correspondence_weights(c_w)
-
-        # 3-D homogeneous form with z=0
-        p_src = [ c.source for c in H_wi._corrs ]
-        N = len(p_src)
-        p_src = np.hstack([ p_src, np.zeros((N,1)), np.ones((N,1)) ])
-
-        self.p_src = p_src.T
-        self.p_tgt = np.array([ c.target for c in H_wi._corrs ]).T
-        self.W = np.diag(weights)
-        self.inode = inode
-        self.enode = enode
-
-    def sq_unweighted_reprojection_errors(self):
-        """
-        compute the geometric reprojection error of the world
-        points `self.p_w` through the homography described
-        the composition of intrinsics and extrinsics.
-        """
-        K = self.inode.to_matrix()
-        E = self.enode.to_matrix()
-        H = K.dot(E)
-
-        p_mapped = H.dot(self.p_src)[:3,:]
-
-        # normalize homogeneous coordinates
-        M = np.diag(1./p_mapped[2,:])
-        p_mapped = p_mapped[:2,:].dot(M)
-
-        return ((p_mapped - self.p_tgt)**2)
-
-
-    def sq_errors(self):
-        sqerr = self.sq_unweighted_reprojection_errors()
-        return sqerr.dot(self.W).ravel()
-
-
-#--------------------------------------
-class ConstraintGraph(object):
-#--------------------------------------
-    def __init__(self):
-        self.inodes = OrderedDict()
-        self.enodes = OrderedDict()
-        self.constraints = list()
-
-
-    def constraint_errors(self):
-        return np.hstack([ c.sq_errors() for c in self.constraints ])
-
-
-    def sq_pixel_errors(self):
-        homography_constraints = ( c for c in self.constraints if isinstance(c, HomographyConstraint) )
-        return np.hstack([ c.sq_unweighted_reprojection_errors() for c in homography_constraints ])
-
-
-    def _pack_into_vector(self):
-        """ pack node states into a vector """
-        istate = np.hstack([ i.to_tuple() for i in self.inodes.values() ])
-        estate = np.hstack([ e.to_tuple() for e in self.enodes.values() ])
-        return np.hstack(( istate, estate ))
-
-
-    def _unpack_from_vector(self, v):
-        """ Set node values from the vector `v` """
-        N = len(self.inodes)
-        istate = np.reshape(v[:4*N], (-1, 4))
-        estate = np.reshape(v[4*N:], (-1, 6))
-
-        for inode, ival in zip(self.inodes.values(), istate):
-            inode.set_value(*ival)
-
-        for enode, eval_ in zip(self.enodes.values(), estate):
-            enode.set_value(*eval_)
-
-
-    state = property(_pack_into_vector, _unpack_from_vector)
-
-
-    def _pack_intrinsics_into_vector(self):
-        """ pack intrinsic node states into a vector """
-        return np.hstack([ i.to_tuple() for i in self.inodes.values() ])
-
-
-    def _unpack_intrinsics_from_vector(self, v):
-        """ Set intrinsic node values from the vector `v` """
-        istate = np.reshape(v, (-1, 4))
-
-        for inode, ival in zip(self.inodes.values(), istate):
-            inode.set_value(*ival)
-
-
-    istate = property(_pack_intrinsics_into_vector, _unpack_intrinsics_from_vector)
+    """
+    `constraint_graph.ConstraintGraph` minimizing the weighted
+    squared errors of the constraints
+    """
+    packed_class = WeightedPackedHomographyConstraints
 
 
 
@@ -293,12 +149,16 @@ def main():
         graph.state = x
         return graph.constraint_errors()
 
+    def jacobian(x):
+        graph.state = x
+        return graph.constraint_jacobian().toarray()
+
     def optimize_graph():
         x0 = graph.state
         print_graph_summary('Initial:')
 
         print '\nOptimizing graph ...'
-        result = root(objective, x0, method='lm', options={'factor': 0.1, 'col_deriv': 1})
+        result = least_squares(objective, x0, jac=jacobian, method='trf', tr_solver='exact', x_scale='jac')
         print '  Success: ' + str(result.success)
         print '  %s' % result.message
 
@@ -3,16 +3,16 @@
 import os.path
 import numpy as np
 import cPickle as pickle
-from collections import OrderedDict
-from scipy.optimize import root
+from scipy.optimize import OptimizeResult
 
 from projective_math import SqExpWeightingFunction
 from camera_math import estimate_intrinsics_noskew_assume_cxy
 from camera_math import estimate_intrinsics_noskew
 from camera_math import get_extrinsics_from_homography
 from camera_math import matrix_to_xyzrph, matrix_to_intrinsics
-from camera_math import xyzrph_to_matrix, intrinsics_to_matrix
 from tupletypes import WorldImageHomographyInfo
+import constraint_graph
+from constraint_graph import IntrinsicsNode, ExtrinsicsNode, HomographyConstraint
 
 
 
@@ -60,164 +60,129 @@ class HomographyModel(object):
         return self.H0
 
 
-#-------------------------------------
-class IntrinsicsNode(object):
-#-------------------------------------
-    def __init__(self, fx, fy, cx, cy, tag):
-        self.fx = fx
-        self.fy = fy
-        self.cx = cx
-        self.cy = cy
-        self.tag = tag # convenient identification
-
-    def to_tuple(self):
-        return self.fx, self.fy, self.cx, self.cy
-
-    def set_value(self, *tupl):
-        self.fx = tupl[0]
-        self.fy = tupl[1]
-        self.cx = tupl[2]
-        self.cy = tupl[3]
-
-    def __repr__(self):
-        return repr(self.to_tuple())
-
-    def to_matrix(self):
-        return intrinsics_to_matrix(*self.to_tuple())
-
-
-#-------------------------------------
-class ExtrinsicsNode(object):
-#-------------------------------------
-    def __init__(self, x, y, z, r, p, h, tag):
-        self.x = x
-        self.y = y
-        self.z = z
-        self.r = r
-        self.p = p
-        self.h = h
-        self.tag = tag # convenient identification
-
-    def to_tuple(self):
-        return self.x, self.y, self.z, self.r, self.p, self.h
-
-    def set_value(self, *tupl):
-        self.x = tupl[0]
-        self.y = tupl[1]
-        self.z = tupl[2]
-        self.r = tupl[3]
-        self.p = tupl[4]
-        self.h = tupl[5]
-
-    def __repr__(self):
-        return repr(self.to_tuple())
-
-    def to_matrix(self):
-        return xyzrph_to_matrix(*self.to_tuple())
-
-
 #--------------------------------------
-class HomographyConstraint(object):
+class ConstraintGraph(constraint_graph.ConstraintGraph):
 #--------------------------------------
-    def __init__(self, hmodel, inode, enode):
-        H_wi, c_w, _ = hmodel.hinfo
-        weights = H_wi.get_correspondence_weights(c_w)
-
-        # 3-D homogeneous form with z=0
-        p_src = [ c.source for c in H_wi._corrs ]
-        N = len(p_src)
-        p_src = np.hstack([ p_src, np.zeros((N,1)), np.ones((N,1)) ])
-
-        self.p_src = p_src.T
-        self.p_tgt = np.array([ c.target for c in H_wi._corrs ]).T
-        self.W = np.diag(weights)
-        self.inode = inode
-        self.enode = enode
-
-    def sq_unweighted_reprojection_errors(self):
+    """
+    `constraint_graph.ConstraintGraph` with a Levenberg-Marquardt
+    solver that eliminates the extrinsics by Schur complement
+    """
+    def _normal_equations(self, state):
         """
-        compute the geometric reprojection error of the world
-        points `self.p_w` through the homography described
-        the composition of intrinsics and extrinsics.
+        The blocks of the Gauss-Newton normal equations at `state`:
+        U (4x4 per intrinsics node), V (6x6 per extrinsics node),
+        W (4x6 per linked pair of nodes) and the gradients g_i, g_e
         """
-        K = self.inode.to_matrix()
-        E = self.enode.to_matrix()
-        H = K.dot(E)
+        packed = self.packed
+        r, Ji, Je = packed.sq_errors_and_jacobians(state)
+        A = np.concatenate(( Ji, Je ), axis=2)
+        r = np.reshape(r, (2, -1))
 
-        p_mapped = H.dot(self.p_src)[:3,:]
+        U, g_i = np.zeros((packed.num_inodes, 4, 4)), np.zeros((packed.num_inodes, 4))
+        V, g_e = np.zeros((packed.num_enodes, 6, 6)), np.zeros((packed.num_enodes, 6))
+        W = dict()
 
-        # normalize homogeneous coordinates
-        M = np.diag(1./p_mapped[2,:])
-        p_mapped = p_mapped[:2,:].dot(M)
+        for (i, e), a, b in zip(packed.links, packed.bounds[:-1], packed.bounds[1:]):
+            Ac = np.reshape(A[:,a:b], (-1, 10))
+            H = Ac.T.dot(Ac)
+            g = Ac.T.dot(r[:,a:b].ravel())
 
-        return ((p_mapped - self.p_tgt)**2)
+            U[i] += H[:4,:4]
+            V[e] += H[4:,4:]
+            W[i,e] = W.get((i,e), 0.) + H[:4,4:]
+            g_i[i] += g[:4]
+            g_e[e] += g[4:]
 
+        return U, V, W, g_i, g_e
 
-    def sq_errors(self):
-        sqerr = self.sq_unweighted_reprojection_errors().ravel()
-        abserr = np.sqrt(sqerr)
 
-        def pseudo_huber_loss(delta):
-            return np.where(abserr <= delta, sqerr/2., delta*(abserr - delta/2.))
-
-        return pseudo_huber_loss(1.)
-
-
-#--------------------------------------
-class ConstraintGraph(object):
-#--------------------------------------
-    def __init__(self):
-        self.inodes = OrderedDict()
-        self.enodes = OrderedDict()
-        self.constraints = list()
-
-
-    def constraint_errors(self):
-        return np.hstack([ c.sq_errors() for c in self.constraints ])
-
-
-    def sq_pixel_errors(self):
-        homography_constraints = ( c for c in self.constraints if isinstance(c, HomographyConstraint) )
-        return np.hstack([ c.sq_unweighted_reprojection_errors() for c in homography_constraints ])
+    @staticmethod
+    def _schur_step(U, V, W, g_i, g_e, lambda_):
+        """
+        Solve the damped normal equations for the step of all nodes.
+        The extrinsics blocks are eliminated, the reduced system of the
+        intrinsics is solved, and the extrinsics steps are recovered by
+        back-substitution.
+        """
+        NI, NE = len(U), len(V)
+        d4, d6 = np.arange(4), np.arange(6)
 
+        U = U.copy()
+        V = V.copy()
+        U[:,d4,d4] += lambda_ * np.maximum(U[:,d4,d4], 1e-12)
+        V[:,d6,d6] += lambda_ * np.maximum(V[:,d6,d6], 1e-12)
+        Vinv = np.linalg.inv(V)
 
-    def _pack_into_vector(self):
-        """ pack node states into a vector """
-        istate = np.hstack([ i.to_tuple() for i in self.inodes.values() ])
-        estate = np.hstack([ e.to_tuple() for e in self.enodes.values() ])
-        return np.hstack(( istate, estate ))
+        # S = U - W V^-1 W^T,  b = -g_i + W V^-1 g_e
+        S = np.zeros((4*NI, 4*NI))
+        for i in xrange(NI):
+            S[4*i:4*i+4,4*i:4*i+4] = U[i]
+        b = -g_i
 
+        by_enode = dict()
+        for (i, e), Wie in W.iteritems():
+            by_enode.setdefault(e, []).append((i, Wie, Wie.dot(Vinv[e])))
 
-    def _unpack_from_vector(self, v):
-        """ Set node values from the vector `v` """
-        N = len(self.inodes)
-        istate = np.reshape(v[:4*N], (-1, 4))
-        estate = np.reshape(v[4*N:], (-1, 6))
+        for e, links in by_enode.iteritems():
+            for i, _, Yie in links:
+                b[i] += Yie.dot(g_e[e])
+                for j, Wje, _ in links:
+                    S[4*i:4*i+4,4*j:4*j+4] -= Yie.dot(Wje.T)
 
-        for inode, ival in zip(self.inodes.values(), istate):
-            inode.set_value(*ival)
+        step_i = np.linalg.solve(S, b.ravel()).reshape((NI, 4))
 
-        for enode, eval_ in zip(self.enodes.values(), estate):
-            enode.set_value(*eval_)
+        # V step_e = -g_e - W^T step_i
+        b_e = -g_e
+        for (i, e), Wie in W.iteritems():
+            b_e[e] -= Wie.T.dot(step_i[i])
+        step_e = np.einsum('nij,nj->ni', Vinv, b_e)
 
+        return np.hstack(( step_i.ravel(), step_e.ravel() ))
 
-    state = property(_pack_into_vector, _unpack_from_vector)
 
+    def solve(self, max_iterations=100, ftol=1e-8, xtol=1e-8, lambda_=1e-3):
+        """
+        Minimize the sum of squares of `constraint_errors` over the
+        node states by Levenberg-Marquardt. Each step is solved by Schur
+        complement on the extrinsics, so its cost is linear in the number
+        of poses. Returns a `scipy.optimize.OptimizeResult`.
+        """
+        packed = self.packed
 
-    def _pack_intrinsics_into_vector(self):
-        """ pack intrinsic node states into a vector """
-        return np.hstack([ i.to_tuple() for i in self.inodes.values() ])
+        x = self.state
+        r = packed.sq_errors(x)
+        cost = 0.5 * r.dot(r)
+        nfev, success = 1, False
+        message = 'The maximum number of iterations is exceeded.'
 
+        for nit in xrange(1, max_iterations+1):
+            blocks = self._normal_equations(x)
 
-    def _unpack_intrinsics_from_vector(self, v):
-        """ Set intrinsic node values from the vector `v` """
-        istate = np.reshape(v, (-1, 4))
+            # raise the damping until the step reduces the cost
+            while lambda_ < 1e16:
+                step = self._schur_step(*blocks, lambda_=lambda_)
+                r = packed.sq_errors(x + step)
+                new_cost = 0.5 * r.dot(r)
+                nfev += 1
+                if new_cost < cost:
+                    break
+                lambda_ *= 10.
+            else:
+                success, message = True, 'No step reduces the cost any further.'
+                break
 
-        for inode, ival in zip(self.inodes.values(), istate):
-            inode.set_value(*ival)
+            lambda_ = max(lambda_ / 10., 1e-12)
+            x, dcost, cost = x + step, cost - new_cost, new_cost
 
+            if dcost < ftol * cost:
+                success, message = True, '`ftol` termination condition is satisfied.'
+                break
+            if np.linalg.norm(step) < xtol * (xtol + np.linalg.norm(x)):
+                success, message = True, '`xtol` termination condition is satisfied.'
+                break
 
-    istate = property(_pack_intrinsics_into_vector, _unpack_intrinsics_from_vector)
+        self.state = x
+        return OptimizeResult(x=x, cost=cost, success=success, message=message, nit=nit, nfev=nfev)
 
 
 
@@ -292,16 +257,11 @@ def main():
         for itag, inode in graph.inodes.iteritems():
             print '  intrinsics@ ' + itag + " =", np.array(inode.to_tuple())
 
-    def objective(x):
-        graph.state = x
-        return graph.constraint_errors()
-
     def optimize_graph():
-        x0 = graph.state
         print_graph_summary('Initial:')
 
         print '\nOptimizing graph ...'
-        result = root(objective, x0, method='lm', options={'factor': 0.1, 'col_deriv': 1})
+        result = graph.solve()
         print '  Success: ' + str(result.success)
         print '  %s' % result.message
 
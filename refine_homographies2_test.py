@@ -0,0 +1,104 @@
+import numpy as np
+from scipy.optimize import least_squares
+from camera_math import intrinsics_to_matrix, xyzrph_to_matrix
+from constraint_graph import IntrinsicsNode, ExtrinsicsNode
+from refine_homographies2 import ConstraintGraph
+
+
+np.set_printoptions(precision=4, suppress=True)
+np.random.seed(0)
+
+
+class PointsConstraint(object):
+    """ The world points `p_w` seen through `inode` and `enode`, plus `noise` pixels """
+    def __init__(self, p_w, inode, enode, noise=0.):
+        N = len(p_w)
+        self.p_src = np.hstack([ p_w, np.zeros((N,1)), np.ones((N,1)) ]).T
+        p_i = intrinsics_to_matrix(*inode.to_tuple()).dot(
+                xyzrph_to_matrix(*enode.to_tuple())).dot(self.p_src)
+        self.p_tgt = p_i[:2] / p_i[2] + noise * np.random.randn(2, N)
+        self.inode = inode
+        self.enode = enode
+
+
+def create_graph():
+    """
+    2 intrinsics and 4 extrinsics nodes, every pose seen at both zooms,
+    with pixel noise on both sides of the pseudo-Huber threshold
+    """
+    graph = ConstraintGraph()
+    for k in xrange(2):
+        inode = IntrinsicsNode(2500.+300*k, 2490.+300*k, 2000.+5*k, 1500.-5*k, tag='zoom%d' % k)
+        graph.inodes[inode.tag] = inode
+    for k in xrange(4):
+        enode = ExtrinsicsNode(0.02*k-0.03, 0.01*k, 1.+0.05*k, np.pi+0.15*(k-1.5),
+                               0.2*(k % 2)-0.1, 0.1*k, tag='pose%d' % k)
+        graph.enodes[enode.tag] = enode
+
+    p_w = np.random.uniform(-.15, .15, (40, 2))
+    for inode in graph.inodes.values():
+        for enode in graph.enodes.values():
+            graph.constraints.append(PointsConstraint(p_w, inode, enode, noise=1.))
+
+    graph.state = graph.state + np.r_[ np.random.uniform(-30, 30, 8), np.random.uniform(-0.02, 0.02, 24) ]
+    return graph
+
+
+def cost(graph, state):
+    r = graph.packed.sq_errors(state)
+    return 0.5 * r.dot(r)
+
+
+print '\n--schur step vs dense normal equations--------------------\n'
+graph = create_graph()
+J = graph.constraint_jacobian().toarray()
+r = graph.constraint_errors()
+blocks = graph._normal_equations(graph.state)
+
+d = np.arange(J.shape[1])
+for lambda_ in [ 0., 1e-3, 10. ]:
+    H = J.T.dot(J)
+    H[d,d] += lambda_ * np.maximum(H[d,d], 1e-12)
+    dense = np.linalg.solve(H, -J.T.dot(r))
+    step = ConstraintGraph._schur_step(*blocks, lambda_=lambda_)
+    assert np.allclose(step, dense, rtol=1e-6, atol=1e-9 * abs(dense).max())
+print '  ok'
+
+
+print '\n--solve vs least_squares--------------------\n'
+graph = create_graph()
+x0 = graph.state.copy()
+
+def fun(state):
+    return graph.packed.sq_errors(state)
+
+def jac(state):
+    graph.state = state
+    return graph.constraint_jacobian().toarray()
+
+expected = least_squares(fun, x0, jac=jac, method='lm', x_scale='jac',
+                         ftol=1e-12, xtol=1e-12, gtol=1e-12)
+graph.state = x0
+result = graph.solve(ftol=1e-12, xtol=1e-12)
+print '  %s (%d iterations)' % (result.message, result.nit)
+print '  intrinsics: %s' % result.x[:8]
+assert result.success
+assert np.allclose(result.cost, expected.cost, rtol=1e-8)
+assert np.allclose(result.x[:8], expected.x[:8], rtol=1e-6, atol=1e-6)
+assert np.allclose(result.x[8:], expected.x[8:], rtol=1e-6, atol=1e-9)
+assert np.allclose(graph.state, result.x)
+print '  ok'
+
+
+print '\n--cost never increases--------------------\n'
+# solve is deterministic, so stopping it after k iterations gives the
+# state after its k-th accepted step
+costs = [ cost(graph, x0) ]
+for k in xrange(1, result.nit+1):
+    graph.state = x0
+    step = graph.solve(max_iterations=k, ftol=1e-12, xtol=1e-12)
+    assert np.allclose(step.cost, cost(graph, step.x))
+    costs.append(step.cost)
+assert all(b <= a for a, b in zip(costs[:-1], costs[1:]))
+assert np.allclose(costs[-1], result.cost)
+print '  ok'
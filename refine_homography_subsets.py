@@ -1,18 +1,23 @@
 #! /usr/bin/python
 
 import os.path
+import sys
+import traceback
 import numpy as np
 import cPickle as pickle
-from itertools import groupby
-from collections import OrderedDict
-from scipy.optimize import root
+from time import time
+from itertools import groupby, combinations
+from multiprocessing import Pool, cpu_count
+from scipy.optimize import least_squares
+from scipy.special import comb
 
 from camera_math import estimate_intrinsics_noskew_assume_cxy
 from camera_math import estimate_intrinsics_noskew
 from camera_math import get_extrinsics_from_homography
 from camera_math import matrix_to_xyzrph, matrix_to_intrinsics
-from camera_math import xyzrph_to_matrix, intrinsics_to_matrix
 from tupletypes import WorldImageHomographyInfo
+from constraint_graph import IntrinsicsNode, ExtrinsicsNode, ConstraintGraph
+from constraint_graph import HomographyConstraint
 
 
 
@@ -60,180 +65,9 @@ class HomographyModel(object):
         return self.H0
 
 
-#-------------------------------------
-class IntrinsicsNode(object):
-#-------------------------------------
-    def __init__(self, fx, fy, cx, cy, tag):
-        self.fx = fx
-        self.fy = fy
-        self.cx = cx
-        self.cy = cy
-        self.tag = tag # convenient identification
-
-    def to_tuple(self):
-        return self.fx, self.fy, self.cx, self.cy
-
-    def set_value(self, *tupl):
-        self.fx = tupl[0]
-        self.fy = tupl[1]
-        self.cx = tupl[2]
-        self.cy = tupl[3]
-
-    def __repr__(self):
-        return repr(self.to_tuple())
-
-    def to_matrix(self):
-        return intrinsics_to_matrix(*self.to_tuple())
-
-
-#-------------------------------------
-class ExtrinsicsNode(object):
-#-------------------------------------
-    def __init__(self, x, y, z, r, p, h, tag):
-        self.x = x
-        self.y = y
-        self.z = z
-        self.r = r
-        self.p = p
-        self.h = h
-        self.tag = tag # convenient identification
-
-    def to_tuple(self):
-        return self.x, self.y, self.z, self.r, self.p, self.h
-
-    def set_value(self, *tupl):
-        self.x = tupl[0]
-        self.y = tupl[1]
-        self.z = tupl[2]
-        self.r = tupl[3]
-        self.p = tupl[4]
-        self.h = tupl[5]
-
-    def __repr__(self):
-        return repr(self.to_tuple())
-
-    def to_matrix(self):
-        return xyzrph_to_matrix(*self.to_tuple())
-
-
-#--------------------------------------
-class HomographyConstraint(object):
-#--------------------------------------
-    def __init__(self, hmodel, inode, enode):
-        H_wi, c_w, _ = hmodel.hinfo
-        weights = H_wi.get_correspondence_weights(c_w)
-
-        # 3-D homogeneous form with z=0
-        p_src = [ c.source for c in H_wi._corrs ]
-        N = len(p_src)
-        p_src = np.hstack([ p_src, np.zeros((N,1)), np.ones((N,1)) ])
-
-        self.p_src = p_src.T
-        self.p_tgt = np.array([ c.target for c in H_wi._corrs ]).T
-        self.W = np.diag(weights)
-        self.inode = inode
-        self.enode = enode
-
-    def sq_unweighted_reprojection_errors(self):
-        """
-        compute the geometric reprojection error of the world
-        points `self.p_w` through the homography described
-        the composition of intrinsics and extrinsics.
-        """
-        K = self.inode.to_matrix()
-        E = self.enode.to_matrix()
-        H = K.dot(E)
-
-        p_mapped = H.dot(self.p_src)[:3,:]
-
-        # normalize homogeneous coordinates
-        M = np.diag(1./p_mapped[2,:])
-        p_mapped = p_mapped[:2,:].dot(M)
-
-        return ((p_mapped - self.p_tgt)**2)
-
-
-    def sq_errors(self):
-        sqerr = self.sq_unweighted_reprojection_errors().ravel()
-        abserr = np.sqrt(sqerr)
-
-        def pseudo_huber_loss(delta):
-            return np.where(abserr <= delta, sqerr/2., delta*(abserr - delta/2.))
-
-        return pseudo_huber_loss(1.)
-
-
-#--------------------------------------
-class ConstraintGraph(object):
-#--------------------------------------
-    def __init__(self):
-        self.inodes = OrderedDict()
-        self.enodes = OrderedDict()
-        self.constraints = list()
-
-
-    def constraint_errors(self):
-        return np.hstack([ c.sq_errors() for c in self.constraints ])
-
-
-    def sq_pixel_errors(self):
-        homography_constraints = ( c for c in self.constraints if isinstance(c, HomographyConstraint) )
-        return np.hstack([ c.sq_unweighted_reprojection_errors() for c in homography_constraints ])
-
-
-    def _pack_into_vector(self):
-        """ pack node states into a vector """
-        istate = np.hstack([ i.to_tuple() for i in self.inodes.values() ])
-        estate = np.hstack([ e.to_tuple() for e in self.enodes.values() ])
-        return np.hstack(( istate, estate ))
-
-
-    def _unpack_from_vector(self, v):
-        """ Set node values from the vector `v` """
-        N = len(self.inodes)
-        istate = np.reshape(v[:4*N], (-1, 4))
-        estate = np.reshape(v[4*N:], (-1, 6))
-
-        for inode, ival in zip(self.inodes.values(), istate):
-            inode.set_value(*ival)
-
-        for enode, eval_ in zip(self.enodes.values(), estate):
-            enode.set_value(*eval_)
-
-
-    state = property(_pack_into_vector, _unpack_from_vector)
-
-
-    def _pack_intrinsics_into_vector(self):
-        """ pack intrinsic node states into a vector """
-        return np.hstack([ i.to_tuple() for i in self.inodes.values() ])
-
-
-    def _unpack_intrinsics_from_vector(self, v):
-        """ Set intrinsic node values from the vector `v` """
-        istate = np.reshape(v, (-1, 4))
-
-        for inode, ival in zip(self.inodes.values(), istate):
-            inode.set_value(*ival)
-
-
-    istate = property(_pack_intrinsics_into_vector, _unpack_intrinsics_from_vector)
-
-
-def refine_homography_subset(args):
-    """ Load homographies pickled in `homography_files` and
-    choose a subset of these homographies according to `bit_index`.
-    Refine this subset of homographies """
-
-    homography_files, bit_index = args
-
-    def take_by_bitindex(list_, bits_as_int):
-        indices = xrange(len(list_)-1, -1, -1)
-        bool_bits = ( bool(bits_as_int & 2**i) for i in indices )
-        return [ entry for entry, bit in zip(list_, bool_bits) if bit ]
-
-    homography_files = take_by_bitindex(homography_files, bit_index)
-    hmodels = [ HomographyModel.load_from_file(f) for f in homography_files ]
+def refine_homography_subset(hmodels):
+    """ Refine the intrinsics of a subset of homographies, given
+    as a list of `HomographyModel`s. Returns the refined intrinsics """
 
     #
     # Deconstruct information in the HomographyModels into
@@ -271,39 +105,111 @@ def refine_homography_subset(args):
         graph.state = x
         return graph.constraint_errors()
 
+    def jacobian(x):
+        graph.state = x
+        return graph.constraint_jacobian()
+
     x0 = graph.state
-    result = root(objective, x0, method='lm', options={'factor': 0.1, 'col_deriv': 1})
+    result = least_squares(objective, x0, jac=jacobian, method='trf', tr_solver='lsmr', x_scale='jac')
     graph.state = result.x
 
     return graph.istate
 
 
-def refine_homography_subset_no_except(args):
+# HomographyModels shared with the workers of `refine_homography_subsets`.
+# They are set before the pool is created, so the forked workers inherit
+# them instead of unpickling the files again for every subset.
+_HMODELS = []
+
+
+def _refine_subset(indices):
+    """
+    Refine the subset `indices` of `_HMODELS`. Returns the indices,
+    the refined intrinsics (None if it failed), the time taken, and
+    the traceback if it failed.
+    """
+    t0 = time()
+    try:
+        istate = refine_homography_subset([ _HMODELS[i] for i in indices ])
+        error = None
+    except Exception:
+        istate, error = None, traceback.format_exc()
+
+    return indices, istate, time() - t0, error
+
+
+def random_combinations(n, m, count):
+    """
+    `count` distinct combinations of `m` out of `range(n)` drawn at
+    random, as sorted tuples, or all of them if there are not more
+    than `count`
+    """
+    n_choose_m = comb(n, m, exact=True)
+    if n_choose_m <= count:
+        return list(combinations(xrange(n), m))
+
+    if n_choose_m <= 2*count:
+        # most of them are needed, so pick from the full list
+        all_ = list(combinations(xrange(n), m))
+        return [ all_[k] for k in np.random.choice(n_choose_m, count, replace=False) ]
+
+    drawn = set()
+    while len(drawn) < count:
+        drawn.add(tuple(sorted(np.random.choice(n, m, replace=False))))
+    return sorted(drawn)
+
+
+def refine_homography_subsets(hmodels, subset_size=5, num_subsets=250, processes=None):
+    """
+    Refine `num_subsets` random subsets of `subset_size` of `hmodels`
+    across a pool of `processes` workers (default: one per cpu). Results
+    are printed in the order of the subsets; a failed subset is reported
+    and left out. Returns the refined intrinsics of the other subsets.
+    """
+    global _HMODELS
+
+    for hm in hmodels:
+        hm.homography_at_center()
+    _HMODELS = hmodels
+
+    subsets = random_combinations(len(hmodels), subset_size, num_subsets)
+    processes = processes or cpu_count()
+    pool = Pool(min(processes, len(subsets)) or 1)
+
+    samples = []
+    t0 = time()
     try:
-        return refine_homography_subset(args)
-    except:
-        return (0., 0., 0., 0.)
+        results = pool.imap(_refine_subset, subsets)
+        for k, (indices, istate, seconds, error) in enumerate(results):
+            status = 'FAILED' if error else 'ok'
+            etags = ' '.join( hmodels[i].etag for i in indices )
+            print '    [%d/%d] %6.2fs  %-6s %s' % (k+1, len(subsets), seconds, status, etags)
+            if error:
+                print '      ' + error.strip().replace('\n', '\n      ')
+            else:
+                samples.append(istate)
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        _HMODELS = []
+
+    print '\n    %d subsets in %.2fs, %d failed\n' % (
+        len(subsets), time() - t0, len(subsets) - len(samples))
+    return samples
 
 
 def main():
-    import sys
-    import multiprocessing
     from glob import glob
 
     np.set_printoptions(precision=4, suppress=True)
 
-    def random_combinations(n, m):
-        n_choose_m = [ x for x in xrange(2**n) if bin(x).count('1') == m ]
-        return np.random.choice(n_choose_m, 250, replace=False)
-
     for subfolder in sorted(glob(sys.argv[1] + '/*/')):
         print '  %s' % subfolder
-        homography_files = glob(subfolder + '*.lh0')
-        num_files = len(homography_files)
+        homography_files = sorted(glob(subfolder + '*.lh0'))
+        hmodels = [ HomographyModel.load_from_file(f) for f in homography_files ]
 
-        pool = multiprocessing.Pool()
-        args = [ (homography_files, bit_index) for bit_index in random_combinations(num_files, 5) ]
-        samples = pool.map(refine_homography_subset_no_except, args)
+        samples = refine_homography_subsets(hmodels)
 
         with open(subfolder + '/intrinsics.samples', 'w') as f:
             pickle.dump(samples, f)
@@ -0,0 +1,54 @@
+import numpy as np
+from time import sleep
+from scipy.special import comb
+import refine_homography_subsets
+from refine_homography_subsets import random_combinations, refine_homography_subsets as refine_subsets
+
+
+np.random.seed(0)
+
+
+print '\n--random combinations--------------------\n'
+for n, m, count in [ (20, 5, 250), (8, 3, 40), (8, 3, 56), (8, 3, 100), (5, 5, 3) ]:
+    subsets = random_combinations(n, m, count)
+    assert len(subsets) == min(count, comb(n, m, exact=True))
+    assert len(set(subsets)) == len(subsets)
+    for s in subsets:
+        assert len(s) == m and list(s) == sorted(set(s))
+        assert 0 <= s[0] and s[-1] < n
+
+# not more than `count` of them: all, in order
+assert random_combinations(6, 2, 15) == random_combinations(6, 2, 100) == [
+        (i, j) for i in xrange(6) for j in xrange(i+1, 6) ]
+print '  ok'
+
+
+print '\n--subsets keep their results--------------------\n'
+class FakeModel(object):
+    def __init__(self, k):
+        self.k = k
+        self.etag = 'pose%d' % k
+
+    def homography_at_center(self):
+        pass
+
+def fake_refine(hmodels):
+    # uneven times, so that the workers finish out of order
+    sleep(0.01 * (sum( hm.k for hm in hmodels ) % 4))
+    if hmodels[0].k == 0:
+        raise ValueError('first model')
+    return np.array([ hm.k for hm in hmodels ])
+
+# the forked workers inherit the replaced function
+refine_homography_subsets.refine_homography_subset = fake_refine
+
+hmodels = [ FakeModel(k) for k in xrange(9) ]
+np.random.seed(1)
+subsets = random_combinations(len(hmodels), 4, 30)
+expected = [ np.array(s) for s in subsets if s[0] != 0 ]
+for processes in [ 1, 4 ]:
+    np.random.seed(1)
+    samples = refine_subsets(hmodels, subset_size=4, num_subsets=30, processes=processes)
+    assert len(samples) == len(expected)
+    assert all(np.array_equal(a, b) for a, b in zip(samples, expected))
+print '  ok'
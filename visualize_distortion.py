@@ -10,7 +10,8 @@ from skimage.io import imread
 from skimage.color import rgb2gray
 from skimage.filters import scharr
 
-from gp import GaussianProcess, sqexp2D_covariancef
+from gp import GaussianProcess, MultiOutputGaussianProcess, sqexp2D_covariancef
+from gp import set_num_threads
 
 
 
@@ -55,7 +56,7 @@ class HomographyModel(object):
 #--------------------------------------
 class GPModel(object):
 #--------------------------------------
-    def __init__(self, points_i, values):
+    def __init__(self, points_i, values, joint=True):
         assert len(points_i) == len(values)
 
         X = points_i
@@ -65,30 +66,45 @@ class GPModel(object):
         V = values - np.tile(meanV, (len(values), 1))
 
         self._meanV = meanV
-        self._gp_x = GPModel._fit_gp(X, S, V[:,0])
-        self._gp_y = GPModel._fit_gp(X, S, V[:,1])
-
+        if joint:
+            # one set of length-scales for both components
+            self._gp, = MultiOutputGaussianProcess.fit_restarts([
+                (X, V, sqexp2D_covariancef, GPModel._initial_thetas(S, V)) ],
+                processes=GPModel.processes, prune_after=GPModel.prune_after)
+        else:
+            self._gp_x, self._gp_y = GaussianProcess.fit_restarts([
+                (X, V[:,0], sqexp2D_covariancef, GPModel._initial_thetas(S, V[:,0])),
+                (X, V[:,1], sqexp2D_covariancef, GPModel._initial_thetas(S, V[:,1])) ],
+                processes=GPModel.processes, prune_after=GPModel.prune_after)
+
+
+    # Run all restarts for this many iterations, then only those close
+    # to the best one to the end (None to run all of them to the end)
+    prune_after = None
+
+    # Worker processes for the restarts (None: one per cpu). A pool only
+    # pays off when the fits take longer than starting it, so the default
+    # is to fit in this process
+    processes = 1
 
     @staticmethod
-    def _fit_gp(X, covX, t):
+    def _initial_thetas(covX, t):
         xx, xy, yy = covX[0,0], covX[0,1], covX[1,1]
 
         # Perform hyper-parameter optimization with different
         # initial points and choose the GP with best model evidence
-        theta0 = np.array(( t.std(), sqrt(xx), sqrt(yy), xy, 10. ))
-        best_gp = GaussianProcess.fit(X, t, sqexp2D_covariancef, theta0)
-
+        theta0s = [ np.array(( t.std(), sqrt(xx), sqrt(yy), xy, 10. )) ]
         for tau in xrange(50, 800, 100):
-            theta0 = np.array(( t.std(), tau, tau, 0, 10. ))
-            gp = GaussianProcess.fit(X, t, sqexp2D_covariancef, theta0)
-            if gp.model_evidence() > best_gp.model_evidence():
-                best_gp = gp
+            theta0s.append(np.array(( t.std(), tau, tau, 0, 10. )))
 
-        return best_gp
+        return theta0s
 
 
     def predict(self, X):
-        V = np.vstack([ self._gp_x.predict(X), self._gp_y.predict(X) ]).T
+        if getattr(self, '_gp', None) is not None:
+            V = self._gp.predict(X)
+        else:
+            V = np.vstack([ self._gp_x.predict(X), self._gp_y.predict(X) ]).T
         return V + np.tile(self._meanV, (len(X), 1))
 
 
@@ -128,16 +144,12 @@ def save_plot(hmodel):
 
         print '\nGP Hyper-parameters'
         print '---------------------'
-        print '  x: ', model._gp_x._covf.theta
-        print '        log-likelihood: %.4f' % model._gp_x.model_evidence()
-        print '  y: ', model._gp_y._covf.theta
-        print '        log-likelihood: %.4f' % model._gp_y.model_evidence()
+        print '  x, y: ', model._gp._covf.theta
+        print '  scales:', model._gp.scales()
+        print '        log-likelihood: %.4f' % model._gp.model_evidence()
         print ''
         print '  Optimization detail:'
-        print '  [ x ]'
-        print '  ' + str(model._gp_x.fit_result).replace('\n', '\n      ')
-        print '  [ y ]'
-        print '  ' + str(model._gp_y.fit_result).replace('\n', '\n      ')
+        print '  ' + str(model._gp.fit_result).replace('\n', '\n      ')
 
         with open(hmodel.filestem + '.gp', 'w') as f:
             pickle.dump(model, f)
@@ -201,9 +213,26 @@ def save_plot(hmodel):
 
 
 def main():
+    """
+    usage: visualize_distortion.py [-j N] [-t N] homography_model ...
+
+    -j N  fit the GP restarts on N worker processes (0: one per cpu)
+    -t N  compute the gram matrices on N threads (each worker uses one)
+    """
     np.set_printoptions(precision=4, suppress=True)
 
-    for filename in sys.argv[1:]:
+    args = sys.argv[1:]
+    while args and args[0].startswith('-'):
+        opt = args.pop(0)
+        if opt == '-j' and args:
+            GPModel.processes = int(args.pop(0)) or None
+        elif opt == '-t' and args:
+            set_num_threads(int(args.pop(0)))
+        else:
+            print main.__doc__
+            sys.exit(2)
+
+    for filename in args:
         hmodel = HomographyModel.load_from_file(filename)
         save_plot(hmodel)
 